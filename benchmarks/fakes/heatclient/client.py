@@ -0,0 +1,162 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2015, Craig Tracey <craigtracey@gmail.com>
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+
+import time
+import itertools
+import threading
+
+# how long a created or updated stack takes to converge and how many
+# resources it has, set by the benchmark
+CONVERGE_SECONDS = 5.0
+RESOURCES = 10
+# what stacks.get() returns as the stack outputs
+OUTPUTS = []
+
+calls = {}
+_stacks = {}
+_event_ids = itertools.count(1)
+_stack_ids = itertools.count(1)
+_lock = threading.Lock()
+
+
+def reset():
+    calls.clear()
+    _stacks.clear()
+
+
+def _count(call):
+    with _lock:
+        calls[call] = calls.get(call, 0) + 1
+
+
+def _timestamp(when):
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(when))
+
+
+class _Resource(object):
+
+    def __init__(self, **attrs):
+        self.__dict__.update(attrs)
+
+
+class _Stack(object):
+    # events are scheduled up front; what the API shows is whatever is due
+
+    def __init__(self, name, template, parameters):
+        self.id = 'stack-%d' % next(_stack_ids)
+        self.name = name
+        self.template = template
+        self.parameters = parameters
+        self.created = time.time()
+        self.updated = None
+        self.events = []
+        self._converge('CREATE')
+
+    def _converge(self, action):
+        start = time.time()
+        self.action = action
+        self.done_at = start + CONVERGE_SECONDS
+        self._event(start, self.name, action + '_IN_PROGRESS')
+        for i in range(RESOURCES):
+            name = 'server%d' % i
+            self._event(start + CONVERGE_SECONDS * i / (2.0 * RESOURCES),
+                        name, action + '_IN_PROGRESS')
+            self._event(start + CONVERGE_SECONDS * (i + 1) / (RESOURCES + 1),
+                        name, action + '_COMPLETE')
+        self._event(self.done_at, self.name, action + '_COMPLETE')
+        self.events.sort(key=lambda event: event[0])
+
+    def _event(self, when, resource, status):
+        self.events.append((when, next(_event_ids), resource, status))
+
+    def update(self, template, parameters):
+        self.template = template
+        self.parameters = parameters
+        self.updated = time.time()
+        self._converge('UPDATE')
+
+    def view(self, outputs=False):
+        status = 'COMPLETE' if time.time() >= self.done_at else 'IN_PROGRESS'
+        return _Resource(
+            id=self.id,
+            stack_name=self.name,
+            action=self.action,
+            status=status,
+            stack_status='%s_%s' % (self.action, status),
+            creation_time=_timestamp(self.created),
+            updated_time=self.updated and _timestamp(self.updated),
+            outputs=list(OUTPUTS) if outputs else None)
+
+    def visible_events(self):
+        now = time.time()
+        return [_Resource(id=str(event_id), resource_name=resource,
+                          resource_status=status,
+                          resource_status_reason='state changed',
+                          event_time=_timestamp(when))
+                for when, event_id, resource, status in self.events
+                if when <= now]
+
+
+def _stack(stack_id):
+    for stack in _stacks.values():
+        if stack_id in (stack.id, stack.name):
+            return stack
+    error = Exception("Stack %s not found" % stack_id)
+    error.code = 404
+    raise error
+
+
+class _Stacks(object):
+
+    def list(self, filters=None):
+        _count('stacks.list')
+        name = (filters or {}).get('name')
+        for stack in list(_stacks.values()):
+            if name is None or stack.name == name:
+                yield stack.view()
+
+    def get(self, stack_id):
+        _count('stacks.get')
+        return _stack(stack_id).view(outputs=True)
+
+    def create(self, stack_name, template=None, parameters=None, **kwargs):
+        _count('stacks.create')
+        _stacks[stack_name] = _Stack(stack_name, template, parameters)
+
+    def update(self, stack_id, template=None, parameters=None, **kwargs):
+        _count('stacks.update')
+        _stack(stack_id).update(template, parameters)
+
+
+class _Events(object):
+
+    def list(self, stack_id, marker=None, sort_dir='asc', limit=None,
+             **kwargs):
+        _count('events.list')
+        events = _stack(stack_id).visible_events()
+        if sort_dir == 'desc':
+            events.reverse()
+        if marker is not None:
+            ids = [event.id for event in events]
+            events = events[ids.index(marker) + 1:] if marker in ids else []
+        return events[:limit] if limit else events
+
+
+class Client(object):
+
+    def __init__(self, version, endpoint=None, token=None, **kwargs):
+        self.stacks = _Stacks()
+        self.events = _Events()
@@ -0,0 +1,26 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2015, Craig Tracey <craigtracey@gmail.com>
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+
+
+def format_parameters(params):
+    # "KEY1=VALUE1;KEY2=VALUE2", given once or several times
+    parameters = {}
+    for param in params or []:
+        for pair in param.split(';'):
+            if pair:
+                key, _, value = pair.partition('=')
+                parameters[key] = value
+    return parameters
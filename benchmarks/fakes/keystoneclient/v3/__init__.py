@@ -0,0 +1,48 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2015, Craig Tracey <craigtracey@gmail.com>
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+
+import time
+import datetime
+
+# how long a login takes, set by the benchmark
+LOGIN_SECONDS = 0.2
+TOKEN_LIFETIME = 3600
+ENDPOINT = 'http://heat.invalid:8004/v1/benchmark'
+logins = 0
+
+
+class _Catalog(object):
+
+    def url_for(self, service_type=None, endpoint_type=None):
+        return ENDPOINT
+
+
+class _AuthRef(object):
+
+    def __init__(self):
+        self.expires = datetime.datetime.utcnow() + \
+            datetime.timedelta(seconds=TOKEN_LIFETIME)
+
+
+class Client(object):
+
+    def __init__(self, **creds):
+        global logins
+        time.sleep(LOGIN_SECONDS)
+        logins += 1
+        self.auth_token = 'token-%d' % logins
+        self.auth_ref = _AuthRef()
+        self.service_catalog = _Catalog()
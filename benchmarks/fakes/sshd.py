@@ -0,0 +1,138 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2015, Craig Tracey <craigtracey@gmail.com>
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+
+import time
+import socket
+import threading
+
+import paramiko
+
+
+class _Server(paramiko.ServerInterface):
+    # any user with any key gets in; direct-tcpip channels (ssh -W) are
+    # connected to the routed address of their destination
+
+    def __init__(self, routes):
+        self.routes = routes
+        self.pending = {}
+
+    def get_allowed_auths(self, username):
+        return 'publickey'
+
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_direct_tcpip_request(self, chanid, origin, destination):
+        address = self.routes.get(tuple(destination), tuple(destination))
+        try:
+            self.pending[chanid] = socket.create_connection(address, 5)
+        except socket.error:
+            return paramiko.OPEN_FAILED_CONNECT_FAILED
+        return paramiko.OPEN_SUCCEEDED
+
+
+def _pump(source, target):
+    try:
+        while True:
+            data = source.recv(32 * 1024)
+            if not data:
+                break
+            target.sendall(data)
+    except Exception:
+        pass
+    finally:
+        for end in (source, target):
+            try:
+                end.close()
+            except Exception:
+                pass
+
+
+def _thread(target, *args):
+    thread = threading.Thread(target=target, args=args)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+class DelayedSSHServer(object):
+    # An sshd on 127.0.0.1 that refuses connections until `delay` seconds
+    # after start(), like a server that is still booting. The port is
+    # reserved up front so it can be handed out before the server is up.
+
+    def __init__(self, host_key, delay=0, routes=None):
+        self.host_key = host_key
+        self.delay = delay
+        self.routes = routes or {}
+        self.ready_at = None
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.bind(('127.0.0.1', 0))
+        self.port = self._sock.getsockname()[1]
+        self._closed = False
+        self._transports = []
+
+    def start(self):
+        self.ready_at = time.time() + self.delay
+        _thread(self._serve)
+        return self
+
+    def _serve(self):
+        time.sleep(max(0, self.ready_at - time.time()))
+        # a bound socket that isn't listening refuses connections
+        self._sock.listen(64)
+        while not self._closed:
+            try:
+                conn, _ = self._sock.accept()
+            except socket.error:
+                return
+            _thread(self._session, conn)
+
+    def _session(self, conn):
+        transport = paramiko.Transport(conn)
+        self._transports.append(transport)
+        transport.add_server_key(self.host_key)
+        server = _Server(self.routes)
+        try:
+            # a TCP only probe never sends its banner
+            transport.start_server(server=server)
+        except (paramiko.SSHException, EOFError, socket.error):
+            transport.close()
+            return
+        while transport.is_active() and not self._closed:
+            channel = transport.accept(1)
+            if channel is None:
+                continue
+            target = server.pending.pop(channel.get_id(), None)
+            if target is None:
+                channel.close()
+                continue
+            _thread(_pump, channel, target)
+            _thread(_pump, target, channel)
+
+    def close(self):
+        self._closed = True
+        try:
+            # wakes up a blocked accept()
+            self._sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self._sock.close()
+        for transport in self._transports:
+            transport.close()
@@ -0,0 +1,302 @@
+#!/usr/bin/env python
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2015, Craig Tracey <craigtracey@gmail.com>
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+
+# Runs ursula's provisioning and output paths end to end against the local
+# stand-ins in benchmarks/fakes (heat and keystone, vagrant, a delayed sshd
+# and a chatty ansible-playbook), fully offline, and prints how long each
+# took to get to ready as JSON that can be tracked across commits.
+#
+#   python benchmarks/provisioning.py [--scenario heat,vagrant,ssh,output]
+#                                     [--quick] [--record results.jsonl]
+
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+import contextlib
+import subprocess
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+REPO = os.path.dirname(BENCHMARKS)
+FAKES = os.path.join(BENCHMARKS, 'fakes')
+FAKE_BIN = os.path.join(FAKES, 'bin')
+# the fakes shadow any installed heatclient and keystoneclient
+sys.path[:0] = [FAKES, REPO]
+
+SCENARIOS = ('heat', 'vagrant', 'ssh', 'output')
+
+
+@contextlib.contextmanager
+def _quiet():
+    # ursula's progress output would otherwise end up in the results
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        yield
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+
+def _timed(func, *args, **kwargs):
+    started = time.time()
+    with _quiet():
+        func(*args, **kwargs)
+    return time.time() - started
+
+
+def _fake_env(**values):
+    env = os.environ.copy()
+    env['PATH'] = os.pathsep.join([FAKE_BIN, env.get('PATH', '')])
+    env.update((key, str(value)) for key, value in values.items())
+    return env
+
+
+def _percentile(values, pct):
+    values = sorted(values)
+    return values[max(0, int(round(pct / 100.0 * len(values))) - 1)]
+
+
+def bench_heat(workdir, scale):
+    from heatclient import client as fake_heat
+    from keystoneclient import v3 as fake_keystone
+    from ursula_cli import shell
+
+    fake_heat.reset()
+    fake_heat.CONVERGE_SECONDS = 10 * scale
+    fake_heat.RESOURCES = 20
+    environment = os.path.join(workdir, 'heat')
+    os.makedirs(environment)
+    args = argparse.Namespace(
+        environment=environment, heat_stack_name='benchmark',
+        heat_parameters=['flavor=m1.small'], heat_stack_update=False,
+        heat_probe_servers=False, ursula_user='ubuntu',
+        ursula_ssh_timeout=60, ursula_ssh_concurrency=16)
+    env = _fake_env(OS_USERNAME='benchmark', OS_PASSWORD='benchmark',
+                    OS_TENANT_NAME='benchmark',
+                    OS_AUTH_URL='http://keystone.invalid:5000/v3')
+    template = "heat_template_version: 2013-05-23\n"
+
+    create = _timed(shell._run_heat, args, template, env=env)
+    create_calls = sum(fake_heat.calls.values())
+    fake_heat.calls.clear()
+    unchanged = _timed(shell._run_heat, args, template, env=env)
+    return {
+        'converge_seconds': fake_heat.CONVERGE_SECONDS,
+        'resources': fake_heat.RESOURCES,
+        'create_ready_seconds': create,
+        'create_overhead_seconds': create - fake_heat.CONVERGE_SECONDS,
+        'create_api_calls': create_calls,
+        'unchanged_ready_seconds': unchanged,
+        'unchanged_api_calls': sum(fake_heat.calls.values()),
+        'keystone_logins': fake_keystone.logins,
+    }
+
+
+def bench_vagrant(workdir, scale, vms=4):
+    from ursula_cli import shell
+
+    environment = os.path.join(workdir, 'vagrant')
+    os.makedirs(environment)
+    with open(os.path.join(environment, 'vagrant.yml'), 'w') as f:
+        f.write("vms:\n")
+        for i in range(vms):
+            f.write("  vm%d: {}\n" % i)
+    boot, ssh_ready = 2 * scale, 3 * scale
+    state = os.path.join(workdir, 'vagrant-state')
+
+    results = {'vms': vms, 'boot_seconds': boot,
+               'ssh_ready_seconds': ssh_ready}
+    for label, concurrency, ideal in (
+            ('serial', 1, vms * boot + ssh_ready),
+            ('parallel', vms, boot + ssh_ready)):
+        shutil.rmtree(state, ignore_errors=True)
+        env = _fake_env(FAKE_VAGRANT_STATE=state,
+                        FAKE_VAGRANT_BOOT_SECONDS=boot,
+                        FAKE_VAGRANT_SSH_SECONDS=ssh_ready)
+        elapsed = _timed(shell._run_vagrant, environment,
+                         concurrency=concurrency, env=env)
+        results['%s_ready_seconds' % label] = elapsed
+        results['%s_overhead_seconds' % label] = elapsed - ideal
+    return results
+
+
+def _wait_for_servers(servers, hosts, probe):
+    # how long until every server answered, and how long after each came
+    # up it was noticed
+    from ursula_cli import ssh
+
+    noticed = {}
+
+    def timed_probe(host):
+        ok = probe(host)
+        if ok:
+            noticed.setdefault(host, time.time())
+        return ok
+
+    for server in servers:
+        server.start()
+    started = time.time()
+    with _quiet():
+        ssh.wait_for_ssh(hosts, timed_probe, concurrency=16, timeout=300)
+    elapsed = time.time() - started
+    lags = [noticed[host] - server.ready_at
+            for host, server in zip(hosts, servers)]
+    for server in servers:
+        server.close()
+    return elapsed, lags
+
+
+def bench_ssh(workdir, scale, hosts=20):
+    import paramiko
+    from fakes import sshd
+    from ursula_cli import ssh
+
+    host_key = paramiko.RSAKey.generate(1024)
+    key_file = os.path.join(workdir, 'id_rsa')
+    paramiko.RSAKey.generate(1024).write_private_key_file(key_file)
+    max_delay = 10 * scale
+
+    def delayed_servers():
+        return [sshd.DelayedSSHServer(host_key,
+                                      delay=max_delay * (i + 1) / hosts)
+                for i in range(hosts)]
+
+    def direct_probe(address):
+        host, port = address.split(':')
+        return ssh.probe_host(host, 'benchmark', key_file=key_file,
+                              port=int(port))
+
+    servers = delayed_servers()
+    direct, direct_lags = _wait_for_servers(
+        servers, ['127.0.0.1:%d' % s.port for s in servers], direct_probe)
+
+    # the same servers behind a bastion, reached over direct-tcpip
+    servers = delayed_servers()
+    names = ['server%02d' % i for i in range(hosts)]
+    bastion = sshd.DelayedSSHServer(host_key, routes=dict(
+        ((name, 22), ('127.0.0.1', server.port))
+        for name, server in zip(names, servers))).start()
+    probe = ssh.BastionProbe('127.0.0.1', 'benchmark', key_file=key_file,
+                             bastion_port=bastion.port)
+    try:
+        bastioned, bastion_lags = _wait_for_servers(servers, names, probe)
+    finally:
+        probe.close()
+        bastion.close()
+
+    return {
+        'hosts': hosts,
+        'last_server_up_seconds': max_delay,
+        'direct_ready_seconds': direct,
+        'direct_detect_p50_seconds': _percentile(direct_lags, 50),
+        'direct_detect_max_seconds': max(direct_lags),
+        'bastion_ready_seconds': bastioned,
+        'bastion_detect_p50_seconds': _percentile(bastion_lags, 50),
+        'bastion_detect_max_seconds': max(bastion_lags),
+    }
+
+
+def bench_output(workdir, scale, hosts=500):
+    from ursula_cli import profiler, shell
+
+    tasks = max(1, int(100 * scale))
+    env = _fake_env(FAKE_ANSIBLE_HOSTS=hosts, FAKE_ANSIBLE_TASKS=tasks)
+    command = [os.path.join(FAKE_BIN, 'ansible-playbook'), 'site.yml']
+
+    # what producing the output costs without ursula reading it
+    started = time.time()
+    output = subprocess.Popen(command, env=env,
+                              stdout=subprocess.PIPE).communicate()[0]
+    raw = time.time() - started
+
+    tracker = profiler.FailureTracker()
+    run_profiler = profiler.RunProfiler()
+    streamed = _timed(shell._run_ansible, 'hosts', 'site.yml',
+                      callbacks=[run_profiler.feed, tracker.feed], env=env)
+    lines = output.count('\n')
+    return {
+        'lines': lines,
+        'bytes': len(output),
+        'raw_seconds': raw,
+        'streamed_seconds': streamed,
+        'overhead_seconds': streamed - raw,
+        'lines_per_second': lines / streamed,
+        'mb_per_second': len(output) / streamed / 1e6,
+        'recap_hosts': len(tracker.hosts),
+    }
+
+
+def _commit():
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(
+                ['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO,
+                stderr=devnull).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='ursula provisioning benchmarks')
+    parser.add_argument('--scenario', default=','.join(SCENARIOS),
+                        help='comma separated scenarios to run, of %s'
+                             % ', '.join(SCENARIOS))
+    parser.add_argument('--quick', action='store_true',
+                        help='scale every simulated delay down 5x')
+    parser.add_argument('--record', default=None,
+                        help='also append the results to this file, one '
+                             'JSON document per line')
+    args = parser.parse_args()
+
+    scenarios = [s for s in args.scenario.split(',') if s]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error("unknown scenario: %s" % ", ".join(sorted(unknown)))
+    logging.basicConfig(level=logging.WARNING)
+    # the probes drop connections mid handshake on purpose
+    logging.getLogger('paramiko').setLevel(logging.CRITICAL)
+    scale = 0.2 if args.quick else 1.0
+
+    workdir = tempfile.mkdtemp(prefix='ursula-bench-')
+    # keystone sessions, known hosts and the like stay in the sandbox
+    os.environ['HOME'] = workdir
+    os.environ.pop('SSH_AUTH_SOCK', None)
+    results = {}
+    try:
+        for name in scenarios:
+            results[name] = globals()['bench_%s' % name](workdir, scale)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = json.dumps({'benchmark': 'provisioning', 'commit': _commit(),
+                         'quick': args.quick, 'time': int(time.time()),
+                         'results': results}, sort_keys=True)
+    print(report)
+    if args.record:
+        with open(args.record, 'a') as f:
+            f.write(report + "\n")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2015, Craig Tracey <craigtracey@gmail.com>
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+
+# Measures how long it takes ursula to start and exits non-zero if startup
+# regresses, either because a heavy dependency is imported at module load
+# again or because the median startup time exceeds the budget.
+#
+#   python benchmarks/startup.py [--runs 20] [--max-seconds 0.25]
+
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+
+# only the provisioner paths that need these should ever import them
+LAZY_MODULES = ('ansible', 'paramiko', 'yaml', 'heatclient',
+                'keystoneclient', 'multiprocessing')
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+COMMANDS = {
+    'import': [sys.executable, '-c', 'import ursula_cli.shell'],
+    'help': [sys.executable, '-m', 'ursula_cli.shell', '--help'],
+}
+
+
+def _env():
+    env = os.environ.copy()
+    env['PYTHONPATH'] = os.pathsep.join(
+        p for p in (REPO, env.get('PYTHONPATH')) if p)
+    return env
+
+
+def eagerly_imported():
+    code = ("import sys, ursula_cli.shell; "
+            "print(' '.join(m for m in %r if m in sys.modules))"
+            % (LAZY_MODULES,))
+    output = subprocess.check_output([sys.executable, '-c', code],
+                                     env=_env())
+    return output.split()
+
+
+def median_runtime(command, runs):
+    timings = []
+    with open(os.devnull, 'w') as devnull:
+        for _ in range(runs):
+            start = time.time()
+            subprocess.check_call(command, env=_env(), stdout=devnull)
+            timings.append(time.time() - start)
+    timings.sort()
+    return timings[len(timings) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='ursula startup benchmark')
+    parser.add_argument('--runs', type=int, default=20)
+    parser.add_argument('--max-seconds', type=float, default=0.25,
+                        help='fail if the median startup time exceeds this')
+    args = parser.parse_args()
+
+    failures = []
+    imported = eagerly_imported()
+    if imported:
+        failures.append("imported at startup: %s" % ", ".join(imported))
+
+    results = {}
+    for name, command in sorted(COMMANDS.items()):
+        results[name] = median_runtime(command, args.runs)
+        if results[name] > args.max_seconds:
+            failures.append("%s took %.3fs (budget %.3fs)"
+                            % (name, results[name], args.max_seconds))
+
+    print(json.dumps({'benchmark': 'startup', 'median_seconds': results,
+                      'eager_imports': imported}, sort_keys=True))
+    for failure in failures:
+        sys.stderr.write("REGRESSION: %s\n" % failure)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,123 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2015, Craig Tracey <craigtracey@gmail.com>
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+
+import sys
+import json
+import logging
+
+LOG = logging.getLogger(__name__)
+
+STATUS_LABELS = {
+    'ok': 'SUCCESS',
+    'changed': 'CHANGED',
+    'failed': 'FAILED',
+    'unreachable': 'UNREACHABLE',
+    'skipped': 'SKIPPED',
+}
+
+
+def available():
+    # the in-process engine needs the ansible 2 python API
+    try:
+        from ansible.cli.adhoc import AdHocCLI  # noqa
+        from ansible.plugins.callback import CallbackBase  # noqa
+    except ImportError:
+        return False
+    return True
+
+
+def _host_result(host, status, result):
+    result = dict((key, value) for key, value in result.iteritems()
+                  if not key.startswith('_ansible'))
+    return {
+        'host': host,
+        'status': status,
+        'rc': result.get('rc'),
+        'stdout': result.get('stdout'),
+        'stderr': result.get('stderr'),
+        'msg': result.get('msg'),
+        'result': result,
+    }
+
+
+def format_result(result):
+    # the same layout as ansible's minimal callback, so what is printed
+    # (and parsed by the profiler) doesn't change with the engine
+    label = STATUS_LABELS[result['status']]
+    if result['rc'] is not None and result['stdout'] is not None:
+        text = "%s | %s | rc=%s >>\n%s\n" % (result['host'], label,
+                                             result['rc'], result['stdout'])
+        if result['stderr']:
+            text += "%s\n" % result['stderr']
+        return text
+    return "%s | %s! => %s\n" % (result['host'], label,
+                                 json.dumps(result['result'], indent=4,
+                                            sort_keys=True))
+
+
+def _callback(on_result):
+    from ansible.plugins.callback import CallbackBase
+
+    class ResultCallback(CallbackBase):
+        CALLBACK_VERSION = 2.0
+        CALLBACK_TYPE = 'stdout'
+        CALLBACK_NAME = 'ursula_adhoc'
+
+        def __init__(self):
+            super(ResultCallback, self).__init__()
+            self.results = []
+
+        def _record(self, result, status):
+            host_result = _host_result(result._host.get_name(), status,
+                                       result._result)
+            self.results.append(host_result)
+            if on_result is not None:
+                on_result(host_result)
+
+        def v2_runner_on_ok(self, result):
+            changed = result._result.get('changed', False)
+            self._record(result, 'changed' if changed else 'ok')
+
+        def v2_runner_on_failed(self, result, ignore_errors=False):
+            self._record(result, 'failed')
+
+        def v2_runner_on_unreachable(self, result):
+            self._record(result, 'unreachable')
+
+        def v2_runner_on_skipped(self, result):
+            self._record(result, 'skipped')
+
+    return ResultCallback()
+
+
+def run(command, on_result=None):
+    # Runs an `ansible` command line in this process. on_result is called
+    # with each host's result as it arrives; all of them are returned
+    # with ansible's exit status.
+    from ansible.cli.adhoc import AdHocCLI
+
+    # ansible's configuration is read from the environment when it is first
+    # imported, which for a daemon worker was before this run's environment
+    # was set up
+    constants = sys.modules.get('ansible.constants')
+    if constants is not None:
+        reload(constants)
+
+    callback = _callback(on_result)
+    cli = AdHocCLI(list(command), callback=callback)
+    cli.parse()
+    rc = cli.run()
+    return rc, callback.results
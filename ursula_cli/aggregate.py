@@ -0,0 +1,203 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2015, Craig Tracey <craigtracey@gmail.com>
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+
+import re
+import sys
+import json
+import time
+import hashlib
+from collections import OrderedDict
+
+from ursula_cli.adhoc import STATUS_LABELS
+from ursula_cli.profiler import strip_ansi
+
+PROGRESS_INTERVAL = 5
+
+RESULT_HEADER = re.compile(
+    r'^(\S+) \| (SUCCESS|CHANGED|FAILED|UNREACHABLE|SKIPPED)!?'
+    r'(?: \| rc=(-?\d+))? (?:=>|>>)\s?(.*)$')
+HOST_NUMBER = re.compile(r'^(.*?)(\d+)(\D*)$')
+# what differs between otherwise identical outputs of different hosts
+NORMALIZERS = [
+    (re.compile(r'\b[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-'
+                r'[0-9a-f]{12}\b', re.IGNORECASE), '<uuid>'),
+    (re.compile(r'\b\d{1,3}(?:\.\d{1,3}){3}\b'), '<ip>'),
+    (re.compile(r'\d+(?:\.\d+)?'), '<n>'),
+    (re.compile(r'[ \t]+'), ' '),
+]
+
+
+def normalize(text, host):
+    text = text.replace(host, '<host>')
+    short = host.split('.')[0]
+    if short != host:
+        text = text.replace(short, '<host>')
+    for pattern, replacement in NORMALIZERS:
+        text = pattern.sub(replacement, text)
+    return text.strip()
+
+
+def _result_text(result):
+    if result['rc'] is not None and result['stdout'] is not None:
+        text = result['stdout']
+        if result['stderr']:
+            text += "\n" + result['stderr']
+        return text
+    return json.dumps(result['result'], indent=4, sort_keys=True)
+
+
+def compact_hosts(hosts):
+    # comp01, comp02, comp03, comp07 -> comp[01:03], comp07
+    ranges = {}
+    names = []
+    for host in hosts:
+        match = HOST_NUMBER.match(host)
+        if not match:
+            names.append(host)
+            continue
+        prefix, number, suffix = match.groups()
+        ranges.setdefault((prefix, suffix, len(number)), []).append(
+            int(number))
+
+    for (prefix, suffix, width), numbers in ranges.iteritems():
+        numbers.sort()
+        start = previous = numbers[0]
+        for number in numbers[1:] + [None]:
+            if number == previous + 1:
+                previous = number
+                continue
+            if start == previous:
+                names.append("%s%0*d%s" % (prefix, width, start, suffix))
+            else:
+                names.append("%s[%0*d:%0*d]%s" % (prefix, width, start,
+                                                  width, previous, suffix))
+            start = previous = number
+    return sorted(names)
+
+
+class Aggregator(object):
+    # Groups hosts by a hash of their status, rc and output (normalized if
+    # asked to), keeping a single copy of each distinct output, and keeps
+    # a running count of the groups while results come in.
+
+    def __init__(self, normalized=False, prefix=None, out=None):
+        self.normalized = normalized
+        self.prefix = prefix or ""
+        self.out = out or sys.stdout
+        self.groups = OrderedDict()
+        self.total = 0
+        self._last_report = 0
+
+    def add(self, host, status, rc, text):
+        basis = normalize(text, host) if self.normalized else text
+        digest = hashlib.sha1()
+        for part in (status, rc, basis):
+            if isinstance(part, unicode):
+                part = part.encode('utf-8')
+            digest.update("%s\0" % (part,))
+        key = digest.hexdigest()
+        group = self.groups.get(key)
+        if group is None:
+            group = self.groups[key] = {
+                'status': status,
+                'rc': rc,
+                'output': text,
+                'hosts': [],
+            }
+        group['hosts'].append(host)
+        self.total += 1
+        self._report()
+
+    def add_result(self, result):
+        self.add(result['host'], result['status'], result['rc'],
+                 _result_text(result))
+
+    def _report(self, final=False):
+        now = time.time()
+        tty = self.out.isatty()
+        if not final and not tty and now - self._last_report < \
+                PROGRESS_INTERVAL:
+            return
+        self._last_report = now
+        counts = sorted((len(g['hosts']) for g in self.groups.itervalues()),
+                        reverse=True)
+        shown = ", ".join(str(c) for c in counts[:8])
+        if len(counts) > 8:
+            shown += ", ..."
+        msg = "%s%d hosts, %d distinct results (%s)" % (
+            self.prefix, self.total, len(counts), shown)
+        if tty:
+            self.out.write("\r%s%s" % (msg, "\n" if final else ""))
+        else:
+            self.out.write("%s\n" % msg)
+        self.out.flush()
+
+    def finish(self):
+        if self.total:
+            self._report(final=True)
+
+    def summary(self):
+        blocks = []
+        for group in sorted(self.groups.itervalues(),
+                            key=lambda g: -len(g['hosts'])):
+            rc = "" if group['rc'] is None else " | rc=%s" % group['rc']
+            blocks.append("==== %d hosts | %s%s: %s\n%s\n" % (
+                len(group['hosts']), STATUS_LABELS[group['status']], rc,
+                ", ".join(compact_hosts(group['hosts'])), group['output']))
+        return "".join(blocks)
+
+    def as_json(self):
+        return json.dumps([{
+            'status': group['status'],
+            'rc': group['rc'],
+            'output': group['output'],
+            'hosts': group['hosts'],
+        } for group in sorted(self.groups.itervalues(),
+                              key=lambda g: -len(g['hosts']))],
+            indent=2, sort_keys=True)
+
+
+class TextResults(object):
+    # Turns the text ansible prints for an adhoc run back into per-host
+    # results, for runs that can't use the in-process engine.
+
+    STATUSES = dict((label, status)
+                    for status, label in STATUS_LABELS.iteritems())
+
+    def __init__(self, aggregator):
+        self.aggregator = aggregator
+        self._current = None
+
+    def _flush(self):
+        if self._current is not None:
+            host, status, rc, lines = self._current
+            self.aggregator.add(host, status, rc, "\n".join(lines).rstrip())
+            self._current = None
+
+    def feed(self, line):
+        line = strip_ansi(line)
+        match = RESULT_HEADER.match(line)
+        if match:
+            self._flush()
+            host, label, rc, rest = match.groups()
+            self._current = (host, self.STATUSES[label],
+                             int(rc) if rc is not None else None,
+                             [rest] if rest else [])
+        elif self._current is not None:
+            self._current[3].append(line)
+
+    def finish(self):
+        self._flush()
@@ -0,0 +1,375 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2015, Craig Tracey <craigtracey@gmail.com>
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+
+import os
+import sys
+import json
+import time
+import errno
+import select
+import signal
+import socket
+import struct
+import logging
+import traceback
+
+LOG = logging.getLogger(__name__)
+
+SOCKET_PATH = os.path.join('~', '.ursula', 'daemon.sock')
+# set in the environment to always run in the invoking process
+DISABLE_ENVVAR = 'URSULA_NO_DAEMON'
+# imported once by the daemon so requests don't pay for them
+PRELOAD_MODULES = (
+    'yaml',
+    'paramiko',
+    'ansible.cli.adhoc',
+    'ansible.plugins.callback',
+    'heatclient.client',
+    'keystoneclient.v3',
+)
+WARM_IDLE_TIMEOUT = 3600
+CHUNK_SIZE = 64 * 1024
+# how long an interrupted run gets to clean up before it is terminated
+INTERRUPT_GRACE = 5
+
+# every message is a one byte type and a payload length, then the payload
+FRAME_HEADER = struct.Struct('!cI')
+REQUEST = 'r'
+OUTPUT = 'o'
+EXIT = 'x'
+SO_PEERCRED = getattr(socket, 'SO_PEERCRED', 17)
+PEERCRED = struct.Struct('3i')
+
+
+def socket_path(path=None):
+    return os.path.expanduser(path or SOCKET_PATH)
+
+
+def _send_frame(sock, kind, payload):
+    sock.sendall(FRAME_HEADER.pack(kind, len(payload)) + payload)
+
+
+def _recv_exact(sock, size):
+    data = ''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+
+def _recv_frame(sock):
+    header = _recv_exact(sock, FRAME_HEADER.size)
+    if header is None:
+        return None, None
+    kind, size = FRAME_HEADER.unpack(header)
+    payload = _recv_exact(sock, size)
+    if payload is None:
+        return None, None
+    return kind, payload
+
+
+def _connect(path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except socket.error as e:
+        sock.close()
+        if e.errno in (errno.ENOENT, errno.ECONNREFUSED):
+            return None
+        raise
+    return sock
+
+
+def forward(argv, path=None):
+    # Runs `ursula <argv>` in the daemon, streaming its output here, and
+    # returns its exit status, or None when no daemon is running.
+    if os.environ.get(DISABLE_ENVVAR):
+        return None
+    sock = _connect(socket_path(path))
+    if sock is None:
+        return None
+    try:
+        _send_frame(sock, REQUEST, json.dumps({
+            'argv': list(argv),
+            'cwd': os.getcwd(),
+            'env': dict(os.environ),
+        }))
+        while True:
+            kind, payload = _recv_frame(sock)
+            if kind is None:
+                raise Exception("The ursula daemon closed the connection")
+            if kind == OUTPUT:
+                sys.stdout.write(payload)
+                sys.stdout.flush()
+            elif kind == EXIT:
+                return int(payload)
+    finally:
+        sock.close()
+
+
+def preload():
+    for name in PRELOAD_MODULES:
+        try:
+            __import__(name)
+        except ImportError:
+            LOG.debug("Not preloading %s, it is not installed", name)
+
+
+def _exit_status(code):
+    if code is None:
+        return 0
+    if isinstance(code, (int, long)):
+        return code & 0xff
+    sys.stderr.write("%s\n" % code)
+    return 1
+
+
+def _reset_signals():
+    # forked workers get the default handling back, even if the daemon was
+    # started with SIGINT ignored
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+
+def _terminate(signum, frame):
+    raise SystemExit(0)
+
+
+def _signal_group(pgid, signum):
+    try:
+        os.killpg(pgid, signum)
+    except OSError as e:
+        if e.errno != errno.ESRCH:
+            raise
+
+
+def _interrupt(pid):
+    # ^C for the run's whole process group, as a terminal would send it,
+    # then SIGTERM for whatever is still around after the grace period
+    _signal_group(pid, signal.SIGINT)
+    deadline = time.time() + INTERRUPT_GRACE
+    while time.time() < deadline:
+        if os.waitpid(pid, os.WNOHANG)[0]:
+            break
+        time.sleep(0.1)
+    else:
+        _signal_group(pid, signal.SIGTERM)
+        os.waitpid(pid, 0)
+    # ansible's workers ignore SIGINT and may outlive it
+    _signal_group(pid, signal.SIGTERM)
+
+
+def _run_request(run, request, stdout_fd):
+    # in a freshly forked process: become the invoking CLI, then run
+    status = 255
+    try:
+        _reset_signals()
+        os.setpgid(0, 0)
+        devnull = os.open(os.devnull, os.O_RDONLY)
+        os.dup2(devnull, 0)
+        os.dup2(stdout_fd, 1)
+        os.dup2(stdout_fd, 2)
+        os.chdir(request['cwd'])
+        os.environ.clear()
+        os.environ.update(request['env'])
+        os.environ[DISABLE_ENVVAR] = '1'
+        status = _exit_status(run(request['argv']))
+    except SystemExit as e:
+        status = _exit_status(e.code)
+    except BaseException:
+        traceback.print_exc()
+    finally:
+        try:
+            # os._exit skips the atexit hook that writes out queued log
+            # records
+            logging.shutdown()
+            sys.stdout.flush()
+            sys.stderr.flush()
+        finally:
+            os._exit(status)
+
+
+def _wait_status(pid):
+    _, status = os.waitpid(pid, 0)
+    if os.WIFSIGNALED(status):
+        return 128 + os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def _relay(conn, run, request):
+    # Forks the process that runs the request and copies everything it
+    # (and anything it starts) writes to the client as output frames. If
+    # the client goes away (^C), the run is interrupted.
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        conn.close()
+        os.close(read_fd)
+        _run_request(run, request, write_fd)
+    os.close(write_fd)
+
+    client_gone = False
+    try:
+        while True:
+            ready, _, _ = select.select([read_fd, conn], [], [])
+            if conn in ready and not conn.recv(1):
+                client_gone = True
+                break
+            if read_fd in ready:
+                data = os.read(read_fd, CHUNK_SIZE)
+                if not data:
+                    break
+                _send_frame(conn, OUTPUT, data)
+    except socket.error:
+        client_gone = True
+    finally:
+        os.close(read_fd)
+
+    if client_gone:
+        LOG.debug("Client went away, interrupting pid %d", pid)
+        _interrupt(pid)
+        return
+    _send_frame(conn, EXIT, str(_wait_status(pid)))
+
+
+def _peer_uid(conn):
+    return PEERCRED.unpack(conn.getsockopt(socket.SOL_SOCKET, SO_PEERCRED,
+                                           PEERCRED.size))[1]
+
+
+def _reap():
+    while True:
+        try:
+            pid, _ = os.waitpid(-1, os.WNOHANG)
+        except OSError as e:
+            if e.errno == errno.ECHILD:
+                return
+            raise
+        if not pid:
+            return
+
+
+def _fork(func, *args):
+    sys.stdout.flush()
+    sys.stderr.flush()
+    pid = os.fork()
+    if pid == 0:
+        _reset_signals()
+        try:
+            func(*args)
+        except BaseException:
+            traceback.print_exc()
+            os._exit(1)
+        os._exit(0)
+    return pid
+
+
+def _listen(path):
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory, 0700)
+    if os.path.exists(path):
+        other = _connect(path)
+        if other is not None:
+            other.close()
+            raise Exception("An ursula daemon is already listening on %s"
+                            % path)
+        os.unlink(path)
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    old_umask = os.umask(0077)
+    try:
+        sock.bind(path)
+    finally:
+        os.umask(old_umask)
+    sock.listen(16)
+    return sock
+
+
+def _warm(run, request, argv):
+    with open(os.devnull, 'w') as devnull:
+        _run_request(run, dict(request, argv=argv), devnull.fileno())
+
+
+def serve(run, warm_args=None, warm_interval=None, path=None,
+          idle_timeout=WARM_IDLE_TIMEOUT):
+    # Accepts requests from the CLI on a unix socket and runs each in a
+    # process forked from this one, so everything imported and set up here
+    # is already in place. run(argv) does what `ursula <argv>` does.
+    #
+    # warm_args(argv), if given, returns the `ursula warm` arguments for a
+    # request; the daemon then re-opens the control masters of environments
+    # it served in the last idle_timeout seconds every warm_interval.
+    path = socket_path(path)
+    sock = _listen(path)
+    signal.signal(signal.SIGTERM, _terminate)
+    uid = os.getuid()
+    warm_jobs = {}
+    LOG.info("ursula daemon listening on %s (pid %d)", path, os.getpid())
+
+    try:
+        while True:
+            _reap()
+            now = time.time()
+            for key, job in warm_jobs.items():
+                if now - job['last_used'] > idle_timeout:
+                    del warm_jobs[key]
+                elif now >= job['next_due']:
+                    job['next_due'] = now + warm_interval
+                    _fork(_warm, run, job['request'], job['argv'])
+
+            timeout = 60
+            if warm_jobs:
+                timeout = max(0, min(j['next_due']
+                                     for j in warm_jobs.itervalues()) - now)
+            try:
+                ready, _, _ = select.select([sock], [], [], timeout)
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            if not ready:
+                continue
+
+            conn, _ = sock.accept()
+            try:
+                if _peer_uid(conn) != uid:
+                    LOG.warn("Rejected a connection from uid %d",
+                             _peer_uid(conn))
+                    continue
+                kind, payload = _recv_frame(conn)
+                if kind != REQUEST:
+                    continue
+                request = json.loads(payload)
+                LOG.debug("Running %s in %s", " ".join(request['argv']),
+                          request['cwd'])
+                _fork(_relay, conn, run, request)
+
+                argv = warm_args(request['argv']) if warm_args else None
+                if argv and warm_interval:
+                    key = (request['cwd'], tuple(argv))
+                    job = warm_jobs.setdefault(key, {
+                        'next_due': time.time() + warm_interval,
+                    })
+                    job.update(request=request, argv=argv,
+                               last_used=time.time())
+            finally:
+                conn.close()
+    finally:
+        sock.close()
+        os.unlink(path)
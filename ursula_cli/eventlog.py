@@ -0,0 +1,233 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2015, Craig Tracey <craigtracey@gmail.com>
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+
+import os
+import re
+import json
+import time
+import Queue
+import logging
+import threading
+
+from ursula_cli.profiler import strip_ansi
+
+MAX_BYTES = 10 * 1024 * 1024
+BACKUP_COUNT = 5
+# records waiting to be written; beyond this they are dropped rather than
+# holding up the run, except for command output, which waits its turn
+QUEUE_SIZE = 10000
+# how long exiting waits for queued records to reach the file
+FLUSH_TIMEOUT = 5
+OUTPUT_LOGGER = 'ursula_cli.output'
+REDACTED = '<redacted>'
+
+# a whole word of a name: OS_PASSWORD, ansible_ssh_pass, but not bypass,
+# passed or tokens_used
+_SECRET_WORD = (r'(?<![a-z0-9])(?:pass(?:wd|word)?|secret|token|credential%s)'
+                r'(?![a-z0-9])')
+SECRET_NAME = re.compile(_SECRET_WORD % '|private', re.IGNORECASE)
+SECRET_VALUES = [
+    (re.compile(r'-----BEGIN [A-Z ]*PRIVATE KEY-----.*?'
+                r'-----END [A-Z ]*PRIVATE KEY-----', re.DOTALL),
+     REDACTED),
+    # NAME=value, NAME: value, 'NAME': 'value'
+    (re.compile(r'((?<![\w.-])[\w.-]*?' + _SECRET_WORD % '' +
+                r"""[\w.-]*['"]?\s*[=:]\s*)"""
+                r"""(?:u?"[^"]*"|u?'[^']*'|[^\s'",;}]+)""", re.IGNORECASE),
+     r'\1' + REDACTED),
+    # --os-password value, but not --ask-pass --other-flag
+    (re.compile(r'(--[\w-]*?' + _SECRET_WORD % '' + r'[\w-]*\s+)(?!-)\S+',
+                re.IGNORECASE),
+     r'\1' + REDACTED),
+]
+# an argv item whose value is the next item
+SECRET_FLAG = re.compile(r'--[\w-]*?' + _SECRET_WORD % '' + r'[\w-]*$',
+                         re.IGNORECASE)
+
+
+def redact(text):
+    for pattern, replacement in SECRET_VALUES:
+        text = pattern.sub(replacement, text)
+    return text
+
+
+def redact_env(env):
+    return dict((key, REDACTED if SECRET_NAME.search(key) else value)
+                for key, value in env.iteritems())
+
+
+def redact_fields(value):
+    # every string in an event's fields; in a list (argv) also the value
+    # after a secret flag, and in a dict anything under a secret name
+    if isinstance(value, basestring):
+        return redact(value)
+    if isinstance(value, dict):
+        return dict((key, REDACTED if isinstance(key, basestring) and
+                     SECRET_NAME.search(key) else redact_fields(item))
+                    for key, item in value.iteritems())
+    if isinstance(value, (list, tuple)):
+        redacted = []
+        for i, item in enumerate(value):
+            previous = value[i - 1] if i else None
+            if (isinstance(previous, basestring) and
+                    SECRET_FLAG.match(previous) and
+                    isinstance(item, basestring) and
+                    not item.startswith('-')):
+                redacted.append(REDACTED)
+            else:
+                redacted.append(redact_fields(item))
+        return redacted
+    return value
+
+
+def changed_env(env, inherited):
+    # what was set or changed in env since it was inherited, secrets
+    # redacted
+    return redact_env(dict((key, value) for key, value in env.iteritems()
+                           if inherited.get(key) != value))
+
+
+def event(name, **fields):
+    # extra= for a log call, adding the event name and fields to its JSON
+    return {'event': name, 'fields': fields}
+
+
+class RedactingFormatter(logging.Formatter):
+
+    def format(self, record):
+        return redact(super(RedactingFormatter, self).format(record))
+
+
+class JSONFormatter(logging.Formatter):
+    # one JSON object per line
+
+    def format(self, record):
+        data = {
+            'time': "%s.%03dZ" % (
+                time.strftime('%Y-%m-%dT%H:%M:%S',
+                              time.gmtime(record.created)),
+                record.msecs),
+            'level': record.levelname,
+            'logger': record.name,
+            'pid': record.process,
+            'message': redact(record.getMessage()),
+        }
+        name = getattr(record, 'event', None)
+        if name:
+            data['event'] = name
+            data.update(redact_fields(getattr(record, 'fields', None) or {}))
+        if record.exc_info:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            data['exception'] = redact(record.exc_text)
+        return json.dumps(data, sort_keys=True, default=str)
+
+
+class QueueHandler(logging.Handler):
+    # Hands records to a thread that passes them on to target, so logging
+    # never waits on the disk. A process forked from this one (a daemon
+    # worker) starts its own thread on its first record.
+
+    def __init__(self, target):
+        logging.Handler.__init__(self)
+        self.target = target
+        self.dropped = 0
+        self._pid = None
+        self._queue = None
+        self._thread = None
+
+    def _start(self):
+        self._pid = os.getpid()
+        self._queue = Queue.Queue(QUEUE_SIZE)
+        self._thread = threading.Thread(target=self._drain,
+                                        args=(self._queue,))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _drain(self, queue):
+        while True:
+            record = queue.get()
+            if record is None:
+                return
+            self.target.handle(record)
+
+    def prepare(self, record):
+        # the arguments are rendered here, they may change before the record
+        # is written
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(
+                record.exc_info)
+            record.exc_info = None
+        return record
+
+    def emit(self, record):
+        try:
+            if self._pid != os.getpid():
+                self._start()
+            # the output log is a copy of everything the run printed
+            block = getattr(record, 'event', None) == 'output'
+            self._queue.put(self.prepare(record), block)
+        except Queue.Full:
+            self.dropped += 1
+        except Exception:
+            self.handleError(record)
+
+    def close(self):
+        if self._pid == os.getpid() and self._thread.is_alive():
+            try:
+                self._queue.put(None, timeout=FLUSH_TIMEOUT)
+            except Queue.Full:
+                pass
+            self._thread.join(FLUSH_TIMEOUT)
+            if self.dropped and not self._thread.is_alive():
+                self.target.handle(logging.makeLogRecord(dict(
+                    event('log_dropped', dropped=self.dropped),
+                    name=__name__, levelno=logging.WARNING,
+                    levelname='WARNING', process=os.getpid(),
+                    msg="Dropped %d log records, the event log could not "
+                        "keep up" % self.dropped)))
+        self._pid = None
+        self.target.close()
+        logging.Handler.close(self)
+
+
+def file_handler(path, max_bytes=MAX_BYTES, backup_count=BACKUP_COUNT):
+    # JSON events, rotated by size, written from a background thread
+    from logging.handlers import RotatingFileHandler
+
+    target = RotatingFileHandler(path, maxBytes=max_bytes,
+                                 backupCount=backup_count)
+    target.setFormatter(JSONFormatter())
+    return QueueHandler(target)
+
+
+class OutputLog(object):
+    # A copy of command output as `output` events in the event log, written
+    # by the same queue, with the same write()/close() as output.RunLog.
+
+    def __init__(self, strip_color=True):
+        self.strip_color = strip_color
+        self.logger = logging.getLogger(OUTPUT_LOGGER)
+
+    def write(self, data):
+        if self.strip_color:
+            data = strip_ansi(data)
+        self.logger.info("%s", data.rstrip('\n'), extra=event('output'))
+
+    def close(self):
+        pass
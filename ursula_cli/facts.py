@@ -0,0 +1,94 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2015, Craig Tracey <craigtracey@gmail.com>
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+
+import os
+import time
+import errno
+
+from ursula_cli import fingerprint
+from ursula_cli.aggregate import Aggregator
+
+FACT_CACHE_DIR = '.ursula_facts'
+# caching is opt-in, facts are gathered every run unless a TTL is given
+DEFAULT_TTL = 0
+# `ursula facts` fills the cache, so it has to have one
+GATHER_TTL = 3600
+DEFAULT_FORKS = 50
+
+
+def cache_dir(environment):
+    return os.path.abspath(os.path.join(environment, FACT_CACHE_DIR))
+
+
+def _gathers_facts(play):
+    value = play.get('gather_facts', True)
+    if isinstance(value, basestring):
+        return value.strip().lower() not in ('false', 'no', 'off', '0')
+    return bool(value)
+
+
+def gathering_hosts(playbook, index, subset=None):
+    # the hosts of every play that gathers facts, in inventory order
+    hosts = set()
+    for play, _ in fingerprint.load_plays(playbook)[0]:
+        if _gathers_facts(play):
+            hosts.update(fingerprint.play_hosts(play, index, subset))
+    return [host for host in index.hosts if host in hosts]
+
+
+def cache_status(directory, hosts, ttl):
+    # ansible's jsonfile cache keeps one file per host and treats it as
+    # expired once it is older than the timeout
+    hits, misses = [], []
+    now = time.time()
+    for host in hosts:
+        try:
+            fresh = now - os.stat(os.path.join(directory, host)).st_mtime \
+                <= ttl
+        except OSError:
+            fresh = False
+        (hits if fresh else misses).append(host)
+    return hits, misses
+
+
+def clear(directory, hosts=None):
+    # drops the cached facts of hosts, or of every host, returning the
+    # hosts that had some
+    if hosts is None:
+        try:
+            hosts = os.listdir(directory)
+        except OSError:
+            return []
+    cleared = []
+    for host in hosts:
+        try:
+            os.unlink(os.path.join(directory, host))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        else:
+            cleared.append(host)
+    return cleared
+
+
+class GatherResults(Aggregator):
+    # setup's output is different on every host; only failures are worth
+    # showing, so successful hosts are grouped by status alone
+
+    def add(self, host, status, rc, text):
+        if status in ('ok', 'changed'):
+            text = ""
+        super(GatherResults, self).add(host, status, rc, text)
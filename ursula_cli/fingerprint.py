@@ -0,0 +1,296 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2015, Craig Tracey <craigtracey@gmail.com>
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+
+import os
+import json
+import hashlib
+import logging
+
+from ursula_cli import utils
+
+LOG = logging.getLogger(__name__)
+
+FINGERPRINT_FILE = '.ursula_fingerprints.json'
+TASK_LISTS = ('pre_tasks', 'tasks', 'post_tasks', 'handlers')
+INCLUDE_KEYS = ('include', 'include_tasks', 'import_tasks')
+PLAYBOOK_INCLUDE_KEYS = ('include', 'import_playbook')
+EXTRA_VARS_FLAGS = ('-e', '--extra-vars')
+
+
+def hash_file(digest, path):
+    digest.update(path)
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(64 * 1024)
+            if not chunk:
+                break
+            digest.update(chunk)
+
+
+def hash_tree(digest, path):
+    if os.path.isfile(path):
+        hash_file(digest, path)
+        return
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            hash_file(digest, os.path.join(root, name))
+
+
+def _load_yaml(path):
+    import yaml
+
+    with open(path) as f:
+        return yaml.safe_load(f) or []
+
+
+def _include_path(value, base):
+    # "include: foo.yml some=var" -> base/foo.yml, unless it is templated
+    if not isinstance(value, basestring) or '{{' in value:
+        return None
+    path = os.path.join(base, value.split()[0])
+    return path if os.path.isfile(path) else None
+
+
+def load_plays(playbook, seen=None):
+    # (play, directory it is relative to) for every play, following
+    # playbook level includes; also returns every file that was read
+    if seen is None:
+        seen = set()
+    playbook = os.path.abspath(playbook)
+    seen.add(playbook)
+    base = os.path.dirname(playbook)
+    plays, files = [], [playbook]
+    for entry in _load_yaml(playbook):
+        if not isinstance(entry, dict):
+            continue
+        included = None
+        for key in PLAYBOOK_INCLUDE_KEYS:
+            if key in entry and 'hosts' not in entry:
+                included = _include_path(entry[key], base)
+        if included:
+            if included not in seen:
+                more_plays, more_files = load_plays(included, seen)
+                plays.extend(more_plays)
+                files.extend(more_files)
+        else:
+            plays.append((entry, base))
+    return plays, files
+
+
+def task_includes(tasks, base, seen):
+    # task files pulled in by the play itself (roles are hashed whole)
+    for task in tasks or []:
+        if not isinstance(task, dict):
+            continue
+        for key in ('block', 'rescue', 'always'):
+            for path in task_includes(task.get(key), base, seen):
+                yield path
+        for key in INCLUDE_KEYS:
+            path = _include_path(task.get(key), base)
+            if path and path not in seen:
+                seen.add(path)
+                yield path
+                for nested in task_includes(_load_yaml(path),
+                                            os.path.dirname(path), seen):
+                    yield nested
+
+
+def vars_files(play, base):
+    # the files a play's vars_files name; of a list of alternatives, every
+    # one that exists
+    for entry in play.get('vars_files') or []:
+        if not isinstance(entry, list):
+            entry = [entry]
+        for value in entry:
+            path = _include_path(value, base)
+            if path:
+                yield path
+
+
+def extra_vars_files(args):
+    # the files given as --extra-vars @file on an ansible command line
+    for i, arg in enumerate(args):
+        value = None
+        if arg in EXTRA_VARS_FLAGS and i + 1 < len(args):
+            value = args[i + 1]
+        elif arg.startswith('--extra-vars='):
+            value = arg[len('--extra-vars='):]
+        elif arg.startswith('-e') and not arg.startswith('--'):
+            value = arg[2:]
+        if value and value.startswith('@') and os.path.isfile(value[1:]):
+            yield os.path.abspath(value[1:])
+
+
+def role_name(role):
+    if isinstance(role, dict):
+        return role.get('role') or role.get('name')
+    return role
+
+
+def find_role(name, base, roles_path):
+    for directory in [os.path.join(base, 'roles')] + list(roles_path):
+        path = os.path.join(os.path.expanduser(directory), name)
+        if os.path.isdir(path):
+            return path
+    if os.path.isdir(os.path.join(base, name)):
+        return os.path.join(base, name)
+    return None
+
+
+def role_meta(path):
+    for name in ('main.yml', 'main.yaml', 'main'):
+        meta = os.path.join(path, 'meta', name)
+        if os.path.isfile(meta):
+            return meta
+    return None
+
+
+def role_dependencies(path):
+    meta = role_meta(path)
+    if meta is not None:
+        data = _load_yaml(meta)
+        if isinstance(data, dict):
+            return [role_name(r) for r in data.get('dependencies') or []
+                    if role_name(r)]
+    return []
+
+
+class _Hasher(object):
+    # role trees are hashed once however many plays and hosts use them
+
+    def __init__(self, roles_path):
+        self.roles_path = roles_path
+        self.roles = {}
+
+    def role(self, name, base, stack=()):
+        key = (name, base)
+        if key in self.roles:
+            return self.roles[key]
+        digest = hashlib.sha256()
+        digest.update(name)
+        path = find_role(name, base, self.roles_path)
+        if path is None:
+            LOG.debug("Role %s not found, fingerprinting its name only",
+                      name)
+        else:
+            hash_tree(digest, path)
+            for dependency in role_dependencies(path):
+                if dependency not in stack:
+                    digest.update(self.role(dependency, base,
+                                            stack + (name,)))
+        self.roles[key] = digest.hexdigest()
+        return self.roles[key]
+
+    def play(self, play, base):
+        digest = hashlib.sha256()
+        for role in play.get('roles') or []:
+            name = role_name(role)
+            if name and '{{' not in name:
+                digest.update(self.role(name, base))
+        seen = set()
+        for key in TASK_LISTS:
+            for path in task_includes(play.get(key), base, seen):
+                hash_file(digest, path)
+        for path in vars_files(play, base):
+            hash_file(digest, path)
+        return digest.hexdigest()
+
+
+def play_hosts(play, index, subset):
+    pattern = play.get('hosts') or 'all'
+    if isinstance(pattern, list):
+        pattern = ','.join(pattern)
+    if '{{' in pattern:
+        pattern = 'all'
+    return index.resolve(pattern, subset)
+
+
+def host_fingerprints(playbook, index, run_args, roles_path=(),
+                      subset=None):
+    # A host's fingerprint covers the playbook (and the playbooks and task
+    # files it includes), every role applied to it by any play, its
+    # variables from the inventory, group_vars, host_vars and vars_files,
+    # and the rest of the ansible command line (extra-vars and the files
+    # they name, tags, user, ...).
+    plays, files = load_plays(playbook)
+
+    common = hashlib.sha256()
+    for path in files:
+        hash_file(common, path)
+    base = os.path.dirname(os.path.abspath(playbook))
+    for name in ('library', 'group_vars', 'host_vars'):
+        if os.path.exists(os.path.join(base, name)):
+            hash_tree(common, os.path.join(base, name))
+    common.update(json.dumps(run_args))
+    for path in extra_vars_files(run_args):
+        hash_file(common, path)
+
+    hasher = _Hasher(roles_path)
+    digests = {}
+    for play, play_base in plays:
+        play_digest = hasher.play(play, play_base)
+        for host in play_hosts(play, index, subset):
+            digests.setdefault(host, hashlib.sha256(common.digest()))
+            digests[host].update(play_digest)
+
+    fingerprints = {}
+    for host, digest in digests.iteritems():
+        digest.update(json.dumps(index.host_vars[host], sort_keys=True,
+                                 default=str))
+        fingerprints[host] = digest.hexdigest()
+    return fingerprints
+
+
+def _path(environment):
+    return os.path.join(environment, FINGERPRINT_FILE)
+
+
+def _load_all(environment):
+    try:
+        with open(_path(environment)) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def _playbook_key(playbook):
+    return os.path.normpath(playbook)
+
+
+def load(environment, playbook):
+    return _load_all(environment).get(_playbook_key(playbook), {})
+
+
+def changed_hosts(fingerprints, stored, hosts=None):
+    return [host for host in (hosts or sorted(fingerprints))
+            if host in fingerprints and
+            stored.get(host) != fingerprints[host]]
+
+
+def record(environment, playbook, fingerprints, recap):
+    # only hosts that finished the run without failing keep a fingerprint,
+    # anything else is converged again by the next incremental run
+    data = _load_all(environment)
+    stored = data.setdefault(_playbook_key(playbook), {})
+    for host, counts in recap.hosts.iteritems():
+        if host in fingerprints and not (counts['failed'] or
+                                         counts['unreachable']):
+            stored[host] = fingerprints[host]
+        else:
+            stored.pop(host, None)
+    utils.atomic_write(_path(environment),
+                       json.dumps(data, indent=2, sort_keys=True))
@@ -0,0 +1,487 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2015, Craig Tracey <craigtracey@gmail.com>
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+
+import os
+import json
+import errno
+import time
+import types
+import hashlib
+import logging
+import calendar
+from datetime import datetime
+
+from ursula_cli import inventory
+from ursula_cli import utils
+
+LOG = logging.getLogger(__name__)
+
+POLL_MIN = 1.0
+POLL_MAX = 15.0
+POLL_BACKOFF = 1.5
+EVENT_PAGE_SIZE = 100
+# number of polls without any new event before the stack status is checked
+# directly, in case events are not being recorded for this stack
+STATUS_CHECK_POLLS = 10
+CACHE_FILE = '.heat_cache'
+SESSION_CACHE_DIR = os.path.join('~', '.ursula', 'sessions')
+# don't reuse a token that would expire within this many seconds
+SESSION_EXPIRY_MARGIN = 300
+SSH_CONFIG_FILE = '.ssh_config'
+SSH_KEY_FILE = '.ssh_key'
+INVENTORY_FILE = '.heat_inventory.json'
+# ansible only runs executable inventories, this one prints the JSON
+INVENTORY_SCRIPT = '.heat_inventory'
+INVENTORY_WRAPPER = """#!/bin/sh
+# written by ursula, the inventory of the environment's heat stack
+if [ "$1" = "--host" ]; then
+    echo '{}'
+else
+    cat "$(dirname "$0")/%s"
+fi
+""" % INVENTORY_FILE
+# every server in the stack is in this group
+INVENTORY_GROUP = 'heat'
+
+
+def _event_time(event):
+    value = getattr(event, 'event_time', None)
+    for fmt in ('%Y-%m-%dT%H:%M:%SZ', '%Y-%m-%dT%H:%M:%S.%fZ',
+                '%Y-%m-%dT%H:%M:%S'):
+        try:
+            return datetime.strptime(value, fmt)
+        except (TypeError, ValueError):
+            continue
+    return datetime.utcnow()
+
+
+def latest_event_id(heatclient, stack_id):
+    events = heatclient.events.list(stack_id, sort_dir='desc', limit=1)
+    if events:
+        return events[0].id
+    return None
+
+
+def _new_events(heatclient, stack_id, marker):
+    events = []
+    while True:
+        page = heatclient.events.list(stack_id, marker=marker,
+                                      sort_dir='asc', limit=EVENT_PAGE_SIZE)
+        events.extend(page)
+        if len(page) < EVENT_PAGE_SIZE:
+            return events
+        marker = page[-1].id
+
+
+class StackProgress(object):
+
+    def __init__(self, stack_name):
+        self.stack_name = stack_name
+        self.started = {}
+        self.finished = {}
+        self.statuses = {}
+
+    def add(self, event):
+        name = event.resource_name
+        status = event.resource_status
+        when = _event_time(event)
+        self.statuses[name] = status
+
+        if status.endswith('_IN_PROGRESS'):
+            self.started.setdefault(name, when)
+            self.finished.pop(name, None)
+            LOG.debug("%s: %s", name, status)
+            return
+
+        self.finished[name] = when
+        reason = getattr(event, 'resource_status_reason', None)
+        elapsed = self.elapsed(name)
+        if elapsed is not None:
+            LOG.info("%s: %s (%.1fs)", name, status, elapsed)
+        else:
+            LOG.info("%s: %s", name, status)
+        if status.endswith('_FAILED') and reason:
+            LOG.error("%s: %s", name, reason)
+        if name != self.stack_name:
+            LOG.info("%d/%d stack resources done", self.done(), self.total())
+
+    def elapsed(self, name):
+        if name in self.started and name in self.finished:
+            delta = self.finished[name] - self.started[name]
+            return delta.seconds + delta.microseconds / 1e6
+        return None
+
+    def is_done(self, name):
+        status = self.statuses.get(name)
+        return status is not None and not status.endswith('_IN_PROGRESS')
+
+    def done(self):
+        return len([n for n in self.statuses
+                    if n != self.stack_name and self.is_done(n)])
+
+    def total(self):
+        return len([n for n in self.statuses if n != self.stack_name])
+
+    def summary(self, count=5):
+        timings = [(self.elapsed(n), n) for n in self.statuses
+                   if n != self.stack_name and self.elapsed(n) is not None]
+        for elapsed, name in sorted(timings, reverse=True)[:count]:
+            LOG.debug("  %-40s %7.1fs", name, elapsed)
+
+
+def _rolls_back(stack):
+    # heat rolls back a failed create or update unless told not to
+    return stack.action == 'ROLLBACK' or not getattr(stack, 'disable_rollback',
+                                                     True)
+
+
+def wait_for_stack(heatclient, stack_name, action, marker=None):
+    # Follow the stack's event list rather than re-fetching the whole stack:
+    # only new events after `marker` are listed on each poll, the poll
+    # interval backs off while heat is quiet, and the full stack (with its
+    # outputs) is fetched once, after the stack reaches a terminal state.
+    # A failed create or update that heat rolls back is only over once the
+    # rollback is.
+    action = action.upper()
+    progress = StackProgress(stack_name)
+    started = time.time()
+    interval = POLL_MIN
+    quiet = 0
+
+    while True:
+        events = _new_events(heatclient, stack_name, marker)
+        terminal = False
+        for event in events:
+            marker = event.id
+            progress.add(event)
+            if event.resource_name != stack_name:
+                continue
+            if event.resource_status == 'ROLLBACK_IN_PROGRESS':
+                action = 'ROLLBACK'
+                terminal = False
+            elif (event.resource_status.startswith(action + '_') and
+                    progress.is_done(stack_name)):
+                terminal = True
+
+        if (terminal and action != 'ROLLBACK' and
+                progress.statuses[stack_name].endswith('_FAILED') and
+                _rolls_back(heatclient.stacks.get(stack_name))):
+            LOG.info("Waiting for heat to roll back stack %s", stack_name)
+            action = 'ROLLBACK'
+            terminal = False
+
+        if terminal:
+            break
+
+        if events:
+            interval = POLL_MIN
+            quiet = 0
+        else:
+            interval = min(POLL_MAX, interval * POLL_BACKOFF)
+            quiet += 1
+
+        if quiet >= STATUS_CHECK_POLLS:
+            stack = heatclient.stacks.get(stack_name)
+            if stack.status != 'IN_PROGRESS':
+                LOG.debug("Stack %s reached %s without a stack event",
+                          stack_name, stack.stack_status)
+                return stack
+            quiet = 0
+
+        LOG.debug("Waiting on stack (%ds elapsed)...",
+                  time.time() - started)
+        time.sleep(interval)
+
+    LOG.debug("Stack %s finished in %ds, slowest resources:",
+              stack_name, time.time() - started)
+    progress.summary()
+    return heatclient.stacks.get(stack_name)
+
+
+def find_stack(heatclient, stack_name):
+    # a filtered stack list returns the status without the (potentially
+    # expensive) outputs that a full stack GET resolves
+    for stack in heatclient.stacks.list(filters={'name': stack_name}):
+        if stack.stack_name == stack_name:
+            return stack
+    return None
+
+
+def stack_fingerprint(stack_args):
+    fields = {
+        'stack_name': stack_args['stack_name'],
+        'template': stack_args['template'],
+        'parameters': stack_args.get('parameters', {}),
+    }
+    return hashlib.sha256(json.dumps(fields, sort_keys=True)).hexdigest()
+
+
+def _cache_path(environment):
+    return os.path.join(environment, CACHE_FILE)
+
+
+def load_cache(environment):
+    try:
+        with open(_cache_path(environment)) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def _stack_timestamp(stack):
+    return (getattr(stack, 'updated_time', None) or
+            getattr(stack, 'creation_time', None))
+
+
+def save_cache(environment, fingerprint, stack, outputs):
+    cache = {
+        'fingerprint': fingerprint,
+        'stack_id': stack.id,
+        'updated_time': _stack_timestamp(stack),
+        'outputs': outputs,
+    }
+    # outputs may carry the heat generated private key
+    utils.atomic_write(_cache_path(environment), json.dumps(cache), 0600)
+
+
+def cached_outputs(cache, fingerprint, stack):
+    # outputs are only reusable if the stack is the one ursula last deployed
+    # from these exact inputs and nobody has touched it since
+    if (cache.get('fingerprint') != fingerprint or
+            cache.get('stack_id') != stack.id or
+            cache.get('updated_time') != _stack_timestamp(stack)):
+        return None
+    return cache.get('outputs')
+
+
+def _session_path(creds):
+    key = hashlib.sha256(json.dumps(creds, sort_keys=True)).hexdigest()
+    return os.path.join(os.path.expanduser(SESSION_CACHE_DIR),
+                        "%s.json" % key)
+
+
+def _load_session(creds):
+    try:
+        with open(_session_path(creds)) as f:
+            session = json.load(f)
+    except (IOError, ValueError):
+        return None
+    if session.get('expires_at', 0) < time.time() + SESSION_EXPIRY_MARGIN:
+        return None
+    return session
+
+
+def _save_session(creds, session):
+    # the cached token only saves a login, it never fails the run
+    path = _session_path(creds)
+    try:
+        try:
+            os.makedirs(os.path.dirname(path), 0700)
+        except OSError as e:
+            # several environments may be deploying at once
+            if e.errno != errno.EEXIST:
+                raise
+        utils.atomic_write(path, json.dumps(session), 0600)
+    except (IOError, OSError) as e:
+        LOG.debug("Unable to cache the keystone token: %s", e)
+
+
+def _delete_session(creds):
+    try:
+        os.unlink(_session_path(creds))
+    except OSError:
+        pass
+
+
+def _authenticate(creds):
+    from keystoneclient.v3 import Client as Keystone_Client
+
+    LOG.debug("Logging into keystone")
+    ks_client = Keystone_Client(**creds)
+    endpoint = ks_client.service_catalog.url_for(
+        service_type='orchestration', endpoint_type='publicURL')
+    expires = ks_client.auth_ref.expires
+    return {
+        'token': ks_client.auth_token,
+        'endpoint': endpoint,
+        'expires_at': calendar.timegm(expires.utctimetuple()),
+    }
+
+
+class HeatClient(object):
+    # Wraps heatclient so the keystone token and orchestration endpoint are
+    # reused across ursula invocations (cached per set of credentials under
+    # ~/.ursula/sessions) and a rejected token transparently triggers a
+    # fresh login and a single retry of the failed call.
+
+    def __init__(self, creds):
+        self._creds = creds
+        self._client = None
+        self._connect()
+
+    def _connect(self, reauth=False):
+        from heatclient.client import Client as Heat_Client
+
+        session = None
+        if reauth:
+            _delete_session(self._creds)
+        else:
+            session = _load_session(self._creds)
+        if session is None:
+            session = _authenticate(self._creds)
+            _save_session(self._creds, session)
+        else:
+            LOG.debug("Reusing cached keystone token")
+        self._client = Heat_Client('1', session['endpoint'],
+                                   token=session['token'])
+
+    def _call(self, manager, method, *args, **kwargs):
+        for attempt in (0, 1):
+            try:
+                func = getattr(getattr(self._client, manager), method)
+                result = func(*args, **kwargs)
+                # paginated listings only hit the API when iterated
+                if isinstance(result, types.GeneratorType):
+                    result = list(result)
+                return result
+            except Exception as e:
+                if getattr(e, 'code', None) != 401 or attempt:
+                    raise
+                LOG.debug("Keystone token rejected, logging in again")
+                self._connect(reauth=True)
+
+    def __getattr__(self, manager):
+        return _ManagerProxy(self, manager)
+
+
+class _ManagerProxy(object):
+
+    def __init__(self, client, manager):
+        self._client = client
+        self._manager = manager
+
+    def __getattr__(self, method):
+        def call(*args, **kwargs):
+            return self._client._call(self._manager, method, *args, **kwargs)
+        return call
+
+
+def split_outputs(outputs):
+    # the servers (name to address), bastion address and generated private
+    # key among the stack outputs
+    servers = {}
+    floating_ip = None
+    private_key = None
+    for output in outputs:
+        if output['output_key'] == "floating_ip":
+            floating_ip = output['output_value']
+        elif output['output_key'] == "private_key":
+            private_key = output['output_value']
+        else:
+            servers[output['output_key']] = output['output_value']
+    return servers, floating_ip, private_key
+
+
+def ssh_config(user, servers, floating_ip=None, key_path=None):
+    defaults = [
+        "Host *",
+        "  User %s" % user,
+        "  ForwardAgent yes",
+        "  UserKnownHostsFile /dev/null",
+        "  StrictHostKeyChecking no",
+        "  PasswordAuthentication no",
+    ]
+    if key_path:
+        defaults.append("  IdentityFile %s" % key_path)
+    blocks = [defaults]
+    if floating_ip:
+        blocks.append(["Host floating_ip", "  Hostname %s" % floating_ip])
+    for server in sorted(servers):
+        block = ["Host %s" % server, "  Hostname %s" % servers[server]]
+        if floating_ip:
+            block.append("  ProxyCommand ssh -W %%h:%%p -o "
+                         "StrictHostKeyChecking=no %s@%s"
+                         % (user, floating_ip))
+        blocks.append(block)
+    return "".join("\n%s\n" % "\n".join(block) for block in blocks)
+
+
+def build_inventory(servers, static_inventory=None):
+    # ansible's dynamic inventory format: the stack's servers, in the groups
+    # and with the variables the static inventory gives them. Also returns
+    # the hosts of the static inventory that are not in the stack.
+    groups = {}
+    missing = []
+    hostvars = dict((server, {'heat_ip': ip})
+                    for server, ip in servers.iteritems())
+    if static_inventory and os.path.isfile(static_inventory):
+        static_groups, hosts, inline_vars = inventory.parse(static_inventory)
+        missing = [host for host in hosts if host not in servers]
+        for host in hosts:
+            if host in servers:
+                hostvars[host].update(inline_vars[host])
+        for name, group in static_groups.iteritems():
+            members = [host for host in group['hosts'] if host in servers]
+            if name == 'all':
+                members = []
+            if members or group['children'] or group['vars']:
+                groups[name] = {
+                    'hosts': members,
+                    'children': group['children'],
+                    'vars': group['vars'],
+                }
+    group = groups.setdefault(INVENTORY_GROUP, {
+        'hosts': [], 'children': [], 'vars': {}})
+    group['hosts'].extend(sorted(server for server in servers
+                                 if server not in group['hosts']))
+    groups['_meta'] = {'hostvars': hostvars}
+    return groups, missing
+
+
+def inventory_path(environment):
+    return os.path.join(environment, INVENTORY_SCRIPT)
+
+
+def write_environment(environment, outputs, user, static_inventory=None):
+    # Writes the ssh config, the inventory and any generated private key for
+    # the stack's outputs, each only when it changed. Returns the servers,
+    # bastion address and key file.
+    servers, floating_ip, private_key = split_outputs(outputs)
+    key_path = None
+    if private_key:
+        key_path = os.path.join(environment, SSH_KEY_FILE)
+        if utils.write_if_changed(key_path, private_key, 0600):
+            LOG.debug("Wrote the stack's private key to %s", key_path)
+
+    config_path = os.path.join(environment, SSH_CONFIG_FILE)
+    if utils.write_if_changed(config_path, ssh_config(user, servers,
+                                                      floating_ip, key_path)):
+        LOG.debug("Wrote the ssh config for %d servers to %s", len(servers),
+                  config_path)
+
+    data, missing = build_inventory(servers, static_inventory)
+    if utils.write_if_changed(os.path.join(environment, INVENTORY_FILE),
+                              json.dumps(data, indent=2, sort_keys=True,
+                                         separators=(',', ': ')) + "\n"):
+        LOG.debug("Wrote the inventory of %d servers to %s", len(servers),
+                  inventory_path(environment))
+        if missing:
+            LOG.warn("%s lists hosts that are not in the stack, they are "
+                     "left out of its inventory: %s", static_inventory,
+                     ", ".join(missing))
+    utils.write_if_changed(inventory_path(environment), INVENTORY_WRAPPER,
+                           0755)
+    return servers, floating_ip, key_path
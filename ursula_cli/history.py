@@ -0,0 +1,274 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2015, Craig Tracey <craigtracey@gmail.com>
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+
+import os
+import math
+import time
+import contextlib
+
+from ursula_cli import utils
+
+HISTORY_PATH = os.path.join('~', '.ursula', 'history.db')
+PHASES = ('provision', 'ssh_wait', 'ansible')
+# a run is slow when it takes this much longer than the median of the
+# successful runs of the same playbook in the same environment before it
+SLOW_FACTOR = 1.5
+# and at least this many seconds longer, so short runs aren't flagged for
+# noise
+SLOW_MIN_DELTA = 30
+BASELINE_RUNS = 20
+MIN_BASELINE_RUNS = 3
+RECENT_RUNS = 5
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    started REAL NOT NULL,
+    environment TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    target TEXT NOT NULL,
+    provisioner TEXT,
+    rc INTEGER,
+    hosts INTEGER,
+    duration REAL NOT NULL,
+    provision REAL NOT NULL DEFAULT 0,
+    ssh_wait REAL NOT NULL DEFAULT 0,
+    ansible REAL NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS runs_by_target
+    ON runs (environment, kind, target, started);
+"""
+COLUMNS = ('id', 'started', 'environment', 'kind', 'target', 'provisioner',
+           'rc', 'hosts', 'duration') + PHASES
+
+
+class RunRecord(object):
+    # What one run did and how long each phase took. Phases can nest
+    # (waiting for ssh is part of provisioning), a nested phase's time is
+    # only counted for the nested phase.
+
+    def __init__(self, environment, kind, target, provisioner=None):
+        self.environment = os.path.abspath(environment)
+        self.kind = kind
+        self.target = target
+        self.provisioner = provisioner
+        self.started = time.time()
+        self.hosts = None
+        self.phases = dict.fromkeys(PHASES, 0.0)
+        self._running = []
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        now = time.time()
+        if self._running:
+            outer, since = self._running[-1]
+            self.phases[outer] += now - since
+        self._running.append([name, now])
+        try:
+            yield
+        finally:
+            name, since = self._running.pop()
+            now = time.time()
+            self.phases[name] += now - since
+            if self._running:
+                self._running[-1][1] = now
+
+
+def phase(record, name):
+    if record is None:
+        return _no_phase()
+    return record.phase(name)
+
+
+@contextlib.contextmanager
+def _no_phase():
+    yield
+
+
+def connect(path=None):
+    import sqlite3
+
+    path = os.path.expanduser(path or HISTORY_PATH)
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory, 0700)
+    # concurrent runs each write their own record
+    conn = sqlite3.connect(path, timeout=30)
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def _rows(conn, environment=None, target=None):
+    query = "SELECT %s FROM runs" % ", ".join(COLUMNS)
+    clauses, params = [], []
+    if environment:
+        clauses.append("environment = ?")
+        params.append(os.path.abspath(environment))
+    if target:
+        clauses.append("target = ?")
+        params.append(target)
+    if clauses:
+        query += " WHERE " + " AND ".join(clauses)
+    query += " ORDER BY started, id"
+    return [dict(zip(COLUMNS, row)) for row in conn.execute(query, params)]
+
+
+def percentile(values, pct):
+    # nearest rank
+    if not values:
+        return None
+    values = sorted(values)
+    rank = int(math.ceil(pct / 100.0 * len(values)))
+    return values[max(0, rank - 1)]
+
+
+def _with_baselines(rows, column='duration'):
+    # each run's baseline is the median of the successful runs of the same
+    # playbook in the same environment that came before it
+    previous = {}
+    for row in rows:
+        key = (row['environment'], row['kind'], row['target'])
+        durations = previous.setdefault(key, [])
+        row['baseline'] = None
+        if len(durations) >= MIN_BASELINE_RUNS:
+            row['baseline'] = percentile(durations[-BASELINE_RUNS:], 50)
+        row['slow'] = bool(
+            row['baseline'] is not None and row['rc'] is not None and
+            row[column] > SLOW_FACTOR * row['baseline'] and
+            row[column] - row['baseline'] > SLOW_MIN_DELTA)
+        if row['rc'] == 0:
+            durations.append(row[column])
+    return rows
+
+
+def save(record, rc, path=None):
+    # stores the run and returns it with its baseline and whether it was
+    # slow compared to it
+    duration = time.time() - record.started
+    conn = connect(path)
+    try:
+        with conn:
+            conn.execute(
+                "INSERT INTO runs (started, environment, kind, target, "
+                "provisioner, rc, hosts, duration, provision, ssh_wait, "
+                "ansible) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (record.started, record.environment, record.kind,
+                 record.target, record.provisioner, rc, record.hosts,
+                 duration) + tuple(record.phases[p] for p in PHASES))
+        rows = _rows(conn, record.environment, record.target)
+    finally:
+        conn.close()
+    rows = [row for row in rows if row['kind'] == record.kind]
+    return _with_baselines(rows)[-1]
+
+
+def runs(environment=None, target=None, count=20, path=None):
+    conn = connect(path)
+    try:
+        rows = _rows(conn, environment, target)
+    finally:
+        conn.close()
+    return _with_baselines(rows)[-count:] if count else _with_baselines(rows)
+
+
+def stats(environment=None, target=None, column='duration', path=None):
+    # p50/p95 of the successful runs of each playbook, for the most recent
+    # runs against those before them
+    conn = connect(path)
+    try:
+        rows = _with_baselines(_rows(conn, environment, target), column)
+    finally:
+        conn.close()
+
+    groups = {}
+    for row in rows:
+        groups.setdefault((row['environment'], row['kind'], row['target']),
+                          []).append(row)
+    results = []
+    for (environment, kind, target), group in sorted(groups.iteritems()):
+        values = [row[column] for row in group if row['rc'] == 0]
+        recent = values[-RECENT_RUNS:]
+        before = values[:-RECENT_RUNS][-BASELINE_RUNS:]
+        results.append({
+            'environment': environment,
+            'kind': kind,
+            'target': target,
+            'runs': len(group),
+            'failed': len([row for row in group if row['rc'] != 0]),
+            'slow': len([row for row in group if row['slow']]),
+            'p50': percentile(values, 50),
+            'p95': percentile(values, 95),
+            'recent_p50': percentile(recent, 50),
+            'recent_p95': percentile(recent, 95),
+            'baseline_p50': percentile(before, 50),
+            'last': group[-1],
+        })
+    return results
+
+
+def _display_path(path):
+    relative = os.path.relpath(path)
+    return path if relative.startswith('..') else relative
+
+
+def _duration(seconds):
+    if seconds is None:
+        return "-"
+    return utils.format_duration(seconds)
+
+
+def format_runs(rows):
+    lines = ["%-19s  %-20s  %-30s  %4s  %5s  %9s  %9s  %9s  %9s" % (
+        "STARTED", "ENVIRONMENT", "PLAYBOOK", "RC", "HOSTS", "PROVISION",
+        "SSH WAIT", "ANSIBLE", "TOTAL")]
+    for row in rows:
+        line = "%-19s  %-20s  %-30s  %4s  %5s  %9s  %9s  %9s  %9s" % (
+            time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(row['started'])),
+            _display_path(row['environment']), _target_label(row),
+            "-" if row['rc'] is None else row['rc'],
+            "-" if row['hosts'] is None else row['hosts'],
+            _duration(row['provision']), _duration(row['ssh_wait']),
+            _duration(row['ansible']), _duration(row['duration']))
+        if row['slow']:
+            line += "  SLOW (%.1fx the usual %s)" % (
+                row['duration'] / row['baseline'],
+                _duration(row['baseline']))
+        lines.append(line)
+    return "\n".join(lines)
+
+
+def _target_label(row):
+    if row['kind'] == 'playbook':
+        return row['target']
+    return "%s (%s)" % (row['target'], row['kind'])
+
+
+def format_stats(results):
+    lines = ["%-20s  %-30s  %5s  %5s  %9s  %9s  %10s  %10s  %7s  %4s" % (
+        "ENVIRONMENT", "PLAYBOOK", "RUNS", "FAIL", "P50", "P95",
+        "RECENT P50", "RECENT P95", "CHANGE", "SLOW")]
+    for result in results:
+        change = "-"
+        if result['recent_p50'] and result['baseline_p50']:
+            change = "%+.0f%%" % (
+                100.0 * result['recent_p50'] / result['baseline_p50'] - 100)
+        lines.append(
+            "%-20s  %-30s  %5d  %5d  %9s  %9s  %10s  %10s  %7s  %4d" % (
+                _display_path(result['environment']), _target_label(result),
+                result['runs'], result['failed'], _duration(result['p50']),
+                _duration(result['p95']), _duration(result['recent_p50']),
+                _duration(result['recent_p95']), change, result['slow']))
+    return "\n".join(lines)
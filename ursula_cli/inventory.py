@@ -0,0 +1,504 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2015, Craig Tracey <craigtracey@gmail.com>
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+
+import os
+import re
+import ast
+import json
+import shlex
+import fnmatch
+import logging
+import subprocess
+
+from ursula_cli import utils
+
+LOG = logging.getLogger(__name__)
+
+INDEX_FILE = '.ursula_inventory.json'
+# bump when the layout of the cached index changes
+INDEX_VERSION = 1
+VARS_EXTENSIONS = ('', '.yml', '.yaml', '.json')
+
+HOST_RANGE = re.compile(r'\[([0-9a-zA-Z]+):([0-9a-zA-Z]+)(?::([0-9]+))?\]')
+SUBSCRIPT = re.compile(r'^(.+)\[(?:(-?[0-9]+)|([0-9]+)[:-]([0-9]*))\]$')
+SECTION = re.compile(r'^\[([^:\]\s]+)(?::(\w+))?\]$')
+
+
+class InventoryError(Exception):
+    pass
+
+
+def _parse_value(value):
+    # the same literal handling ansible applies to INI variables
+    try:
+        return ast.literal_eval(value)
+    except (ValueError, SyntaxError):
+        return value
+
+
+def _expand_range(name):
+    match = HOST_RANGE.search(name)
+    if not match:
+        return [name]
+    start, end, step = match.groups()
+    step = int(step or 1)
+    if start.isdigit() and end.isdigit():
+        width = len(start) if start.startswith('0') else 0
+        values = ["%0*d" % (width, i)
+                  for i in range(int(start), int(end) + 1, step)]
+    elif len(start) == 1 and len(end) == 1:
+        values = [chr(i) for i in range(ord(start), ord(end) + 1, step)]
+    else:
+        raise InventoryError("Invalid host range in '%s'" % name)
+    prefix, suffix = name[:match.start()], name[match.end():]
+    names = []
+    for value in values:
+        names.extend(_expand_range(prefix + value + suffix))
+    return names
+
+
+def _new_group():
+    return {'hosts': [], 'children': [], 'vars': {}}
+
+
+def _parse_ini(path):
+    groups = {'all': _new_group(), 'ungrouped': _new_group()}
+    host_vars = {}
+    hosts = []
+
+    def add_host(group, name, variables):
+        if name not in host_vars:
+            hosts.append(name)
+            host_vars[name] = {}
+        host_vars[name].update(variables)
+        if name not in groups[group]['hosts']:
+            groups[group]['hosts'].append(name)
+
+    group, kind = 'ungrouped', 'hosts'
+    with open(path) as f:
+        for lineno, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith(('#', ';')):
+                continue
+            match = SECTION.match(line)
+            if match:
+                group, kind = match.group(1), match.group(2) or 'hosts'
+                if kind not in ('hosts', 'children', 'vars'):
+                    raise InventoryError("%s:%d: unknown section type '%s'"
+                                         % (path, lineno, kind))
+                groups.setdefault(group, _new_group())
+                continue
+
+            if kind == 'vars':
+                if '=' not in line:
+                    raise InventoryError("%s:%d: expected key=value"
+                                         % (path, lineno))
+                key, value = line.split('=', 1)
+                groups[group]['vars'][key.strip()] = _parse_value(
+                    value.strip())
+            elif kind == 'children':
+                child = line.split()[0]
+                groups.setdefault(child, _new_group())
+                if child not in groups[group]['children']:
+                    groups[group]['children'].append(child)
+            else:
+                tokens = shlex.split(line, comments=True)
+                name, variables = tokens[0], {}
+                if HOST_RANGE.sub('', name).count(':') == 1:
+                    name, port = name.rsplit(':', 1)
+                    variables['ansible_port'] = int(port)
+                for token in tokens[1:]:
+                    if '=' not in token:
+                        raise InventoryError("%s:%d: expected key=value, "
+                                             "got '%s'"
+                                             % (path, lineno, token))
+                    key, value = token.split('=', 1)
+                    variables[key] = _parse_value(value)
+                for host in _expand_range(name):
+                    add_host(group, host, variables)
+
+    return groups, hosts, host_vars
+
+
+def _parse_script(path):
+    # an executable inventory, as ansible would run it
+    proc = subprocess.Popen([os.path.abspath(path), '--list'],
+                            stdout=subprocess.PIPE)
+    data = json.loads(proc.communicate()[0])
+    if proc.returncode:
+        raise InventoryError("%s --list failed (rc=%d)"
+                             % (path, proc.returncode))
+
+    groups = {'all': _new_group(), 'ungrouped': _new_group()}
+    meta = data.pop('_meta', {}).get('hostvars', {})
+    hosts = []
+    for name, group in sorted(data.iteritems()):
+        if isinstance(group, list):
+            group = {'hosts': group}
+        groups[name] = {
+            'hosts': list(group.get('hosts', [])),
+            'children': list(group.get('children', [])),
+            'vars': dict(group.get('vars', {})),
+        }
+        hosts.extend(h for h in group.get('hosts', []) if h not in hosts)
+    for child in set(c for g in groups.values() for c in g['children']):
+        groups.setdefault(child, _new_group())
+    host_vars = dict((host, dict(meta.get(host, {}))) for host in hosts)
+    return groups, hosts, host_vars
+
+
+def _vars_files(directory, name):
+    paths = []
+    for extension in VARS_EXTENSIONS:
+        path = os.path.join(directory, name + extension)
+        if os.path.isfile(path):
+            paths.append(path)
+    path = os.path.join(directory, name)
+    if os.path.isdir(path):
+        paths.extend(os.path.join(path, f) for f in sorted(os.listdir(path))
+                     if f.endswith(VARS_EXTENSIONS[1:]))
+    return paths
+
+
+def _load_vars(directory, name):
+    variables = {}
+    for path in _vars_files(directory, name):
+        with open(path) as f:
+            data = f.read()
+        if data.startswith('$ANSIBLE_VAULT'):
+            LOG.debug("Skipping vault encrypted %s", path)
+            continue
+        import yaml
+        try:
+            loaded = yaml.safe_load(data)
+        except yaml.YAMLError as e:
+            raise InventoryError("Unable to parse %s: %s" % (path, e))
+        if isinstance(loaded, dict):
+            variables.update(loaded)
+    return variables
+
+
+def _sources(inventory_path):
+    # everything the index is built from; the vars directories themselves
+    # are included so added or removed files are noticed too
+    base = os.path.dirname(os.path.abspath(inventory_path))
+    paths = [os.path.abspath(inventory_path)]
+    for directory in ('group_vars', 'host_vars'):
+        directory = os.path.join(base, directory)
+        if not os.path.isdir(directory):
+            continue
+        paths.append(directory)
+        for name in sorted(os.listdir(directory)):
+            path = os.path.join(directory, name)
+            paths.append(path)
+            if os.path.isdir(path):
+                paths.extend(os.path.join(path, f)
+                             for f in sorted(os.listdir(path)))
+    return dict((path, os.stat(path).st_mtime) for path in paths)
+
+
+def parse(inventory_path):
+    # the groups (with their hosts, children and vars), the hosts in order
+    # and each host's own variables, as the inventory states them
+    if os.access(inventory_path, os.X_OK):
+        return _parse_script(inventory_path)
+    return _parse_ini(inventory_path)
+
+
+def _build(inventory_path):
+    groups, hosts, inline_vars = parse(inventory_path)
+
+    grouped = set(h for name, g in groups.iteritems()
+                  if name not in ('all', 'ungrouped') for h in g['hosts'])
+    groups['ungrouped']['hosts'] = [h for h in groups['ungrouped']['hosts']
+                                    if h not in grouped]
+    tops = [name for name in groups if name != 'all' and
+            not any(name in g['children'] for g in groups.itervalues())]
+    groups['all']['children'] = sorted(tops)
+
+    base = os.path.dirname(os.path.abspath(inventory_path))
+    group_vars_dir = os.path.join(base, 'group_vars')
+    host_vars_dir = os.path.join(base, 'host_vars')
+
+    def ancestors(name, depth, seen):
+        # (depth, group) for each group the given one belongs to
+        found = [(depth, name)]
+        for parent, group in groups.iteritems():
+            if name in group['children'] and parent not in seen:
+                seen.add(parent)
+                found.extend(ancestors(parent, depth - 1, seen))
+        return found
+
+    group_vars = dict((name, dict(group['vars'],
+                                  **_load_vars(group_vars_dir, name)))
+                      for name, group in groups.iteritems())
+
+    host_groups = {}
+    variables = {}
+    for host in hosts:
+        direct = [n for n, g in groups.iteritems() if host in g['hosts']]
+        found = {}
+        for name in direct + ['all']:
+            for depth, group in ancestors(name, 0, set([name])):
+                found[group] = min(depth, found.get(group, depth))
+        found['all'] = min(found.values()) - 1
+        # the most distant ancestors first, so nearer groups override them
+        ordered = sorted(found, key=lambda g: (found[g], g))
+        host_groups[host] = [g for g in ordered
+                             if g not in ('all', 'ungrouped')]
+        merged = {}
+        for group in ordered:
+            merged.update(group_vars[group])
+        merged.update(inline_vars[host])
+        merged.update(_load_vars(host_vars_dir, host))
+        variables[host] = merged
+
+    members = {}
+
+    def group_hosts(name, seen):
+        if name in members:
+            return members[name]
+        result = list(groups[name]['hosts'])
+        for child in groups[name]['children']:
+            if child in seen:
+                continue
+            for host in group_hosts(child, seen | set([child])):
+                if host not in result:
+                    result.append(host)
+        members[name] = result
+        return result
+
+    for name in groups:
+        group_hosts(name, set([name]))
+    members['all'] = list(hosts)
+
+    return {
+        'hosts': hosts,
+        'groups': members,
+        'host_groups': host_groups,
+        'host_vars': variables,
+    }
+
+
+def _split_pattern(pattern):
+    if ',' in pattern:
+        parts = pattern.split(',')
+    else:
+        # ':' separates patterns, except inside a [x:y] subscript
+        parts = re.split(r':(?![^\[]*\])', pattern)
+    return [part.strip() for part in parts if part.strip()]
+
+
+def _matcher(name):
+    # a predicate for the host and group names a pattern term matches
+    if name.startswith('~'):
+        return re.compile(name[1:]).search
+    if any(c in name for c in '*?['):
+        return lambda value: fnmatch.fnmatch(value, name)
+    return lambda value: value == name
+
+
+class InventoryIndex(object):
+    # Groups, group membership and host variables of an inventory, with
+    # host pattern resolution following ansible's rules (unions, &, !,
+    # globs, ~regexes and [x:y] subscripts).
+
+    def __init__(self, data):
+        self.hosts = data['hosts']
+        self.groups = data['groups']
+        self.host_groups = data['host_groups']
+        self.host_vars = data['host_vars']
+
+    def _match(self, term):
+        name, subscript = term, None
+        if not term.startswith('~'):
+            match = SUBSCRIPT.match(term)
+            if match:
+                name, index, start, end = match.groups()
+                if index is not None:
+                    subscript = (int(index), None)
+                else:
+                    subscript = (int(start), int(end) if end else -1)
+
+        if name in ('all', '*'):
+            found = list(self.hosts)
+        else:
+            matches = _matcher(name)
+            found = []
+            for group in sorted(self.groups):
+                if group not in ('all', 'ungrouped') and matches(group):
+                    found.extend(h for h in self.groups[group]
+                                 if h not in found)
+            found.extend(h for h in self.hosts
+                         if h not in found and matches(h))
+
+        if subscript and found:
+            start, end = subscript
+            if end is None:
+                # found[-1:0] would be empty
+                found = found[start:start + 1 or None] \
+                    if -len(found) <= start < len(found) else []
+            else:
+                if end == -1:
+                    end = len(found) - 1
+                found = found[start:end + 1]
+        return found
+
+    def _terms(self, pattern):
+        terms = []
+        for term in _split_pattern(pattern):
+            if term.startswith('@'):
+                with open(term[1:]) as f:
+                    terms.extend(line.strip() for line in f if line.strip())
+            else:
+                terms.append(term)
+        return terms
+
+    def resolve(self, pattern='all', subset=None):
+        try:
+            return self._resolve(pattern, subset)
+        except (IOError, re.error) as e:
+            raise InventoryError("Unable to resolve '%s': %s" % (pattern, e))
+
+    def _resolve(self, pattern, subset=None):
+        terms = self._terms(pattern)
+        if not terms:
+            return []
+        regular = [t for t in terms if t[0] not in '&!']
+        if not regular:
+            regular = ['all']
+        hosts = []
+        for term in regular:
+            hosts.extend(h for h in self._match(term) if h not in hosts)
+        for term in terms:
+            if term.startswith('&'):
+                keep = set(self._match(term[1:]))
+                hosts = [h for h in hosts if h in keep]
+        for term in terms:
+            if term.startswith('!'):
+                drop = set(self._match(term[1:]))
+                hosts = [h for h in hosts if h not in drop]
+        if subset:
+            keep = set(self._resolve(subset))
+            hosts = [h for h in hosts if h in keep]
+        return hosts
+
+
+def load_index(inventory_path):
+    # the index is cached next to the inventory and rebuilt whenever the
+    # inventory, or any group_vars/host_vars file, changes
+    try:
+        return _load_index(inventory_path)
+    except (EnvironmentError, ValueError) as e:
+        # unreadable files, or a dynamic inventory that didn't print JSON
+        raise InventoryError("Unable to index %s: %s" % (inventory_path, e))
+
+
+def _load_index(inventory_path):
+    cache_path = os.path.join(os.path.dirname(inventory_path), INDEX_FILE)
+    executable = os.access(inventory_path, os.X_OK)
+    sources = _sources(inventory_path)
+    if not executable:
+        try:
+            with open(cache_path) as f:
+                cached = json.load(f)
+            if (cached.get('version') == INDEX_VERSION and
+                    cached.get('sources') == sources):
+                return InventoryIndex(cached['index'])
+        except (IOError, ValueError, KeyError):
+            pass
+
+    LOG.debug("Indexing inventory %s", inventory_path)
+    data = _build(inventory_path)
+    if not executable:
+        try:
+            utils.atomic_write(cache_path, json.dumps({
+                'version': INDEX_VERSION,
+                'sources': sources,
+                'index': data,
+            }, default=str))
+        except (IOError, OSError) as e:
+            LOG.debug("Unable to cache the inventory index: %s", e)
+    return InventoryIndex(data)
+
+
+def list_hosts(inventory_path, pattern='all', subset=None):
+    return load_index(inventory_path).resolve(pattern, subset)
+
+
+def host_groups(inventory_path, pattern='all', subset=None):
+    index = load_index(inventory_path)
+    return dict((host, index.host_groups[host])
+                for host in index.resolve(pattern, subset))
+
+
+def _connection_var(variables, *names):
+    for name in names:
+        value = variables.get(name)
+        # templated values are left for ansible to resolve
+        if value is not None and '{{' not in str(value):
+            return str(value)
+    return None
+
+
+def host_connections(inventory_path, pattern='all', subset=None):
+    # the address, port and user ansible's ssh connection would use for
+    # each host
+    index = load_index(inventory_path)
+    connections = []
+    for host in index.resolve(pattern, subset):
+        variables = index.host_vars[host]
+        connection = _connection_var(variables, 'ansible_connection')
+        if connection in ('local', 'docker'):
+            continue
+        connections.append({
+            'name': host,
+            'address': _connection_var(variables, 'ansible_host',
+                                       'ansible_ssh_host') or host,
+            'port': _connection_var(variables, 'ansible_port',
+                                    'ansible_ssh_port'),
+            'user': _connection_var(variables, 'ansible_user',
+                                    'ansible_ssh_user'),
+        })
+    return connections
+
+
+def partition_hosts(hosts, count):
+    hosts = sorted(hosts)
+    return [shard for shard in (hosts[i::count] for i in range(count))
+            if shard]
+
+
+def partition_groups(groups, count):
+    # Keep hosts that share their smallest group in the same shard, so
+    # groups that coordinate among themselves (clusters, run_once within a
+    # group) stay in one ansible process, then balance shard sizes by
+    # placing the largest groups first.
+    sizes = {}
+    for names in groups.itervalues():
+        for name in names:
+            sizes[name] = sizes.get(name, 0) + 1
+
+    buckets = {}
+    for host, names in groups.iteritems():
+        leaf = min(names, key=lambda n: (sizes[n], n)) if names else host
+        buckets.setdefault(leaf, []).append(host)
+
+    shards = [[] for _ in range(count)]
+    for leaf in sorted(buckets, key=lambda b: (-len(buckets[b]), b)):
+        smallest = min(shards, key=len)
+        smallest.extend(sorted(buckets[leaf]))
+    return [shard for shard in shards if shard]
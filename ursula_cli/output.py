@@ -0,0 +1,126 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2015, Craig Tracey <craigtracey@gmail.com>
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+
+import os
+import sys
+import select
+import threading
+
+from ursula_cli.profiler import strip_ansi
+
+CHUNK_SIZE = 64 * 1024
+# how long a partial line (e.g. a prompt) may sit in the buffer before it is
+# shown without waiting for its newline
+PARTIAL_LINE_TIMEOUT = 0.2
+
+# serializes writes from concurrently streamed processes so blocks from
+# different processes never interleave mid-line
+_WRITE_LOCK = threading.Lock()
+
+
+class RunLog(object):
+    # append-only copy of command output, by default without the color
+    # codes ANSIBLE_FORCE_COLOR adds
+
+    def __init__(self, path, strip_color=True):
+        self.path = path
+        self.strip_color = strip_color
+        self._file = open(path, 'a')
+
+    def write(self, data):
+        if self.strip_color:
+            data = strip_ansi(data)
+        self._file.write(data)
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+def _prefixed(block, prefix):
+    return "".join(prefix + line for line in block.splitlines(True))
+
+
+class OutputStream(object):
+    # Copies a subprocess' combined stdout/stderr to our stdout (and
+    # optionally a log file) in large chunks. Only complete lines are
+    # handed to the line callbacks, prefixed or logged; a trailing partial
+    # line is held back until its newline arrives.
+
+    def __init__(self, out=None, prefix=None, callbacks=(), log=None):
+        self.out = out or sys.stdout
+        self.prefix = prefix
+        self.callbacks = list(callbacks)
+        self.log = log
+
+    def _write(self, data, at_line_start=True):
+        if self.prefix:
+            data = _prefixed(data, self.prefix)
+            if not at_line_start:
+                data = data[len(self.prefix):]
+        self.out.write(data)
+        self.out.flush()
+
+    def _emit(self, block, shown=0):
+        # `shown` bytes at the start of block were already written to stdout
+        # as a partial line
+        with _WRITE_LOCK:
+            self._write(block[shown:], at_line_start=not shown)
+            if self.log is not None:
+                self.log.write(block)
+        for line in block.splitlines():
+            for callback in self.callbacks:
+                callback(line)
+
+    def write(self, block):
+        # output produced in this process rather than read from a subprocess
+        self._emit(block if block.endswith('\n') else block + '\n')
+
+    def consume(self, fd):
+        pending = ''
+        shown = 0
+        while True:
+            if pending:
+                ready, _, _ = select.select([fd], [], [],
+                                            PARTIAL_LINE_TIMEOUT)
+                if not ready:
+                    if len(pending) > shown:
+                        with _WRITE_LOCK:
+                            self._write(pending[shown:],
+                                        at_line_start=not shown)
+                        shown = len(pending)
+                    continue
+
+            chunk = os.read(fd, CHUNK_SIZE)
+            if not chunk:
+                break
+
+            pending += chunk
+            end = pending.rfind('\n') + 1
+            if end:
+                self._emit(pending[:end], shown)
+                pending = pending[end:]
+                shown = 0
+
+        if pending:
+            self._emit(pending + '\n', shown)
+
+
+def stream(proc, **kwargs):
+    OutputStream(**kwargs).consume(proc.stdout.fileno())
+    proc.stdout.close()
+    proc.wait()
+    return proc.returncode
@@ -0,0 +1,295 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2015, Craig Tracey <craigtracey@gmail.com>
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+
+import re
+import json
+import time
+
+from ursula_cli import utils
+
+PROFILE_FILE = '.ursula_profile.json'
+
+ANSI_ESCAPE = re.compile(r'\x1b\[[0-9;]*[A-Za-z]')
+PLAY_HEADER = re.compile(r'^PLAY \[(.*)\] \**$')
+TASK_HEADER = re.compile(r'^(?:TASK|RUNNING HANDLER) \[(.*)\] \**$')
+RECAP_HEADER = re.compile(r'^PLAY RECAP \**$')
+HOST_RESULT = re.compile(
+    r'^(ok|changed|skipping|failed|fatal): \[([^\]]+?)(?: -> [^\]]+)?\]')
+RECAP_LINE = re.compile(
+    r'^(\S+)\s+:\s+ok=(\d+)\s+changed=(\d+)\s+unreachable=(\d+)\s+'
+    r'failed=(\d+)')
+ADHOC_RESULT = re.compile(
+    r'^(\S+) \| (SUCCESS|CHANGED|FAILED|UNREACHABLE)!?(?: \| rc=-?\d+)? '
+    r'(?:=>|>>)')
+
+# when a host reports several results for one task (loops), keep the worst
+STATUS_PRIORITY = ['skipping', 'ok', 'changed', 'failed', 'fatal']
+IGNORING = re.compile(r'^\.\.\.ignoring$')
+# failures worth retrying as is: connection trouble, timeouts, locks held
+# by something else on the host and overloaded upstream services
+TRANSIENT_FAILURE = re.compile(
+    r'unreachable|timed? ?out|temporar|connection (reset|refused|closed)|'
+    r'no route to host|could not get lock|unable to lock|try again|'
+    r'resource temporarily unavailable|\b50[234]\b', re.IGNORECASE)
+# tasks --start-at-task can't start from
+IMPLICIT_TASKS = ('setup', 'Gathering Facts')
+
+ADHOC_STATUS = {
+    'SUCCESS': 'ok',
+    'CHANGED': 'changed',
+    'FAILED': 'failed',
+    'UNREACHABLE': 'fatal',
+}
+
+
+def strip_ansi(line):
+    return ANSI_ESCAPE.sub('', line)
+
+
+class RunProfiler(object):
+    # Builds per-task and per-host timings from ansible's stdout as it is
+    # streamed. A host's time on a task runs from the task header to the
+    # last result line ansible prints for that host.
+
+    def __init__(self, adhoc_name=None):
+        self.started = time.time()
+        self.finished = None
+        self.play = None
+        self.tasks = []
+        self.current = None
+        if adhoc_name:
+            self._start_task(adhoc_name, self.started)
+
+    def _start_task(self, name, now):
+        self._end_task(now)
+        self.current = {
+            'name': name,
+            'play': self.play,
+            'start': now,
+            'end': None,
+            'hosts': {},
+        }
+        self.tasks.append(self.current)
+
+    def _end_task(self, now):
+        if self.current is not None:
+            self.current['end'] = now
+            self.current = None
+
+    def _host_result(self, host, status, now):
+        if self.current is None:
+            return
+        result = self.current['hosts'].setdefault(
+            host, {'status': status, 'end': now})
+        result['end'] = now
+        if (STATUS_PRIORITY.index(status) >
+                STATUS_PRIORITY.index(result['status'])):
+            result['status'] = status
+
+    def feed(self, line):
+        line = strip_ansi(line).rstrip()
+        now = time.time()
+
+        match = HOST_RESULT.match(line)
+        if match:
+            self._host_result(match.group(2), match.group(1), now)
+            return
+        match = ADHOC_RESULT.match(line)
+        if match:
+            self._host_result(match.group(1), ADHOC_STATUS[match.group(2)],
+                              now)
+            return
+        match = TASK_HEADER.match(line)
+        if match:
+            self._start_task(match.group(1), now)
+            return
+        match = PLAY_HEADER.match(line)
+        if match:
+            self._end_task(now)
+            self.play = match.group(1)
+            return
+        if RECAP_HEADER.match(line):
+            self._end_task(now)
+
+    def finish(self):
+        self.finished = time.time()
+        self._end_task(self.finished)
+
+    def task_durations(self):
+        return [(task['end'] - task['start'], task) for task in self.tasks
+                if task['end'] is not None]
+
+    def host_durations(self):
+        totals = {}
+        for task in self.tasks:
+            for host, result in task['hosts'].iteritems():
+                totals[host] = (totals.get(host, 0) +
+                                result['end'] - task['start'])
+        return totals
+
+    def report(self):
+        tasks = []
+        for task in self.tasks:
+            hosts = dict(
+                (host, {'status': result['status'],
+                        'duration': result['end'] - task['start']})
+                for host, result in task['hosts'].iteritems())
+            tasks.append({
+                'name': task['name'],
+                'play': task['play'],
+                'start': task['start'],
+                'end': task['end'],
+                'duration': (task['end'] or self.finished) - task['start'],
+                'hosts': hosts,
+            })
+        return {
+            'started': self.started,
+            'finished': self.finished,
+            'duration': (self.finished or time.time()) - self.started,
+            'tasks': tasks,
+            'hosts': self.host_durations(),
+        }
+
+    def write(self, path):
+        utils.atomic_write(path, json.dumps(self.report(), indent=2,
+                                            sort_keys=True))
+
+    def summary(self, count=10):
+        lines = []
+        tasks = sorted(self.task_durations(), key=lambda t: t[0],
+                       reverse=True)[:count]
+        if tasks:
+            lines.append("Slowest tasks:")
+            for duration, task in tasks:
+                slowest = sorted(
+                    task['hosts'].iteritems(),
+                    key=lambda h: h[1]['end'], reverse=True)[:1]
+                suffix = ""
+                if slowest:
+                    suffix = " (slowest host: %s)" % slowest[0][0]
+                lines.append("  %8.1fs  %s%s" % (duration, task['name'],
+                                                 suffix))
+        hosts = sorted(self.host_durations().iteritems(),
+                       key=lambda h: h[1], reverse=True)[:count]
+        if hosts:
+            lines.append("Slowest hosts:")
+            for host, duration in hosts:
+                lines.append("  %8.1fs  %s" % (duration, host))
+        return "\n".join(lines)
+
+
+class PlayRecap(object):
+    # Collects the per-host counters from the PLAY RECAP at the end of an
+    # ansible-playbook run.
+
+    def __init__(self):
+        self.hosts = {}
+        self._in_recap = False
+
+    def feed(self, line):
+        line = strip_ansi(line).strip()
+        if RECAP_HEADER.match(line):
+            self._in_recap = True
+            return
+        if not self._in_recap:
+            return
+        match = RECAP_LINE.match(line)
+        if match:
+            host, ok, changed, unreachable, failed = match.groups()
+            self.hosts[host] = {
+                'ok': int(ok),
+                'changed': int(changed),
+                'unreachable': int(unreachable),
+                'failed': int(failed),
+            }
+
+    def merge(self, other):
+        self.hosts.update(other.hosts)
+
+    def failed(self):
+        return sorted(h for h, c in self.hosts.iteritems() if c['failed'])
+
+    def unreachable(self):
+        return sorted(h for h, c in self.hosts.iteritems()
+                      if c['unreachable'])
+
+
+class FailureTracker(PlayRecap):
+    # A PlayRecap that also follows the task headers, so that for every
+    # host that failed it knows the task it failed on and the last task it
+    # completed.
+
+    def __init__(self):
+        super(FailureTracker, self).__init__()
+        self.play = None
+        self.task = None
+        self.task_is_handler = False
+        self.last_completed = {}
+        self.failures = {}
+        self._last_failed = None
+
+    def feed(self, line):
+        super(FailureTracker, self).feed(line)
+        line = strip_ansi(line).rstrip()
+        match = HOST_RESULT.match(line)
+        if match:
+            status, host = match.groups()
+            if status in ('failed', 'fatal'):
+                self._last_failed = host
+                task = self.task
+                if self.task_is_handler or task in IMPLICIT_TASKS:
+                    task = None
+                self.failures.setdefault(host, {
+                    'play': self.play,
+                    'task': task,
+                    'message': line[match.end():].lstrip(': ').strip(),
+                })
+            else:
+                self.last_completed[host] = self.task
+            return
+        if IGNORING.match(line.strip()):
+            if self._last_failed:
+                self.failures.pop(self._last_failed, None)
+                self._last_failed = None
+            return
+        self._last_failed = None
+        match = TASK_HEADER.match(line)
+        if match:
+            self.task = match.group(1)
+            self.task_is_handler = line.startswith('RUNNING HANDLER')
+            return
+        match = PLAY_HEADER.match(line)
+        if match:
+            self.play = match.group(1)
+            self.task = None
+
+    def merge(self, other):
+        super(FailureTracker, self).merge(other)
+        self.last_completed.update(other.last_completed)
+        self.failures.update(other.failures)
+
+    def failed_hosts(self):
+        # the recap is authoritative on who failed, the task lines on where
+        failed = {}
+        for host in set(self.failed()) | set(self.unreachable()):
+            failure = dict(self.failures.get(host) or
+                           {'play': None, 'task': None, 'message': ''})
+            failure['last_completed'] = self.last_completed.get(host)
+            failure['transient'] = bool(
+                host in self.unreachable() or
+                TRANSIENT_FAILURE.search(failure['message']))
+            failed[host] = failure
+        return failed
@@ -0,0 +1,62 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2015, Craig Tracey <craigtracey@gmail.com>
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+
+import os
+import json
+import time
+import random
+
+from ursula_cli import utils
+
+LAST_RUN_FILE = '.ursula_last_run.json'
+RETRY_DELAY = 30
+RETRY_DELAY_MAX = 600
+
+
+def _path(environment):
+    return os.path.join(environment, LAST_RUN_FILE)
+
+
+def load(environment):
+    try:
+        with open(_path(environment)) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+def save(environment, playbook, rc, failures):
+    utils.atomic_write(_path(environment), json.dumps({
+        'playbook': os.path.normpath(playbook),
+        'finished': time.time(),
+        'rc': rc,
+        'failed': failures,
+    }, indent=2, sort_keys=True))
+
+
+def group_by_task(failures):
+    # hosts that failed on the same task are resumed by one ansible run;
+    # those without a task to start at (handlers, fact gathering, no task
+    # seen at all) are re-run from the start
+    groups = {}
+    for host, failure in failures.iteritems():
+        groups.setdefault(failure.get('task'), []).append(host)
+    return sorted((task, sorted(hosts)) for task, hosts in groups.iteritems())
+
+
+def retry_delay(attempt, base=RETRY_DELAY):
+    delay = min(RETRY_DELAY_MAX, base * (2 ** attempt))
+    return delay / 2.0 + random.uniform(0, delay / 2.0)
@@ -16,38 +16,91 @@
 #    License for the specific language governing permissions and limitations
 
 import os
+import re
+import imp
 import sys
+import copy
+import json
+import glob
+import errno
 import time
 import shutil
-import socket
 import logging
 import argparse
+import functools
 import subprocess
 from distutils.version import LooseVersion
 from ConfigParser import ConfigParser, NoOptionError, NoSectionError
 
-import yaml
-import ansible
-import paramiko
-from paramiko import BadHostKeyException, AuthenticationException, SSHException
-from paramiko import AutoAddPolicy
+from ursula_cli import adhoc
+from ursula_cli import aggregate
+from ursula_cli import daemon
+from ursula_cli import eventlog
+from ursula_cli import facts
+from ursula_cli import fingerprint
+from ursula_cli import heat
+from ursula_cli import history
+from ursula_cli import inventory
+from ursula_cli import output
+from ursula_cli import profiler
+from ursula_cli import resume
+from ursula_cli import ssh
+from ursula_cli import targets
+from ursula_cli import utils
 
 LOG = logging.getLogger(__name__)
 MINIMUM_ANSIBLE_VERSION = '1.9'
+VAGRANT_SSH_CONFIG_CONCURRENCY = None
+VAGRANT_SSH_CONFIG_TIMEOUT = 300
+INCREMENTAL_LIMIT_FILE = '.ursula_incremental'
+# ursula's event log, and its name when ansible.cfg sets a log_path
+EVENT_LOG_FILE = 'ursula.log'
+ANSIBLE_EVENT_LOG_FILE = 'ursula.events.log'
+# ansible options that prompt on the terminal
+PROMPT_FLAGS = ('--ask-pass', '--ask-become-pass', '--ask-sudo-pass',
+                '--ask-su-pass', '--ask-vault-pass')
+PROMPT_SHORT_FLAGS = re.compile(r'^-[a-zA-Z]*[kK][a-zA-Z]*$')
+# plays and tasks that read input
+PROMPT_KEYS = re.compile(r'^\s*(?:-\s+)?(?:vars_prompt|pause)\s*:',
+                         re.MULTILINE)
+# set once the installed ansible passed the version check, so daemon
+# workers don't check again
+_ANSIBLE_VERSION_CHECKED = False
+# the environment ursula was started with, commands are logged with only
+# what ursula changed in it
+_INHERITED_ENV = dict(os.environ)
 
 
 class OpenStackConfigurationError(Exception):
     pass
 
 
-def init_logfile():
+def _ansible_config(option, section='defaults'):
     config = ConfigParser()
     config.read('ansible.cfg')
 
     try:
-        cfg_log = config.get('defaults', 'log_path')
+        return config.get(section, option)
     except (NoOptionError, NoSectionError):
-        cfg_log = None
+        return None
+
+
+def _ansible_log_path():
+    return _ansible_config('log_path')
+
+
+def _ansible_host_key_checking(env=None):
+    if env is None:
+        env = os.environ
+    value = env.get('ANSIBLE_HOST_KEY_CHECKING',
+                    _ansible_config('host_key_checking'))
+    if value is None:
+        return True
+    return value.strip().lower() not in ('false', 'no', 'off', '0')
+
+
+def init_logfile():
+    cfg_log = _ansible_log_path()
 
     if cfg_log:
         logfile = os.path.expanduser(cfg_log)
@@ -58,68 +111,151 @@ def init_logfile():
         with open(logfile, 'a'):
             os.utime(logfile, None)
 
+    return logfile
+
+
+def _event_log_path():
+    # ansible writes plain text to its log_path and keeps it open, the events
+    # need a file of their own
+    if _ansible_log_path():
+        return ANSIBLE_EVENT_LOG_FILE
+    return EVENT_LOG_FILE
+
 
 def _initialize_logger(level=logging.DEBUG, logfile=None):
-    init_logfile()
-    global LOG
-    LOG.setLevel(level)
+    global _INHERITED_ENV
+    # a daemon worker sets up the invoking CLI's environment before this
+    _INHERITED_ENV = dict(os.environ)
+
+    # configure the package logger so ursula_cli.heat, ursula_cli.ssh, etc.
+    # log through the same handlers as this module
+    logger = logging.getLogger('ursula_cli')
+    logger.setLevel(logging.DEBUG)
 
     handler = logging.StreamHandler()
-    formatter = logging.Formatter("%(levelname)s: %(message)s")
-    handler.setFormatter(formatter)
-    LOG.addHandler(handler)
+    handler.setLevel(level)
+    handler.setFormatter(
+        eventlog.RedactingFormatter("%(levelname)s: %(message)s"))
+    logger.addHandler(handler)
+
+    # every event goes to the log file, whatever is shown on the console
+    if logfile is None:
+        init_logfile()
+        logfile = _event_log_path()
+    try:
+        events = eventlog.file_handler(logfile)
+    except (IOError, OSError) as e:
+        LOG.warn("Not writing the event log: %s", e)
+        return
+    logger.addHandler(events)
+    output_logger = logging.getLogger(eventlog.OUTPUT_LOGGER)
+    output_logger.propagate = False
+    output_logger.handlers = [events]
+
+
+def _log_command(command, env, **fields):
+    changed = eventlog.changed_env(env, _INHERITED_ENV)
+    LOG.debug("Running command: %s with environment changes: %s",
+              " ".join(command),
+              " ".join("%s=%s" % item for item in sorted(changed.items())),
+              extra=eventlog.event('command', command=command, env=changed,
+                                   **fields))
+
+
+def _ansible_version():
+    # read the version from the installed package instead of importing
+    # ansible, which only ever runs as a subprocess
+    try:
+        _, path, _ = imp.find_module('ansible')
+    except ImportError:
+        raise Exception("ansible is not installed, you may install it with "
+                        "'pip install -U -r requirements.txt'")
+
+    for name in ('release.py', '__init__.py'):
+        try:
+            with open(os.path.join(path, name)) as f:
+                match = re.search(r"^__version__\s*=\s*['\"]([^'\"]+)['\"]",
+                                  f.read(), re.MULTILINE)
+        except IOError:
+            continue
+        if match:
+            return match.group(1)
+
+    raise Exception("Unable to determine the installed ansible version")
 
 
 def _check_ansible_version():
-    version = ansible.__version__
+    global _ANSIBLE_VERSION_CHECKED
+    if _ANSIBLE_VERSION_CHECKED:
+        return
+    version = _ansible_version()
     if not LooseVersion(version) >= LooseVersion(MINIMUM_ANSIBLE_VERSION):
         raise Exception("You are using ansible-playbook '%s'. "
                         "Current required version is at least: '%s'. You may "
                         "install the correct version with 'pip install -U -r "
                         "requirements.txt'" % (
                             version, MINIMUM_ANSIBLE_VERSION))
+    _ANSIBLE_VERSION_CHECKED = True
 
 
-def _append_envvar(key, value):
-    if key in os.environ:
-        os.environ[key] = "%s %s" % (os.environ[key], value)
+def _append_envvar(key, value, env=None):
+    if env is None:
+        env = os.environ
+    if key in env:
+        env[key] = "%s %s" % (env[key], value)
     else:
-        _set_envvar(key, value)
+        _set_envvar(key, value, env)
 
 
-def _set_envvar(key, value):
-    os.environ[key] = value
+def _set_envvar(key, value, env=None):
+    if env is None:
+        env = os.environ
+    env[key] = value
 
 
-def _set_default_env():
+def _set_default_env(env=None, environment=None, fact_cache_ttl=0):
+    if env is None:
+        env = os.environ
     cm_path = os.path.expanduser('~/.ssh/controlmasters')
-    if not os.path.exists(cm_path):
+    try:
         os.makedirs(cm_path)
-
-    _set_envvar('PYTHONUNBUFFERED', '1')  # needed in order to stream output
-    _set_envvar('PYTHONIOENCODING', 'UTF-8')  # needed to handle stdin input
-    _set_envvar('ANSIBLE_FORCE_COLOR', 'yes')
-    _append_envvar('ANSIBLE_SSH_ARGS', '-o ControlMaster=auto')
+    except OSError as e:
+        # several environments may be setting up at once
+        if e.errno != errno.EEXIST:
+            raise
+
+    # needed in order to stream output
+    _set_envvar('PYTHONUNBUFFERED', '1', env)
+    # needed to handle stdin input
+    _set_envvar('PYTHONIOENCODING', 'UTF-8', env)
+    _set_envvar('ANSIBLE_FORCE_COLOR', 'yes', env)
+    _append_envvar('ANSIBLE_SSH_ARGS', '-o ControlMaster=auto', env)
     _append_envvar("ANSIBLE_SSH_ARGS",
-                   "-o ControlPath=~/.ssh/controlmasters/u-%r@%h:%p")
-    _append_envvar("ANSIBLE_SSH_ARGS", "-o ControlPersist=300")
-
-
-def test_ssh(host, user, key_file):
-    ssh = paramiko.SSHClient()
-    ssh.set_missing_host_key_policy(AutoAddPolicy())
-    try: 
-        ssh.connect(hostname=host, username=user, key_filename=key_file)
-        LOG.debug("Connect to {0} successfully".format(host))
-        return True
-    except (BadHostKeyException, AuthenticationException, 
-        SSHException, socket.error) as e:
-            LOG.debug(e)
-            LOG.debug("Connect to {0} failed. Retrying... ".format(host))
+                   "-o ControlPath=~/.ssh/controlmasters/u-%r@%h:%p", env)
+    _append_envvar("ANSIBLE_SSH_ARGS", "-o ControlPersist=300", env)
+
+    # keep the facts gathered by one run for the runs that follow, unless
+    # a fact cache is already configured
+    if not environment or not fact_cache_ttl:
+        return None
+    if 'ANSIBLE_CACHE_PLUGIN' in env or _ansible_config('fact_caching'):
+        LOG.debug("A fact cache is already configured, not managing one")
+        return None
+    fact_cache = facts.cache_dir(environment)
+    _set_envvar('ANSIBLE_CACHE_PLUGIN', 'jsonfile', env)
+    _set_envvar('ANSIBLE_CACHE_PLUGIN_CONNECTION', fact_cache, env)
+    _set_envvar('ANSIBLE_CACHE_PLUGIN_TIMEOUT', str(fact_cache_ttl), env)
+    if 'ANSIBLE_GATHERING' not in env and not _ansible_config('gathering'):
+        # only gather facts for hosts that have none cached
+        _set_envvar('ANSIBLE_GATHERING', 'smart', env)
+    return fact_cache
 
 
 def _run_ansible(inventory, playbook, user='root', module_path='./library',
-                 sudo=False, extra_args=[]):
+                 sudo=False, extra_args=[], callbacks=(), output_log=None,
+                 prefix=None, env=None):
+    if env is None:
+        env = os.environ
     command = [
         'ansible-playbook',
         '--inventory-file',
@@ -135,22 +271,18 @@ def _run_ansible(inventory, playbook, user='root', module_path='./library',
         command.extend(['--become', '--become-method', 'sudo'])
     command += extra_args
 
-    LOG.debug("Running command: %s with environment: %s",
-              " ".join(command), os.environ)
-    proc = subprocess.Popen(command, env=os.environ.copy(), shell=False,
+    _log_command(command, env)
+    proc = subprocess.Popen(command, env=env.copy(), shell=False,
                             stdout=subprocess.PIPE,
                             stderr=subprocess.STDOUT)
 
-    for line in iter(proc.stdout.readline, b''):
-        print line.rstrip()
+    return output.stream(proc, callbacks=callbacks, log=output_log,
+                         prefix=prefix)
 
-    proc.communicate()[0]
-    return proc.returncode
 
-
-def _run_module(inventory, module, module_args, module_hosts='all',
-                user='root', module_path='./library', sudo=False,
-                extra_args=[]):
+def _module_command(inventory, module, module_args, module_hosts='all',
+                    user='root', module_path='./library', sudo=False,
+                    extra_args=[]):
     command = [
         'ansible',
         module_hosts,
@@ -167,89 +299,435 @@ def _run_module(inventory, module, module_args, module_hosts='all',
     if sudo:
         command.extend(['--become', '--become-method', 'sudo'])
     command.extend(extra_args)
-    command.extend(["--args='{}'".format(module_args)])
+    command.extend(['--args', module_args])
+    return command
+
+
+def _run_module(inventory, module, module_args, module_hosts='all',
+                user='root', module_path='./library', sudo=False,
+                extra_args=[], callbacks=(), output_log=None, prefix=None,
+                json_output=False, aggregator=None, env=None):
+    if env is None:
+        env = os.environ
+    command = _module_command(inventory, module, module_args,
+                              module_hosts=module_hosts, user=user,
+                              module_path=module_path, sudo=sudo,
+                              extra_args=extra_args)
+    if aggregator is not None:
+        with open(os.devnull, 'w') as devnull:
+            rc = _run_module_aggregated(command, aggregator, devnull,
+                                        callbacks=callbacks,
+                                        output_log=output_log, env=env)
+        summary = aggregator.as_json() if json_output else \
+            aggregator.summary()
+        output.OutputStream(prefix=prefix).write(summary)
+        return rc
+
+    # ansible reads its configuration from the process environment as it is
+    # imported, so only a run using os.environ can happen in this process
+    if env is not os.environ or not adhoc.available():
+        if json_output:
+            LOG.warn("--ursula-json needs the in-process adhoc engine, "
+                     "printing ansible's output instead")
+        _log_command(command, env)
+        proc = subprocess.Popen(command, env=env.copy(), shell=False,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT)
+        return output.stream(proc, callbacks=callbacks, log=output_log,
+                             prefix=prefix)
 
-    LOG.debug("Running command: %s with environment: %s",
-              " ".join(command), os.environ)
-    proc = subprocess.Popen(" ".join(command), env=os.environ.copy(),
-                            shell=True,
+    LOG.debug("Running in process: %s", " ".join(command))
+    stream = output.OutputStream(prefix=prefix, callbacks=callbacks,
+                                 log=output_log)
+
+    def on_result(result):
+        stream.write(adhoc.format_result(result))
+
+    rc, results = adhoc.run(command, None if json_output else on_result)
+    if json_output:
+        stream.write(json.dumps(dict((r['host'], r) for r in results),
+                                indent=2, sort_keys=True))
+    return rc
+
+
+def _run_module_aggregated(command, aggregator, devnull, callbacks=(),
+                           output_log=None, env=None):
+    # every host's output still goes to the run log and line callbacks,
+    # only the screen shows the aggregate
+    quiet = output.OutputStream(out=devnull, callbacks=callbacks,
+                                log=output_log)
+    try:
+        if env is not os.environ or not adhoc.available():
+            results = aggregate.TextResults(aggregator)
+            _log_command(command, env)
+            proc = subprocess.Popen(command, env=env.copy(), shell=False,
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.STDOUT)
+            rc = output.stream(proc, out=devnull, log=output_log,
+                               callbacks=list(callbacks) + [results.feed])
+            results.finish()
+            return rc
+
+        def on_result(result):
+            quiet.write(adhoc.format_result(result))
+            aggregator.add_result(result)
+        return adhoc.run(command, on_result)[0]
+    finally:
+        aggregator.finish()
+
+
+def _pop_limit(extra_args):
+    limit = None
+    remaining = []
+    args = iter(extra_args)
+    for arg in args:
+        if arg in ('--limit', '-l'):
+            limit = next(args, None)
+        elif arg.startswith('--limit='):
+            limit = arg.split('=', 1)[1]
+        elif arg.startswith('-l') and not arg.startswith('--'):
+            limit = arg[2:]
+        else:
+            remaining.append(arg)
+    return limit, remaining
+
+
+def _exclude_hosts(extra_args, hosts):
+    # narrow the user's --limit (all hosts if none) rather than replacing it
+    limit, extra_args = _pop_limit(extra_args)
+    patterns = [limit or 'all'] + ['!%s' % host for host in hosts]
+    return extra_args + ['--limit', ':'.join(patterns)]
+
+
+def _check_host_patterns(inventory_file, args, extra_args):
+    # catch a typo in --limit or --module-hosts before ansible has loaded
+    # anything
+    limit, _ = _pop_limit(extra_args)
+    if not limit and not args.module:
+        return
+    module_hosts = args.module_hosts or 'all'
+    try:
+        index = inventory.load_index(inventory_file)
+        limit_hosts = index.resolve(limit) if limit else None
+        module_matches = None
+        if args.module:
+            module_matches = index.resolve(module_hosts, subset=limit)
+    except inventory.InventoryError as e:
+        LOG.warn("Unable to index %s, leaving host patterns to ansible: %s",
+                 inventory_file, e)
+        return
+
+    if limit and not limit_hosts:
+        raise Exception("--limit '%s' matches no hosts in %s"
+                        % (limit, inventory_file))
+    if args.module and not module_matches:
+        raise Exception("--module-hosts '%s' matches no hosts in %s%s"
+                        % (module_hosts, inventory_file,
+                           " within --limit '%s'" % limit if limit else ""))
+
+
+def _warm_control_masters(inventory_file, user, pattern='all', subset=None,
+                          concurrency=ssh.WARM_CONCURRENCY, env=None):
+    if env is None:
+        env = os.environ
+    connections = inventory.host_connections(inventory_file, pattern,
+                                             subset=subset)
+    if not connections:
+        return [], []
+    LOG.info("Opening SSH control masters to %d hosts", len(connections))
+    unreachable = ssh.warm_control_masters(
+        connections, env.get('ANSIBLE_SSH_ARGS', ''), user,
+        concurrency=concurrency,
+        host_key_checking=_ansible_host_key_checking(env), env=env)
+    return connections, unreachable
+
+
+def _roles_path():
+    return [p for p in (_ansible_config('roles_path') or '').split(
+        os.pathsep) if p]
+
+
+def _has_tags(extra_args):
+    return any(arg in ('--tags', '-t') or arg.startswith('--tags=') or
+               (arg.startswith('-t') and not arg.startswith('--'))
+               for arg in extra_args)
+
+
+def _changed_tags(args, extra_args):
+    # the tags of the roles and plays the files changed since
+    # --ursula-changed's revision affect
+    environment = os.path.abspath(args.environment)
+    logs = [os.path.abspath(_event_log_path())]
+    if _ansible_log_path():
+        logs.append(os.path.abspath(os.path.expanduser(_ansible_log_path())))
+    changed = []
+    for path in targets.changed_files(args.ursula_changed):
+        # what ursula and the provisioners keep in the environment is not
+        # something the playbook reads
+        name = os.path.relpath(path, environment).split(os.sep)[0]
+        if path.startswith(environment + os.sep) and (
+                name.startswith('.') or
+                name in (EVENT_LOG_FILE, ANSIBLE_EVENT_LOG_FILE)):
+            continue
+        # nor are the logs (rotated ones too) and retry files of runs
+        if path.endswith('.retry') or any(
+                path == log or path.startswith(log + '.') for log in logs):
+            continue
+        changed.append(path)
+    index = targets.load_index(args.environment, args.playbook,
+                               _roles_path())
+    tags = targets.select_tags(
+        index, changed, args.playbook,
+        shared=[args.environment] + list(
+            fingerprint.extra_vars_files(extra_args)),
+        roles_path=_roles_path())
+    if tags:
+        LOG.info("%d files changed since %s, running tags %s", len(changed),
+                 args.ursula_changed, ",".join(tags))
+    return tags
+
+
+def _syntax_check(inventory_file, args, extra_args, output_log=None,
+                  prefix=None, env=None):
+    # --ursula-test, showing the last result again instead if it passed and
+    # nothing it covers changed since
+    try:
+        key = targets.syntax_check_key(
+            args.environment, args.playbook, inventory_file,
+            extra_args + [args.ursula_user, str(args.ursula_sudo)],
+            _roles_path(), _ansible_version())
+    except Exception as e:
+        LOG.debug("Not caching the syntax check: %s", e)
+        key = None
+    if key and not args.ursula_full:
+        cached = targets.cached_syntax_check(args.environment, args.playbook,
+                                             key)
+        if cached is not None:
+            output.OutputStream(prefix=prefix, log=output_log).write(cached)
+            LOG.info("Nothing changed since the syntax check passed, use "
+                     "--ursula-full to run it anyway")
+            return 0
+
+    lines = []
+    rc = _run_ansible(inventory_file, args.playbook, extra_args=extra_args,
+                      user=args.ursula_user, sudo=args.ursula_sudo,
+                      callbacks=[lines.append], output_log=output_log,
+                      prefix=prefix, env=env)
+    if key and not rc:
+        targets.save_syntax_check(args.environment, args.playbook, key,
+                                  "\n".join(lines))
+    return rc
+
+
+def _incremental_hosts(inventory_file, args, extra_args):
+    # fingerprints of every host the playbook targets, and those among
+    # them that changed since their last successful run (None for a full
+    # run)
+    limit, remaining = _pop_limit(extra_args)
+    index = inventory.load_index(inventory_file)
+    run_args = remaining + [args.ursula_user, str(args.ursula_sudo)]
+    fingerprints = fingerprint.host_fingerprints(
+        args.playbook, index, run_args, _roles_path(), subset=limit)
+    if args.ursula_full:
+        return fingerprints, None
+
+    stored = fingerprint.load(args.environment, args.playbook)
+    changed = fingerprint.changed_hosts(
+        fingerprints, stored, [h for h in index.hosts if h in fingerprints])
+    LOG.info("%d of %d hosts changed since their last successful run",
+             len(changed), len(fingerprints))
+    return fingerprints, changed
+
+
+def _playbook_uses_run_once(playbook):
+    # run_once (and anything else that expects to see the whole inventory
+    # from a single process) would run once per shard
+    pattern = re.compile(r'^\s*-?\s*run_once\s*:\s*(yes|true|1)\b',
+                         re.MULTILINE | re.IGNORECASE)
+    paths = [playbook]
+    roles_path = os.path.join(os.path.dirname(os.path.abspath(playbook)),
+                              'roles')
+    for root, _, files in os.walk(roles_path):
+        paths.extend(os.path.join(root, name) for name in files
+                     if name.endswith(('.yml', '.yaml')))
+    for path in paths:
+        with open(path) as f:
+            if pattern.search(f.read()):
+                LOG.debug("%s uses run_once", path)
+                return True
+    return False
+
+
+def _run_sharded(inventory_file, playbook, shards, environment,
+                 by_group=False, user='root', sudo=False, extra_args=[],
+                 output_log=None, prefix=None, recap=None, env=None):
+    if _playbook_uses_run_once(playbook):
+        LOG.warn("%s uses run_once, which would run once per shard; "
+                 "running unsharded" % playbook)
+        return _run_ansible(inventory_file, playbook, user=user, sudo=sudo,
+                            extra_args=extra_args,
+                            callbacks=[recap.feed] if recap else [],
+                            output_log=output_log, prefix=prefix, env=env)
+
+    # our own --limit selects each shard, so fold the user's into it
+    limit, extra_args = _pop_limit(extra_args)
+    if by_group:
+        partitions = inventory.partition_groups(
+            inventory.host_groups(inventory_file, subset=limit), shards)
+    else:
+        partitions = inventory.partition_hosts(
+            inventory.list_hosts(inventory_file, subset=limit), shards)
+    if not partitions:
+        raise Exception("No hosts in %s match --limit %s"
+                        % (inventory_file, limit))
+    count = len(partitions)
+
+    def run_shard(index):
+        limit_file = os.path.abspath(
+            os.path.join(environment, '.ursula_shard_%d' % index))
+        utils.atomic_write(limit_file, "\n".join(partitions[index]) + "\n")
+        shard_args = extra_args + [
+            '--limit', '@%s' % limit_file,
+            '--extra-vars', 'ursula_shard=%d ursula_shards=%d'
+            % (index, count),
+        ]
+        shard_recap = profiler.FailureTracker()
+        try:
+            rc = _run_ansible(inventory_file, playbook, user=user, sudo=sudo,
+                              extra_args=shard_args,
+                              callbacks=[shard_recap.feed],
+                              output_log=output_log, env=env,
+                              prefix="%s[shard %d/%d] " % (
+                                  prefix or "", index + 1, count))
+        finally:
+            os.unlink(limit_file)
+        return rc, shard_recap
+
+    results = utils.parallel_map(run_shard, range(count), count)
+
+    summary = ["Shard summary:"]
+    failed = []
+    unreachable = []
+    for index, (rc, shard_recap) in enumerate(results):
+        summary.append("  shard %d/%d: rc=%d, %d hosts" % (
+            index + 1, count, rc, len(partitions[index])))
+        failed.extend(shard_recap.failed())
+        unreachable.extend(shard_recap.unreachable())
+        if recap is not None:
+            recap.merge(shard_recap)
+    if failed:
+        summary.append("Failed hosts: %s" % ", ".join(sorted(failed)))
+    if unreachable:
+        summary.append("Unreachable hosts: %s"
+                       % ", ".join(sorted(unreachable)))
+    output.OutputStream(prefix=prefix, log=output_log).write(
+        "\n".join(summary))
+
+    # a shard killed by a signal has a negative rc
+    return next((rc for rc, _ in results if rc), 0)
+
+
+def _vagrant_box_ssh_config(box, env=None):
+    if env is None:
+        env = os.environ
+    command = [
+        'vagrant',
+        'ssh-config',
+        box
+    ]
+    proc = subprocess.Popen(command, env=env.copy(),
+                            shell=False,
                             stdout=subprocess.PIPE,
                             stderr=subprocess.STDOUT)
+    ssh_config = proc.communicate()[0]
+
+    if 'not yet ready for SSH' in ssh_config:
+        return None
+    if proc.returncode:
+        raise Exception("Failed to get SSH config for %s: %s"
+                        % (box, ssh_config.strip()))
 
-    for line in iter(proc.stdout.readline, b''):
-        print line.rstrip()
+    return "".join("%s\n" % line.rstrip() for line in ssh_config.splitlines())
 
-    proc.communicate()[0]
-    return proc.returncode
 
+def _wait_vagrant_box_ssh_config(box, timeout=VAGRANT_SSH_CONFIG_TIMEOUT,
+                                 env=None):
+    deadline = time.time() + timeout
+    delay = 2
+    while True:
+        config = _vagrant_box_ssh_config(box, env)
+        if config is not None:
+            return config
 
-def _vagrant_ssh_config(environment, boxes):
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise Exception("Timed out waiting for Vagrant to be ready for "
+                            "SSH on %s" % box)
+        LOG.debug("waiting for Vagrant to be ready for SSH on %s", box)
+        time.sleep(min(delay, remaining))
+        delay = min(delay * 2, 15)
+
+
+def _write_vagrant_ssh_config(environment, boxes, configs, env=None):
     rel_ssh_config_file = os.path.join(environment, ".ssh_config")
     ssh_config_file = os.path.abspath(rel_ssh_config_file)
-    f = open(ssh_config_file, 'w')
-    for box in boxes:
-        command = [
-            'vagrant',
-            'ssh-config',
-            box
-        ]
-        proc = subprocess.Popen(command, env=os.environ.copy(),
-                                shell=False,
-                                stdout=subprocess.PIPE,
-                                stderr=subprocess.STDOUT)
 
-        for line in iter(proc.stdout.readline, b''):
-            f.write("%s\n" % line.rstrip())
+    utils.atomic_write(ssh_config_file,
+                       "".join(configs[box] for box in boxes))
 
-        if proc.returncode:
-            raise Exception("Failed to write SSH config to %s"
-                            % (ssh_config_file))
+    _append_envvar("ANSIBLE_SSH_ARGS", "-F %s" % ssh_config_file, env)
 
-    f.close()
 
-    if 'not yet ready for SSH' in open(ssh_config_file).read():
-        LOG.debug("waiting for Vagrant to be ready for SSH")
-        time.sleep(5)
-        _vagrant_ssh_config(environment, boxes)
-
-    _append_envvar("ANSIBLE_SSH_ARGS", "-F %s" % ssh_config_file)
+def _vagrant_ssh_config(environment, boxes,
+                        concurrency=VAGRANT_SSH_CONFIG_CONCURRENCY, env=None):
+    if concurrency is None:
+        concurrency = utils.cpu_count()
+    # boxes that are not ready for SSH yet are retried on their own, while
+    # the others are already done
+    wait = functools.partial(_wait_vagrant_box_ssh_config, env=env)
+    results = utils.parallel_map(wait, boxes, concurrency)
+    _write_vagrant_ssh_config(environment, boxes, dict(zip(boxes, results)),
+                              env)
 
     return 0
 
 
-def _ssh_add(keyfile):
+def _ssh_add(keyfile, env=None):
+    if env is None:
+        env = os.environ
     command = ["ssh-add", keyfile]
-    proc = subprocess.Popen(command, env=os.environ.copy(),
+    proc = subprocess.Popen(command, env=env.copy(),
                             shell=False,
                             stdout=subprocess.PIPE,
                             stderr=subprocess.STDOUT)
+    proc.communicate()
 
     if proc.returncode:
         raise Exception(
-            "Failed to run %s with environment: %s"
-            % (" ".join(command), os.environ)
+            "Failed to run %s" % " ".join(command)
         )
 
 
-def _run_heat(args, hot):
+def _run_heat(args, hot, env=None, record=None):
+    if env is None:
+        env = os.environ
     try:
         from heatclient.common import utils
-        from heatclient.client import Client as Heat_Client
-        from keystoneclient.v3 import Client as Keystone_Client
+        import keystoneclient.v3  # noqa
     except ImportError as e:
         LOG.error("You must have python-heatclient in your python path")
         raise Exception(e)
 
     CREDS = {
-        'username': os.environ.get('OS_USERNAME'),
-        'password': os.environ.get('OS_PASSWORD'),
-        'tenant_name': os.environ.get(
-            'OS_TENANT_NAME', os.environ.get('OS_PROJECT_NAME')
+        'username': env.get('OS_USERNAME'),
+        'password': env.get('OS_PASSWORD'),
+        'tenant_name': env.get(
+            'OS_TENANT_NAME', env.get('OS_PROJECT_NAME')
         ),
-        'project_name': os.environ.get(
-            'OS_TENANT_NAME', os.environ.get('OS_PROJECT_NAME')
+        'project_name': env.get(
+            'OS_TENANT_NAME', env.get('OS_PROJECT_NAME')
         ),
-        'auth_url': os.environ.get('OS_AUTH_URL'),
+        'auth_url': env.get('OS_AUTH_URL'),
     }
 
     ex_msg = (
@@ -278,123 +756,131 @@ def _run_heat(args, hot):
 
     LOG.debug("Logging into heat")
 
-    ks_client = Keystone_Client(**CREDS)
-    heat_endpoint = ks_client.service_catalog.url_for(
-        service_type='orchestration', endpoint_type='publicURL')
-    heatclient = Heat_Client('1', heat_endpoint, token=ks_client.auth_token)
+    heatclient = heat.HeatClient(CREDS)
 
-    try:
-        LOG.debug("Checking for existence of heat stack: %s" % stack_name)
-        heatclient.stacks.get(stack_name)
-        stack_exists = True
+    fingerprint = heat.stack_fingerprint(STACK)
+    cache = heat.load_cache(args.environment)
+
+    LOG.debug("Checking for existence of heat stack: %s" % stack_name)
+    existing = heat.find_stack(heatclient, stack_name)
+    outputs = None
+    if existing is not None:
         LOG.debug("Already exists")
-    except Exception as e:
-        if e.code == 404:
-            stack_exists = False
-        else:
-            raise Exception(e)
+        if existing.status == 'COMPLETE':
+            outputs = heat.cached_outputs(cache, fingerprint, existing)
 
     stack_action = 'create'
-
-    if stack_exists and args.heat_stack_update:
+    stack = existing
+
+    if outputs is not None:
+        # either no update was requested, or the template, parameters and
+        # stack name all match the last deploy
+        LOG.info("Stack %s is unchanged since the last deploy, using cached "
+                 "outputs" % stack_name)
+        stack_action = None
+    elif existing is not None and args.heat_stack_update:
         stack_action = 'update'
+        marker = heat.latest_event_id(heatclient, stack_name)
         LOG.debug("Updating stack")
         heatclient.stacks.update(stack_name, **STACK)
-        time.sleep(5)
-    elif not stack_exists:
+        stack = heat.wait_for_stack(heatclient, stack_name, stack_action,
+                                    marker)
+    elif existing is None:
         LOG.debug("Creating stack")
         heatclient.stacks.create(**STACK)
-        time.sleep(5)
-
-    while heatclient.stacks.get(stack_name).status == 'IN_PROGRESS':
-        LOG.debug("Waiting on stack...")
-        time.sleep(5)
-
-    stack = heatclient.stacks.get(stack_name)
-    if stack.status != 'COMPLETE':
-        raise Exception("stack %s returned an unexpected status (%s)" %
-                        (stack_name, stack.status))
-
-    LOG.debug("Stack %sd!" % stack_action)
-
-    servers = {}
-    floating_ip = None
-    private_key = None
-    for output in stack.outputs:
-        if output['output_key'] == "floating_ip":
-            floating_ip = output['output_value']
-            LOG.debug("floating_ip : %s" % floating_ip)
-        elif output['output_key'] == "private_key":
-            private_key = output['output_value']
+        stack = heat.wait_for_stack(heatclient, stack_name, stack_action)
+    else:
+        stack_action = None
+        if existing.status == 'IN_PROGRESS':
+            LOG.debug("Waiting on stack...")
+            marker = heat.latest_event_id(heatclient, stack_name)
+            stack = heat.wait_for_stack(heatclient, stack_name,
+                                        existing.action, marker)
         else:
-            servers[output['output_key']] = output['output_value']
-            LOG.debug("server : %s (%s) " %
-                      (output['output_key'], output['output_value']))
-
-    ssh_config = """
-Host *
-  User {user}
-  ForwardAgent yes
-  UserKnownHostsFile /dev/null
-  StrictHostKeyChecking no
-  PasswordAuthentication no
-""".format(user=args.ursula_user)
-
-    ssh_key_path = os.path.join(args.environment, ".ssh_key")
-    ssh_config_path = os.path.join(args.environment, ".ssh_config")
-
-    # write out private key if using one generated by heat
-    if private_key:
-        ssh_config += "  IdentityFile " + ssh_key_path
-        LOG.debug("writing ssh_key to %s" % ssh_key_path)
-        with open(ssh_key_path, "w") as text_file:
-            text_file.write(private_key)
-        os.chmod(ssh_key_path, 0600)
-        _ssh_add(ssh_key_path)
-    LOG.debug("writing ssh_config to %s" % ssh_config_path)
-    with open(ssh_config_path, "w") as text_file:
-        text_file.write(ssh_config)
-
-    if floating_ip:
-        ssh_config_pre = """
-Host floating_ip
-  Hostname {floating_ip}
-"""
-        ssh_config = ssh_config_pre.format(floating_ip=floating_ip)
-        with open(ssh_config_path, "a") as text_file:
-            text_file.write(ssh_config)
-
-    for server, ip in servers.iteritems():
-        test_ip = ip
-        ssh_config_pre = """
-Host {server}
-  Hostname {ip}
-"""
-        if floating_ip:
-            ssh_config_pre += ("  ProxyCommand ssh -W %h:%p -o StrictHostKeyChecking=no"
-                               " {user}@{floating_ip}\n\n")
-        ssh_config = ssh_config_pre.format(
-            server=server, ip=ip, user=args.ursula_user, floating_ip=floating_ip)
-        with open(ssh_config_path, "a") as text_file:
-            text_file.write(ssh_config)
+            stack = heatclient.stacks.get(stack_name)
 
+    # a rolled back stack is complete, but not with what was asked for
+    if stack.status != 'COMPLETE' or (stack_action and
+                                      stack.action == 'ROLLBACK'):
+        raise Exception("stack %s returned an unexpected status (%s)" %
+                        (stack_name, stack.stack_status))
+
+    if stack_action:
+        LOG.debug("Stack %sd!" % stack_action)
+        # the servers may have been replaced
+        cleared = facts.clear(facts.cache_dir(args.environment))
+        if cleared:
+            LOG.info("Dropped the cached facts of %d hosts", len(cleared))
+        outputs = stack.outputs
+        heat.save_cache(args.environment, fingerprint, stack, outputs)
+    elif outputs is None:
+        outputs = stack.outputs
+
+    static_inventory = os.path.join(args.environment, 'hosts')
+    servers, floating_ip, key_file = heat.write_environment(
+        args.environment, outputs, args.ursula_user,
+        static_inventory=static_inventory)
+    LOG.debug("Stack %s has %d servers%s", stack_name, len(servers),
+              " behind %s" % floating_ip if floating_ip else "")
+    if key_file:
+        _ssh_add(key_file, env)
+
+    ssh_config_path = os.path.join(args.environment, heat.SSH_CONFIG_FILE)
     ansible_ssh_config_file = os.path.abspath(ssh_config_path)
     if os.path.isfile(ansible_ssh_config_file):
-        _append_envvar("ANSIBLE_SSH_ARGS", "-F %s" % ansible_ssh_config_file)
+        _append_envvar("ANSIBLE_SSH_ARGS", "-F %s" % ansible_ssh_config_file,
+                       env)
 
     LOG.debug("waiting for SSH connectivity...")
- 
-    user = args.ursula_user
-    
-    if floating_ip:
-        while not test_ssh(floating_ip, user, ssh_key_path):
-            LOG.debug("waiting for SSH connectivity...")
-            time.sleep(5)
-    else:        
-        for ip in servers.itervalues():
-            while not test_ssh(str(ip), user, ssh_key_path):
-                LOG.debug("waiting for {} SSH connectivity...".format(ip))
-                time.sleep(5)
+    with history.phase(record, 'ssh_wait'):
+        _wait_heat_ssh(args, servers, floating_ip,
+                       os.path.join(args.environment, heat.SSH_KEY_FILE))
+
+
+def _wait_heat_ssh(args, servers, floating_ip, ssh_key_path):
+    key_file = None
+    if os.path.isfile(ssh_key_path):
+        key_file = ssh_key_path
+    probe = functools.partial(ssh.probe_host, user=args.ursula_user,
+                              key_file=key_file)
+
+    deadline = time.time() + args.ursula_ssh_timeout
+    server_ips = [str(ip) for ip in servers.itervalues()]
+    if not floating_ip:
+        ssh.wait_for_ssh(server_ips, probe,
+                         concurrency=args.ursula_ssh_concurrency,
+                         timeout=args.ursula_ssh_timeout)
+        return
+
+    ssh.wait_for_ssh([floating_ip], probe, timeout=args.ursula_ssh_timeout)
+    if args.heat_probe_servers:
+        bastion = ssh.BastionProbe(floating_ip, args.ursula_user,
+                                   key_file=key_file)
+        try:
+            ssh.wait_for_ssh(server_ips, bastion,
+                             concurrency=args.ursula_ssh_concurrency,
+                             timeout=max(1, deadline - time.time()))
+        finally:
+            bastion.close()
+
+
+def _clear_recreated_facts(fact_cache):
+    # vagrant writes a machine's id when it creates it, facts cached before
+    # that are from a VM that is gone
+    stale = []
+    for path in glob.glob(os.path.join('.vagrant', 'machines', '*', '*',
+                                       'id')):
+        vm = path.split(os.sep)[-3]
+        try:
+            if (os.stat(os.path.join(fact_cache, vm)).st_mtime <
+                    os.stat(path).st_mtime):
+                stale.append(vm)
+        except OSError:
+            continue
+    cleared = facts.clear(fact_cache, stale)
+    if cleared:
+        LOG.info("Dropped the cached facts of recreated VMs: %s",
+                 ", ".join(sorted(cleared)))
 
 
 def _vagrant_copy_yml(environment):
@@ -403,66 +889,108 @@ def _vagrant_copy_yml(environment):
     shutil.copy2(src, dest)
 
 
-def _run_vagrant(environment):
+def _vagrant_up(vm, output_log=None, env=None):
+    if env is None:
+        env = os.environ
+    command = [
+        'vagrant',
+        'up',
+        '--no-provision',
+        vm,
+    ]
+    proc = subprocess.Popen(command, env=env.copy(),
+                            shell=False,
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT)
+
+    rc = output.stream(proc, prefix="[%s] " % vm, log=output_log)
+    if rc:
+        return rc, None
+
+    # fetch this VM's ssh config now rather than waiting for the slowest VM
+    # to finish booting
+    return 0, _wait_vagrant_box_ssh_config(vm, env=env)
+
+
+def _run_vagrant_parallel(environment, vms, concurrency, output_log=None,
+                          env=None):
+    def boot(vm):
+        try:
+            return _vagrant_up(vm, output_log, env)
+        except Exception as e:
+            LOG.error("%s: %s", vm, e)
+            return -1, None
+
+    results = dict(zip(vms, utils.parallel_map(boot, vms, concurrency)))
+
+    failed = sorted(vm for vm, (rc, _) in results.iteritems() if rc)
+    for vm in failed:
+        LOG.error("%s: vagrant up failed (rc=%s)", vm, results[vm][0])
+    if failed:
+        raise Exception("Failed to boot: %s" % ", ".join(failed))
+
+    configs = dict((vm, config) for vm, (_, config) in results.iteritems())
+    _write_vagrant_ssh_config(environment, vms, configs, env)
+
+
+def _run_vagrant(environment, concurrency=1, output_log=None, env=None,
+                 record=None):
+    import yaml
+
+    if env is None:
+        env = os.environ
     vagrant_config_file = "%s/vagrant.yml" % environment
 
     if os.path.isfile(vagrant_config_file):
-        _set_envvar("SETTINGS_FILE", vagrant_config_file)
+        _set_envvar("SETTINGS_FILE", vagrant_config_file, env)
         vagrant_config = yaml.load(open(vagrant_config_file, 'r'))
     else:
         vagrant_config = yaml.load(open('vagrant.yml', 'r'))
 
     vms = vagrant_config['vms'].keys()
 
+    if concurrency > 1:
+        _run_vagrant_parallel(environment, vms, concurrency, output_log, env)
+        _print_vagrant_banner(vagrant_config_file)
+        return 0
+
     command = [
         'vagrant',
         'up',
         '--no-provision',
     ] + vagrant_config['vms'].keys()
 
-    LOG.debug("Running command: %s\nEnvs:%s", " ".join(command), os.environ)
-    proc = subprocess.Popen(command, env=os.environ.copy(),
+    _log_command(command, env)
+    proc = subprocess.Popen(command, env=env.copy(),
                             shell=False,
                             stdout=subprocess.PIPE,
                             stderr=subprocess.STDOUT)
 
-    for line in iter(proc.stdout.readline, b''):
-        print line.rstrip()
-
-    if proc.returncode:
+    if output.stream(proc, log=output_log):
         raise Exception(
-            "Failed to run %s with environment: %s"
-            % (" ".join(command), os.environ)
+            "Failed to run %s" % " ".join(command)
         )
 
     else:
-        print "**************************************************"
-        print "Ursula <3 Vagrant"
-        print "To interact with your environment via Vagrant set:"
-        print "$ export SETTINGS_FILE=%s" % vagrant_config_file
-        print "**************************************************"
+        _print_vagrant_banner(vagrant_config_file)
 
-        rc = _vagrant_ssh_config(environment, vms)
+        with history.phase(record, 'ssh_wait'):
+            rc = _vagrant_ssh_config(environment, vms, env=env)
         if rc:
             return rc
 
     return 0
 
 
-def run(args, extra_args):
-    _set_default_env()
-
-    if not os.path.exists(args.environment):
-        raise Exception("Environment '%s' does not exist" % args.environment)
-
-    args.environment = args.environment.rstrip('/').rstrip('\\')
+def _print_vagrant_banner(vagrant_config_file):
+    print "**************************************************"
+    print "Ursula <3 Vagrant"
+    print "To interact with your environment via Vagrant set:"
+    print "$ export SETTINGS_FILE=%s" % vagrant_config_file
+    print "**************************************************"
 
-    _set_envvar('URSULA_ENV', os.path.abspath(args.environment))
-
-    inventory = os.path.join(args.environment, 'hosts')
-    if not os.path.exists(inventory) or not os.path.isfile(inventory):
-        raise Exception("Inventory file '%s' does not exist" % inventory)
 
+def _set_ssh_config_env(args, env=None):
     if args.ursula_ssh_config:
         rel_ansible_ssh_config_file = args.ursula_ssh_config
     else:
@@ -470,10 +998,120 @@ def run(args, extra_args):
                                                    'ssh_config')
     ansible_ssh_config_file = os.path.abspath(rel_ansible_ssh_config_file)
     if os.path.isfile(ansible_ssh_config_file):
-        _append_envvar("ANSIBLE_SSH_ARGS", "-F %s" % ansible_ssh_config_file)
+        _append_envvar("ANSIBLE_SSH_ARGS", "-F %s" % ansible_ssh_config_file,
+                       env)
 
     if args.ursula_forward:
-        _append_envvar("ANSIBLE_SSH_ARGS", "-o ForwardAgent=yes")
+        _append_envvar("ANSIBLE_SSH_ARGS", "-o ForwardAgent=yes", env)
+
+
+def _open_output_log(args):
+    if not args.ursula_log_output:
+        return None
+    if _ansible_log_path():
+        # ansible already writes its own output to the configured log_path
+        LOG.debug("ansible.cfg sets log_path, not copying output to it")
+        return None
+    return eventlog.OutputLog(strip_color=not args.ursula_log_color)
+
+
+def run(args, extra_args, env=None):
+    output_log = _open_output_log(args)
+    try:
+        return _run_recorded(args, extra_args, output_log=output_log,
+                             env=env)
+    finally:
+        if output_log:
+            output_log.close()
+
+
+def _run_recorded(args, extra_args, output_log=None, prefix=None,
+                  env=None):
+    if args.ursula_test:
+        kind, target = 'test', os.path.normpath(args.playbook)
+    elif args.module or args.adhoc:
+        kind, target = 'module', args.module or 'shell'
+    else:
+        kind, target = 'playbook', os.path.normpath(args.playbook)
+    environment = args.environment.rstrip('/').rstrip('\\')
+    fields = dict(kind=kind, target=target, environment=environment,
+                  provisioner=args.provisioner)
+    LOG.debug("Starting %s %s in %s", kind, target, environment,
+              extra=eventlog.event('run_start', **fields))
+    record = None
+    if not args.ursula_no_history:
+        record = history.RunRecord(environment, kind, target,
+                                   args.provisioner)
+    started = time.time()
+    rc = None
+    try:
+        rc = _run(args, extra_args, output_log=output_log, prefix=prefix,
+                  env=env, record=record)
+        return rc
+    finally:
+        duration = time.time() - started
+        LOG.debug("Finished %s %s in %s with %s after %s", kind, target,
+                  environment, rc, utils.format_duration(duration),
+                  extra=eventlog.event(
+                      'run_end', rc=rc, duration=duration,
+                      hosts=record and record.hosts,
+                      phases=record and record.phases, **fields))
+        if record is not None:
+            _save_history(record, rc, prefix)
+
+
+def _save_history(record, rc, prefix=None):
+    # the history is a convenience, it never fails a run
+    try:
+        run = history.save(record, rc)
+    except Exception as e:
+        LOG.warn("Unable to record the run in %s: %s", history.HISTORY_PATH,
+                 e)
+        return
+    if run['slow']:
+        LOG.warn("%sThis run took %s, %.1fx the usual %s for %s in %s",
+                 prefix or "", utils.format_duration(run['duration']),
+                 run['duration'] / run['baseline'],
+                 utils.format_duration(run['baseline']), record.target,
+                 record.environment)
+
+
+def _run(args, extra_args, output_log=None, prefix=None, env=None,
+         record=None):
+    try:
+        return _run_environment(args, extra_args, output_log=output_log,
+                                prefix=prefix, env=env, record=record)
+    finally:
+        # the hosts an incremental run was limited to
+        limit_file = os.path.join(args.environment, INCREMENTAL_LIMIT_FILE)
+        if os.path.exists(limit_file):
+            os.unlink(limit_file)
+
+
+def _run_environment(args, extra_args, output_log=None, prefix=None,
+                     env=None, record=None):
+    if env is None:
+        env = os.environ
+
+    if not os.path.exists(args.environment):
+        raise Exception("Environment '%s' does not exist" % args.environment)
+
+    args.environment = args.environment.rstrip('/').rstrip('\\')
+
+    fact_cache = _set_default_env(env, args.environment,
+                                  args.ursula_fact_cache_ttl)
+
+    _set_envvar('URSULA_ENV', os.path.abspath(args.environment), env)
+
+    inventory = os.path.join(args.environment, 'hosts')
+    # the inventory generated from the stack only exists once it is
+    # provisioned
+    heat_inventory = args.provisioner == 'heat' and (
+        args.heat_inventory or not os.path.isfile(inventory))
+    if not heat_inventory and not os.path.isfile(inventory):
+        raise Exception("Inventory file '%s' does not exist" % inventory)
+
+    _set_ssh_config_env(args, env)
 
     if args.ursula_test:
         extra_args += ['--syntax-check', '--list-tasks']
@@ -482,7 +1120,12 @@ def run(args, extra_args):
         if os.path.exists('envs/example/vagrant.yml'):
             if os.path.isfile('envs/example/vagrant.yml'):
                 extra_args += ['--extra-vars', '@envs/example/vagrant.yml']
-        rc = _run_vagrant(environment=args.environment)
+        with history.phase(record, 'provision'):
+            rc = _run_vagrant(environment=args.environment,
+                              concurrency=args.vagrant_concurrency,
+                              output_log=output_log, env=env, record=record)
+        if fact_cache:
+            _clear_recreated_facts(fact_cache)
         if rc:
             return rc
         _vagrant_copy_yml(args.environment)
@@ -500,9 +1143,12 @@ def run(args, extra_args):
         heat_extra_args = "%s/vars_heat.yml" % args.environment
         if os.path.exists(heat_extra_args) and os.path.isfile(heat_extra_args):
             extra_args += ['--extra-vars', '@%s' % heat_extra_args]
-        rc = _run_heat(args=args, hot=hot)
+        with history.phase(record, 'provision'):
+            rc = _run_heat(args=args, hot=hot, env=env, record=record)
         if rc:
             return rc
+        if heat_inventory:
+            inventory = heat.inventory_path(args.environment)
         if not args.ursula_user:
             args.ursula_user = "ubuntu"
         if not args.ursula_sudo:
@@ -513,24 +1159,417 @@ def run(args, extra_args):
     if args.adhoc:
         args.module = "shell"
         args.module_args = args.adhoc
+    _check_host_patterns(inventory, args, extra_args)
+    playbook_run = not args.module and not args.ursula_test
+    if args.ursula_resume and playbook_run:
+        with history.phase(record, 'ansible'):
+            return _resume_last_run(inventory, args, extra_args,
+                                    output_log=output_log, prefix=prefix,
+                                    env=env)
+    # what is printed here belongs to this environment's output, which may be
+    # one of several running at once
+    stream = output.OutputStream(prefix=prefix, log=output_log)
+    fingerprints = None
+    if (args.ursula_incremental or args.ursula_full) and playbook_run:
+        fingerprints, changed = _incremental_hosts(inventory, args,
+                                                   extra_args)
+        if changed == []:
+            stream.write("Nothing changed since the last successful run, "
+                         "use --ursula-full to run anyway")
+            return 0
+        if changed:
+            limit_file = os.path.abspath(
+                os.path.join(args.environment, INCREMENTAL_LIMIT_FILE))
+            utils.atomic_write(limit_file, "\n".join(changed) + "\n")
+            _, extra_args = _pop_limit(extra_args)
+            extra_args += ['--limit', '@%s' % limit_file]
+    if args.ursula_changed and playbook_run:
+        if _has_tags(extra_args):
+            LOG.warn("--tags was given, not selecting tags for the changed "
+                     "files")
+        else:
+            tags = _changed_tags(args, extra_args)
+            if tags == []:
+                stream.write("Nothing %s uses changed since %s" % (
+                    args.playbook, args.ursula_changed))
+                return 0
+            if tags:
+                extra_args += ['--tags', ",".join(tags)]
+    if args.ursula_warm and not args.ursula_test:
+        limit, _ = _pop_limit(extra_args)
+        _, unreachable = _warm_control_masters(
+            inventory, args.ursula_user,
+            pattern=args.module_hosts if args.module else 'all',
+            subset=limit, concurrency=args.ursula_warm_concurrency, env=env)
+        if unreachable and args.ursula_warm_exclude:
+            LOG.warn("Excluding %d unreachable hosts from the run",
+                     len(unreachable))
+            extra_args = _exclude_hosts(extra_args, unreachable)
+    cached_facts = None
+    if fact_cache and playbook_run:
+        cached_facts = _fact_cache_status(inventory, args, extra_args,
+                                          fact_cache)
+    run_profiler = None
+    callbacks = []
+    tracker = profiler.FailureTracker()
     if args.module:
         if not args.module_args:
             raise Exception(
                 "--module also requires --module-args")
         if not args.module_hosts:
             args.module_hosts = "all"
-        rc = _run_module(inventory, args.module, module_args=args.module_args,
-                         module_hosts=args.module_hosts, extra_args=extra_args,
-                         user=args.ursula_user, sudo=args.ursula_sudo)
+        if args.ursula_profile:
+            run_profiler = profiler.RunProfiler(adhoc_name=args.module)
+            callbacks.append(run_profiler.feed)
+        aggregator = None
+        if args.ursula_aggregate or args.ursula_aggregate_normalized:
+            aggregator = aggregate.Aggregator(
+                normalized=args.ursula_aggregate_normalized, prefix=prefix)
+        with history.phase(record, 'ansible'):
+            rc = _run_module(inventory, args.module,
+                             module_args=args.module_args,
+                             module_hosts=args.module_hosts,
+                             extra_args=extra_args, user=args.ursula_user,
+                             sudo=args.ursula_sudo, callbacks=callbacks,
+                             output_log=output_log, prefix=prefix,
+                             json_output=args.ursula_json,
+                             aggregator=aggregator, env=env)
+        if record is not None:
+            record.hosts = _count_hosts(inventory, args.module_hosts,
+                                        extra_args)
+    elif args.ursula_test:
+        with history.phase(record, 'ansible'):
+            rc = _syntax_check(inventory, args, extra_args,
+                               output_log=output_log, prefix=prefix, env=env)
+    elif args.ursula_shards > 1:
+        if args.ursula_profile:
+            LOG.warn("--ursula-profile is not supported with --ursula-shards")
+        with history.phase(record, 'ansible'):
+            rc = _run_sharded(inventory, args.playbook, args.ursula_shards,
+                              environment=args.environment,
+                              by_group=args.ursula_shard_by_group,
+                              extra_args=extra_args, user=args.ursula_user,
+                              sudo=args.ursula_sudo, output_log=output_log,
+                              prefix=prefix, recap=tracker, env=env)
     else:
-        rc = _run_ansible(inventory, args.playbook, extra_args=extra_args,
-                          user=args.ursula_user, sudo=args.ursula_sudo)
+        if args.ursula_profile:
+            run_profiler = profiler.RunProfiler()
+            callbacks.append(run_profiler.feed)
+        callbacks.append(tracker.feed)
+        with history.phase(record, 'ansible'):
+            rc = _run_ansible(inventory, args.playbook, extra_args=extra_args,
+                              user=args.ursula_user, sudo=args.ursula_sudo,
+                              callbacks=callbacks, output_log=output_log,
+                              prefix=prefix, env=env)
+
+    if playbook_run:
+        if fingerprints is not None:
+            fingerprint.record(args.environment, args.playbook, fingerprints,
+                               tracker)
+        with history.phase(record, 'ansible'):
+            rc, failures = _retry_transient(
+                inventory, args, extra_args, rc, tracker.failed_hosts(),
+                fingerprints, output_log=output_log, prefix=prefix, env=env)
+        _record_last_run(args, rc, failures, stream)
+        if record is not None:
+            record.hosts = len(tracker.hosts)
+    if cached_facts:
+        hits, misses = cached_facts
+        stream.write("Fact cache: %d hits, %d misses" % (len(hits),
+                                                         len(misses)))
+        if misses:
+            LOG.debug("Gathered facts for %s", ", ".join(misses))
+    if run_profiler:
+        run_profiler.finish()
+        profile_path = os.path.join(args.environment, profiler.PROFILE_FILE)
+        run_profiler.write(profile_path)
+        stream.write(run_profiler.summary(args.ursula_profile_top))
+        LOG.info("Run profile written to %s", profile_path)
     return rc
 
 
+def _count_hosts(inventory_file, pattern, extra_args):
+    limit, _ = _pop_limit(extra_args)
+    try:
+        return len(inventory.load_index(inventory_file).resolve(pattern,
+                                                                limit))
+    except inventory.InventoryError:
+        return None
+
+
+def _fact_cache_status(inventory_file, args, extra_args, fact_cache):
+    # which of the hosts the playbook gathers facts on have them cached
+    limit, _ = _pop_limit(extra_args)
+    try:
+        hosts = facts.gathering_hosts(args.playbook,
+                                      inventory.load_index(inventory_file),
+                                      limit)
+    except Exception as e:
+        LOG.debug("Not reporting fact cache use: %s", e)
+        return None
+    if not hosts:
+        return None
+    return facts.cache_status(fact_cache, hosts, args.ursula_fact_cache_ttl)
+
+
+def _resume_failures(inventory_file, args, extra_args, failures,
+                     fingerprints=None, output_log=None, prefix=None,
+                     env=None):
+    # re-run each failed host from the task it failed on, returning the
+    # failures that are left afterwards
+    _, extra_args = _pop_limit(extra_args)
+    rc = 0
+    remaining = {}
+    for task, hosts in resume.group_by_task(failures):
+        group_args = extra_args + ['--limit', ','.join(hosts)]
+        if task:
+            LOG.info("Resuming %s at task '%s'", ", ".join(hosts), task)
+            group_args += ['--start-at-task', task]
+        else:
+            LOG.info("Re-running %s from the start", ", ".join(hosts))
+        tracker = profiler.FailureTracker()
+        group_rc = _run_ansible(inventory_file, args.playbook,
+                                extra_args=group_args,
+                                user=args.ursula_user, sudo=args.ursula_sudo,
+                                callbacks=[tracker.feed],
+                                output_log=output_log, prefix=prefix,
+                                env=env)
+        # a run killed by a signal has a negative rc
+        rc = rc or group_rc
+        if fingerprints is not None:
+            fingerprint.record(args.environment, args.playbook,
+                               fingerprints, tracker)
+        if group_rc and not tracker.hosts:
+            # ansible stopped before running anything on these hosts
+            remaining.update((host, failures[host]) for host in hosts)
+        else:
+            remaining.update(tracker.failed_hosts())
+    return rc, remaining
+
+
+def _retry_transient(inventory_file, args, extra_args, rc, failures,
+                     fingerprints=None, output_log=None, prefix=None,
+                     env=None):
+    for attempt in range(args.ursula_retries):
+        transient = dict((host, failure)
+                         for host, failure in failures.iteritems()
+                         if failure['transient'])
+        if not transient:
+            break
+        delay = resume.retry_delay(attempt, args.ursula_retry_delay)
+        LOG.warn("Retrying %d hosts with transient failures in %ds "
+                 "(attempt %d/%d)", len(transient), delay, attempt + 1,
+                 args.ursula_retries)
+        time.sleep(delay)
+        retry_rc, retried = _resume_failures(
+            inventory_file, args, extra_args, transient, fingerprints,
+            output_log=output_log, prefix=prefix, env=env)
+        failures = dict((host, failure)
+                        for host, failure in failures.iteritems()
+                        if host not in transient)
+        failures.update(retried)
+        if not failures:
+            rc = 0
+        elif retry_rc:
+            rc = retry_rc
+    return rc, failures
+
+
+def _record_last_run(args, rc, failures, stream):
+    resume.save(args.environment, args.playbook, rc, failures)
+    if failures:
+        lines = ["Failed hosts:"]
+        for host, failure in sorted(failures.iteritems()):
+            lines.append("  %s: %s (last completed: %s)" % (
+                host, failure['task'] or "before the first task",
+                failure['last_completed'] or "none"))
+        lines.append("Run again with --ursula-resume to continue each host "
+                     "from the task it failed on")
+        stream.write("\n".join(lines))
+
+
+def _resume_last_run(inventory_file, args, extra_args, output_log=None,
+                     prefix=None, env=None):
+    last_run = resume.load(args.environment)
+    if last_run is None:
+        raise Exception("No previous run recorded for %s" % args.environment)
+    if last_run['playbook'] != os.path.normpath(args.playbook):
+        raise Exception("The last run in %s was of %s, not %s"
+                        % (args.environment, last_run['playbook'],
+                           args.playbook))
+    stream = output.OutputStream(prefix=prefix, log=output_log)
+    failures = last_run['failed']
+    if not failures:
+        stream.write("Nothing to resume, no host failed in the last run")
+        return 0
+
+    rc, failures = _resume_failures(inventory_file, args, extra_args,
+                                    failures, output_log=output_log,
+                                    prefix=prefix, env=env)
+    rc, failures = _retry_transient(inventory_file, args, extra_args, rc,
+                                    failures, output_log=output_log,
+                                    prefix=prefix, env=env)
+    _record_last_run(args, rc, failures, stream)
+    return rc
+
+
+def _environment_inventory(environment):
+    # the environment's hosts file, or the inventory generated from its heat
+    # stack if it has none
+    inventory_file = os.path.join(environment, 'hosts')
+    if not os.path.isfile(inventory_file):
+        generated = heat.inventory_path(environment)
+        if os.path.isfile(generated):
+            return generated
+        raise Exception("Inventory file '%s' does not exist" % inventory_file)
+    return inventory_file
+
+
+def warm(args, env=None):
+    # keep control masters to every host open between back-to-back runs,
+    # reconnecting (which restarts ControlPersist) every interval
+    if env is None:
+        env = os.environ
+
+    _set_default_env(env)
+    args.environment = args.environment.rstrip('/').rstrip('\\')
+    inventory_file = _environment_inventory(args.environment)
+
+    _set_ssh_config_env(args, env)
+    # the ssh config written by the vagrant and heat provisioners
+    provisioned_ssh_config = os.path.abspath(
+        os.path.join(args.environment, '.ssh_config'))
+    if os.path.isfile(provisioned_ssh_config):
+        _append_envvar("ANSIBLE_SSH_ARGS", "-F %s" % provisioned_ssh_config,
+                       env)
+
+    while True:
+        connections, unreachable = _warm_control_masters(
+            inventory_file, args.ursula_user, subset=args.limit,
+            concurrency=args.ursula_warm_concurrency, env=env)
+        if not connections:
+            raise Exception("No hosts in %s match --limit %s"
+                            % (inventory_file, args.limit))
+        if args.once:
+            return 1 if unreachable else 0
+        time.sleep(args.ursula_warm_interval)
+
+
+def gather_facts(args, env=None):
+    # refresh the environment's fact cache, without running a playbook
+    if env is None:
+        env = os.environ
+
+    args.environment = args.environment.rstrip('/').rstrip('\\')
+    inventory_file = _environment_inventory(args.environment)
+    fact_cache = _set_default_env(env, args.environment,
+                                  args.ursula_fact_cache_ttl)
+    if fact_cache is None and not args.ursula_fact_cache_ttl:
+        raise Exception("--ursula-fact-cache-ttl must be more than 0")
+    if fact_cache is None:
+        raise Exception("ursula does not manage the fact cache here, "
+                        "ansible.cfg or ANSIBLE_CACHE_PLUGIN configures one")
+
+    _set_ssh_config_env(args, env)
+    provisioned_ssh_config = os.path.abspath(
+        os.path.join(args.environment, '.ssh_config'))
+    if os.path.isfile(provisioned_ssh_config):
+        _append_envvar("ANSIBLE_SSH_ARGS", "-F %s" % provisioned_ssh_config,
+                       env)
+
+    hosts = inventory.load_index(inventory_file).resolve('all', args.limit)
+    if not hosts:
+        raise Exception("No hosts in %s match --limit %s"
+                        % (inventory_file, args.limit))
+    if args.stale:
+        hits, hosts = facts.cache_status(fact_cache, hosts,
+                                         args.ursula_fact_cache_ttl)
+        if not hosts:
+            print "All %d hosts have facts cached" % len(hits)
+            return 0
+
+    limit_file = os.path.abspath(
+        os.path.join(args.environment, '.ursula_facts_limit'))
+    utils.atomic_write(limit_file, "\n".join(hosts) + "\n")
+    return _run_module(inventory_file, 'setup', '', user=args.ursula_user,
+                       sudo=args.ursula_sudo,
+                       extra_args=['--forks', str(args.forks),
+                                   '--limit', '@%s' % limit_file],
+                       aggregator=facts.GatherResults(), env=env)
+
+
+def _expand_environments(spec):
+    environments = []
+    for pattern in spec.split(','):
+        pattern = pattern.strip().rstrip('/').rstrip('\\')
+        if not pattern:
+            continue
+        if glob.has_magic(pattern):
+            matches = [m.rstrip('/') for m in sorted(glob.glob(pattern))
+                       if os.path.isdir(m)]
+        else:
+            # a missing environment is reported by run()
+            matches = [pattern]
+        for match in matches:
+            if match not in environments:
+                environments.append(match)
+    return environments
+
+
+def run_many(environments, args, extra_args):
+    # Every environment gets its own copy of the arguments, its own
+    # environment dict (run() otherwise mutates os.environ), its own
+    # <environment>/ursula.log and a prefix on each line of its output.
+    if args.provisioner == 'vagrant':
+        raise Exception("vagrant environments share the Vagrantfile in the "
+                        "current directory and can't be deployed "
+                        "concurrently")
+
+    width = max([len("ENVIRONMENT")] +
+                [len(environment) for environment in environments])
+
+    def deploy(environment):
+        env_args = copy.copy(args)
+        env_args.environment = environment
+        started = time.time()
+        output_log = None
+        try:
+            if os.path.isdir(environment):
+                output_log = output.RunLog(
+                    os.path.join(environment, 'ursula.log'),
+                    strip_color=not args.ursula_log_color)
+            rc = _run_recorded(env_args, list(extra_args),
+                               output_log=output_log,
+                               prefix="[%s] " % environment.ljust(width),
+                               env=os.environ.copy())
+        except Exception as e:
+            LOG.error("%s: %s", environment, e)
+            rc = -1
+        finally:
+            if output_log:
+                output_log.close()
+        return rc, time.time() - started
+
+    results = utils.parallel_map(deploy, environments,
+                                 args.ursula_env_concurrency)
+
+    print ""
+    print "%-*s  %10s  %4s" % (width, "ENVIRONMENT", "DURATION", "RC")
+    for environment, (rc, duration) in zip(environments, results):
+        print "%-*s  %10s  %4d" % (width, environment,
+                                   utils.format_duration(duration), rc)
+
+    failed = [rc for rc, _ in results if rc]
+    return failed[0] if failed else 0
+
+
 def parse_args():
     parser = argparse.ArgumentParser(description='A CLI wrapper for ansible')
-    parser.add_argument('environment', help='The environment you want to use')
+    parser.add_argument('environment',
+                        help='The environment you want to use. Several '
+                             'environments can be given as a comma '
+                             'separated list or a glob, and are deployed '
+                             'concurrently')
     parser.add_argument('playbook', help='The playbook to run')
     # any args should be namespaced --ursula-$SOMETHING so as not to conflict
     # with ansible-playbook's command line parameters
@@ -543,6 +1582,69 @@ def parse_args():
                         help='Test syntax for playbook')
     parser.add_argument('--ursula-debug', action='store_true',
                         help='Run this tool in debug mode')
+    parser.add_argument('--ursula-log-output', action='store_true',
+                        help='Copy command output to the event log file')
+    parser.add_argument('--ursula-log-color', action='store_true',
+                        help='Keep ANSI colors in the run log copy')
+    parser.add_argument('--ursula-profile', action='store_true',
+                        help='Record per task and per host timings of the '
+                             'run and report the slowest')
+    parser.add_argument('--ursula-profile-top', type=int, default=10,
+                        help='Number of slowest tasks and hosts to report '
+                             'with --ursula-profile')
+    parser.add_argument('--ursula-shards', type=int, default=1,
+                        help='Split the inventory into this many partitions '
+                             'and run the playbook on them in parallel')
+    parser.add_argument('--ursula-shard-by-group', action='store_true',
+                        help='Keep hosts of the same inventory group in the '
+                             'same shard')
+    parser.add_argument('--ursula-incremental', action='store_true',
+                        help='Only run the playbook on hosts whose playbook, '
+                             'roles, variables or extra-vars changed since '
+                             'their last successful run')
+    parser.add_argument('--ursula-full', action='store_true',
+                        help='Run on every host even with '
+                             '--ursula-incremental, recording fresh '
+                             'fingerprints, and run --ursula-test even if '
+                             'nothing changed since it passed')
+    parser.add_argument('--ursula-changed', nargs='?', const='HEAD',
+                        default=None, metavar='REVISION',
+                        help='Only run the tags of the roles and plays '
+                             'affected by the files changed since this git '
+                             'revision (HEAD if not given), including '
+                             'uncommitted and untracked files')
+    parser.add_argument('--ursula-resume', action='store_true',
+                        help='Re-run only the hosts that failed in the last '
+                             'run, starting at the task each failed on')
+    parser.add_argument('--ursula-retries', type=int, default=0,
+                        help='Retry hosts that failed with a transient error '
+                             '(unreachable, timeouts, held locks) up to this '
+                             'many times')
+    parser.add_argument('--ursula-retry-delay', type=int,
+                        default=resume.RETRY_DELAY,
+                        help='Seconds to wait before the first retry, '
+                             'doubling for every further retry')
+    parser.add_argument('--ursula-env-concurrency', type=int, default=4,
+                        help='Maximum number of environments to deploy at '
+                             'once when several are given')
+    parser.add_argument('--ursula-warm', action='store_true',
+                        help='Open SSH control masters to all hosts in '
+                             'parallel before running ansible')
+    parser.add_argument('--ursula-warm-exclude', action='store_true',
+                        help='Leave hosts that --ursula-warm could not reach '
+                             'out of the run')
+    parser.add_argument('--ursula-warm-concurrency', type=int,
+                        default=ssh.WARM_CONCURRENCY,
+                        help='Maximum number of control masters to open at '
+                             'once')
+    parser.add_argument('--ursula-ssh-concurrency', type=int,
+                        default=ssh.DEFAULT_CONCURRENCY,
+                        help='Maximum number of hosts to probe for SSH '
+                             'connectivity at once')
+    parser.add_argument('--ursula-ssh-timeout', type=int,
+                        default=ssh.DEFAULT_TIMEOUT,
+                        help='Seconds to wait for SSH connectivity to all '
+                             'provisioned hosts')
     parser.add_argument('--provisioner',
                         help='The external provisioner to use',
                         default=None, choices=["vagrant", "heat"])
@@ -558,6 +1660,16 @@ def parse_args():
     parser.add_argument('--module-hosts',
                         help='host pattern for arbitrary module',
                         default=None)
+    parser.add_argument('--ursula-json', action='store_true',
+                        help='Print the per host results of --module or '
+                             '--adhoc as JSON')
+    parser.add_argument('--ursula-aggregate', action='store_true',
+                        help='Print each distinct --module or --adhoc '
+                             'result once, with the hosts that returned it')
+    parser.add_argument('--ursula-aggregate-normalized', action='store_true',
+                        help='Like --ursula-aggregate, but group results '
+                             'that only differ in host names, addresses, '
+                             'ids and numbers')
     parser.add_argument(
         '--heat-stack-name', default=None,
         help='Name of the heat stack when heat provisioner is used',
@@ -566,6 +1678,16 @@ def parse_args():
         '--heat-stack-update', default=False, action='store_true',
         help='Update the heat stack',
     )
+    parser.add_argument(
+        '--heat-inventory', default=False, action='store_true',
+        help='Run against the inventory generated from the heat stack '
+             'outputs instead of the hosts file, which is the default when '
+             'the environment has no hosts file')
+    parser.add_argument(
+        '--heat-probe-servers', default=False, action='store_true',
+        help='Wait for SSH on every server behind the floating IP, not '
+             'just the floating IP itself',
+    )
     parser.add_argument(
         '--heat-parameters', metavar='<KEY1=VALUE1;KEY2=VALUE2...>',
            help='Parameter values used to create the stack. '
@@ -574,12 +1696,307 @@ def parse_args():
            action='append')
     parser.add_argument('--vagrant', action='store_true',
                         help='Provision environment in vagrant')
+    parser.add_argument('--vagrant-concurrency', type=int, default=1,
+                        help='Boot up to this many vagrant VMs in parallel')
     parser.add_argument('--ursula-sudo', action='store_true',
                         help='Enable sudo')
+    parser.add_argument('--ursula-fact-cache-ttl', type=int,
+                        default=facts.DEFAULT_TTL,
+                        help='Seconds the facts cached for a host are reused '
+                             'by later runs, by default (0) they are '
+                             'gathered every run')
+    parser.add_argument('--ursula-no-history', action='store_true',
+                        help='Do not record this run in the run history')
     return parser.parse_known_args()
 
 
+def parse_warm_args(argv):
+    parser = argparse.ArgumentParser(
+        prog='ursula warm',
+        description='Keep SSH control masters to an environment open')
+    parser.add_argument('environment', help='The environment to warm')
+    parser.add_argument('--ursula-user', help='The user to connect as',
+                        default=None)
+    parser.add_argument('--ursula-ssh-config', help='path to your ssh config')
+    parser.add_argument('--ursula-forward', action='store_true',
+                        help='Forward SSH agent')
+    parser.add_argument('--ursula-debug', action='store_true',
+                        help='Run this tool in debug mode')
+    parser.add_argument('--ursula-warm-concurrency', type=int,
+                        default=ssh.WARM_CONCURRENCY,
+                        help='Maximum number of control masters to open at '
+                             'once')
+    parser.add_argument('--provisioner',
+                        help='The external provisioner the environment was '
+                             'deployed with',
+                        default=None, choices=["vagrant", "heat"])
+    parser.add_argument('--ursula-warm-interval', type=int,
+                        default=ssh.WARM_INTERVAL,
+                        help='Seconds between reconnects')
+    parser.add_argument('--limit', '-l', default=None,
+                        help='Only warm hosts matching this pattern')
+    parser.add_argument('--once', action='store_true',
+                        help='Open the masters once and exit')
+    return parser.parse_args(argv)
+
+
+def warm_main(argv):
+    args = parse_warm_args(argv)
+    try:
+        log_level = logging.INFO
+        if args.ursula_debug:
+            log_level = logging.DEBUG
+        _initialize_logger(log_level)
+        # the same default user as a run, so the masters end up at the
+        # ControlPath (u-%r@%h:%p) ansible will look for
+        if not args.ursula_user:
+            if args.provisioner == 'vagrant':
+                args.ursula_user = 'vagrant'
+            else:
+                args.ursula_user = 'ubuntu'
+        sys.exit(warm(args))
+    except KeyboardInterrupt:
+        sys.exit(0)
+    except Exception as e:
+        LOG.error(e)
+        sys.exit(-1)
+
+
+def _history_parser(prog, description):
+    parser = argparse.ArgumentParser(prog=prog, description=description)
+    parser.add_argument('environment', nargs='?', default=None,
+                        help='Only show runs of this environment')
+    parser.add_argument('--playbook', default=None,
+                        help='Only show runs of this playbook (or module)')
+    parser.add_argument('--ursula-debug', action='store_true',
+                        help='Run this tool in debug mode')
+    return parser
+
+
+def history_main(argv):
+    parser = _history_parser('ursula history',
+                             'Show recent runs and how long each phase took')
+    parser.add_argument('-n', '--count', type=int, default=20,
+                        help='Number of runs to show, 0 for all')
+    args = parser.parse_args(argv)
+    try:
+        _initialize_logger(logging.DEBUG if args.ursula_debug
+                           else logging.INFO)
+        target = args.playbook and os.path.normpath(args.playbook)
+        print history.format_runs(history.runs(args.environment, target,
+                                               count=args.count))
+    except Exception as e:
+        LOG.error(e)
+        sys.exit(-1)
+
+
+def stats_main(argv):
+    parser = _history_parser('ursula stats',
+                             'Show p50/p95 run times per playbook, recent '
+                             'runs against earlier ones')
+    parser.add_argument('--phase', default='duration',
+                        choices=('duration',) + history.PHASES,
+                        help='Report the time of a single phase instead of '
+                             'whole runs')
+    args = parser.parse_args(argv)
+    try:
+        _initialize_logger(logging.DEBUG if args.ursula_debug
+                           else logging.INFO)
+        target = args.playbook and os.path.normpath(args.playbook)
+        print history.format_stats(history.stats(args.environment, target,
+                                                 column=args.phase))
+    except Exception as e:
+        LOG.error(e)
+        sys.exit(-1)
+
+
+def parse_facts_args(argv):
+    parser = argparse.ArgumentParser(
+        prog='ursula facts',
+        description="Refresh the cached facts of an environment's hosts")
+    parser.add_argument('environment', help='The environment to gather')
+    parser.add_argument('--ursula-user', help='The user to connect as',
+                        default=None)
+    parser.add_argument('--ursula-ssh-config', help='path to your ssh config')
+    parser.add_argument('--ursula-forward', action='store_true',
+                        help='Forward SSH agent')
+    parser.add_argument('--ursula-sudo', action='store_true',
+                        help='Enable sudo')
+    parser.add_argument('--ursula-debug', action='store_true',
+                        help='Run this tool in debug mode')
+    parser.add_argument('--ursula-fact-cache-ttl', type=int,
+                        default=facts.GATHER_TTL,
+                        help='Seconds cached facts stay fresh, runs reuse '
+                             'them when given the same '
+                             '--ursula-fact-cache-ttl')
+    parser.add_argument('--provisioner',
+                        help='The external provisioner the environment was '
+                             'deployed with',
+                        default=None, choices=["vagrant", "heat"])
+    parser.add_argument('--forks', type=int, default=facts.DEFAULT_FORKS,
+                        help='Number of hosts to gather facts from at once')
+    parser.add_argument('--limit', '-l', default=None,
+                        help='Only gather facts for hosts matching this '
+                             'pattern')
+    parser.add_argument('--stale', action='store_true',
+                        help='Only gather facts for hosts without fresh '
+                             'cached facts')
+    return parser.parse_args(argv)
+
+
+def facts_main(argv):
+    args = parse_facts_args(argv)
+    try:
+        log_level = logging.INFO
+        if args.ursula_debug:
+            log_level = logging.DEBUG
+        _initialize_logger(log_level)
+        _check_ansible_version()
+        if args.ursula_fact_cache_ttl <= 0:
+            raise Exception("--ursula-fact-cache-ttl must be positive")
+        # connect the way a run does, so the cached facts are the ones the
+        # run would have gathered
+        if args.provisioner:
+            args.ursula_sudo = True
+        if not args.ursula_user:
+            if args.provisioner == 'vagrant':
+                args.ursula_user = 'vagrant'
+            elif args.provisioner == 'heat':
+                args.ursula_user = 'ubuntu'
+            else:
+                args.ursula_user = 'root'
+        sys.exit(gather_facts(args))
+    except Exception as e:
+        LOG.error(e)
+        sys.exit(-1)
+
+
+def _warm_args_from_run(argv):
+    # the `ursula warm` arguments matching a run, used by the daemon to
+    # keep the control masters of the environments it ran against open
+    if argv[:1] and argv[0] in COMMANDS:
+        return None
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('environment', nargs='?')
+    for option in ('--ursula-user', '--ursula-ssh-config', '--provisioner'):
+        parser.add_argument(option)
+    parser.add_argument('--ursula-forward', action='store_true')
+    parser.add_argument('--vagrant', action='store_true')
+    try:
+        args, _ = parser.parse_known_args(argv)
+    except SystemExit:
+        return None
+    if not args.environment or len(_expand_environments(
+            args.environment)) != 1:
+        return None
+
+    warm_argv = ['warm', args.environment, '--once']
+    if args.vagrant:
+        args.provisioner = 'vagrant'
+    for option in ('ursula_user', 'ursula_ssh_config', 'provisioner'):
+        value = getattr(args, option)
+        if value:
+            warm_argv += ['--%s' % option.replace('_', '-'), value]
+    if args.ursula_forward:
+        warm_argv.append('--ursula-forward')
+    return warm_argv
+
+
+def _run_argv(argv):
+    # what `ursula <argv>` does, in a daemon worker
+    logging.getLogger('ursula_cli').handlers = []
+    logging.getLogger(eventlog.OUTPUT_LOGGER).handlers = []
+    sys.argv = ['ursula'] + list(argv)
+    main()
+
+
+def parse_daemon_args(argv):
+    parser = argparse.ArgumentParser(
+        prog='ursula daemon',
+        description='Serve ursula runs from a long lived process, so that '
+                    'ansible is loaded once and SSH control masters stay '
+                    'open. ursula uses a running daemon automatically, set '
+                    '%s=1 to bypass it.' % daemon.DISABLE_ENVVAR)
+    parser.add_argument('--socket', default=daemon.SOCKET_PATH,
+                        help='Unix socket to listen on')
+    parser.add_argument('--ursula-debug', action='store_true',
+                        help='Run this tool in debug mode')
+    parser.add_argument('--ursula-warm-interval', type=int,
+                        default=ssh.WARM_INTERVAL,
+                        help='Seconds between re-opening the control '
+                             'masters of recently used environments, 0 to '
+                             'disable')
+    parser.add_argument('--ursula-warm-idle', type=int,
+                        default=daemon.WARM_IDLE_TIMEOUT,
+                        help='Stop keeping an environment warm after this '
+                             'many seconds without a run against it')
+    return parser.parse_args(argv)
+
+
+def daemon_main(argv):
+    args = parse_daemon_args(argv)
+    try:
+        log_level = logging.INFO
+        if args.ursula_debug:
+            log_level = logging.DEBUG
+        _initialize_logger(log_level)
+        _check_ansible_version()
+        daemon.preload()
+        daemon.serve(_run_argv, warm_args=_warm_args_from_run,
+                     warm_interval=args.ursula_warm_interval,
+                     path=args.socket, idle_timeout=args.ursula_warm_idle)
+    except KeyboardInterrupt:
+        sys.exit(0)
+    except Exception as e:
+        LOG.error(e)
+        sys.exit(-1)
+
+
+COMMANDS = {
+    'daemon': daemon_main,
+    'facts': facts_main,
+    'history': history_main,
+    'stats': stats_main,
+    'warm': warm_main,
+}
+
+
+def _needs_terminal(argv):
+    # A daemon worker's stdin is /dev/null, so runs that prompt for a
+    # password, or play a playbook (or role) with vars_prompt or pause, stay
+    # in this process.
+    for arg in argv:
+        if arg in PROMPT_FLAGS or PROMPT_SHORT_FLAGS.match(arg):
+            return True
+    for playbook in argv:
+        if not (playbook.endswith(('.yml', '.yaml')) and
+                os.path.isfile(playbook)):
+            continue
+        base = os.path.dirname(os.path.abspath(playbook))
+        # the playbooks next to it, which it may include, and the roles
+        for path in [playbook] + glob.glob(os.path.join(base, '*.y*ml')) + \
+                glob.glob(os.path.join(base, 'roles', '*', 'tasks', '*.y*ml')):
+            try:
+                with open(path) as f:
+                    if PROMPT_KEYS.search(f.read()):
+                        return True
+            except IOError:
+                continue
+    return False
+
+
 def main():
+    if len(sys.argv) > 1 and sys.argv[1] in COMMANDS:
+        return COMMANDS[sys.argv[1]](sys.argv[2:])
+
+    if not _needs_terminal(sys.argv[1:]):
+        try:
+            rc = daemon.forward(sys.argv[1:])
+        except KeyboardInterrupt:
+            sys.exit(130)
+        if rc is not None:
+            sys.exit(rc)
+
     args, extra_args = parse_args()
     try:
         log_level = logging.INFO
@@ -595,7 +2012,14 @@ def main():
                 args.ursula_user = 'vagrant'
             else:
                 args.ursula_user = 'ubuntu'
-        rc = run(args, extra_args)
+        environments = _expand_environments(args.environment)
+        if not environments:
+            raise Exception("No environment matches '%s'" % args.environment)
+        if len(environments) > 1:
+            rc = run_many(environments, args, extra_args)
+        else:
+            args.environment = environments[0]
+            rc = run(args, extra_args)
         sys.exit(rc)
     except Exception as e:
         LOG.error(e)
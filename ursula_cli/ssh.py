@@ -0,0 +1,341 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2015, Craig Tracey <craigtracey@gmail.com>
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+
+import os
+import sys
+import time
+import heapq
+import Queue
+import shlex
+import random
+import socket
+import logging
+import tempfile
+import threading
+import subprocess
+
+from ursula_cli import utils
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT_CONCURRENCY = 16
+DEFAULT_TIMEOUT = 1800
+CONNECT_TIMEOUT = 10
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 30.0
+PROGRESS_INTERVAL = 10
+WARM_CONCURRENCY = 32
+# re-open masters well within the ControlPersist=300 set for ansible
+WARM_INTERVAL = 240
+
+
+def _ssh_errors():
+    from paramiko import BadHostKeyException, AuthenticationException
+    from paramiko import SSHException
+    return (BadHostKeyException, AuthenticationException, SSHException,
+            socket.error)
+
+
+def _ssh_client():
+    # paramiko is only imported once something actually needs to be probed,
+    # it is slow to import and most ursula runs never use it
+    import paramiko
+
+    client = paramiko.SSHClient()
+    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    return client
+
+
+def tcp_probe(host, port=22, timeout=CONNECT_TIMEOUT):
+    sock = None
+    try:
+        sock = socket.create_connection((host, port), timeout)
+        return True
+    except socket.error as e:
+        LOG.debug("TCP connect to %s:%s failed: %s", host, port, e)
+        return False
+    finally:
+        if sock is not None:
+            sock.close()
+
+
+def ssh_probe(host, user, key_file=None, port=22, timeout=CONNECT_TIMEOUT):
+    ssh = _ssh_client()
+    try:
+        ssh.connect(hostname=host, port=port, username=user,
+                    key_filename=key_file, timeout=timeout,
+                    banner_timeout=timeout)
+        LOG.debug("Connect to {0} successfully".format(host))
+        return True
+    except _ssh_errors() as e:
+        LOG.debug("Connect to {0} failed: {1}".format(host, e))
+        return False
+    finally:
+        ssh.close()
+
+
+def probe_host(host, user, key_file=None, port=22):
+    # the TCP connect is cheap and fails fast while a server is still
+    # booting, so only pay for the SSH handshake once sshd is listening
+    return tcp_probe(host, port) and ssh_probe(host, user, key_file, port)
+
+
+class BastionProbe(object):
+    # Probes servers behind a bastion the same way the ProxyCommand
+    # (ssh -W %h:%p user@bastion) in the generated .ssh_config reaches them,
+    # but over direct-tcpip channels multiplexed on a single transport so
+    # the bastion handshake is paid once rather than per host per retry.
+
+    def __init__(self, bastion, user, key_file=None, port=22,
+                 authenticate=True, timeout=CONNECT_TIMEOUT, bastion_port=22):
+        self.bastion = bastion
+        self.user = user
+        self.key_file = key_file
+        self.port = port
+        self.bastion_port = bastion_port
+        self.authenticate = authenticate
+        self.timeout = timeout
+        self._client = None
+        self._lock = threading.Lock()
+
+    def _transport(self):
+        with self._lock:
+            if self._client is not None:
+                transport = self._client.get_transport()
+                if transport is not None and transport.is_active():
+                    return transport
+                self._client.close()
+                self._client = None
+            LOG.debug("Opening transport to bastion %s", self.bastion)
+            client = _ssh_client()
+            try:
+                client.connect(hostname=self.bastion, port=self.bastion_port,
+                               username=self.user,
+                               key_filename=self.key_file,
+                               timeout=self.timeout,
+                               banner_timeout=self.timeout)
+            except Exception:
+                client.close()
+                raise
+            self._client = client
+            return client.get_transport()
+
+    def _open_channel(self, host):
+        transport = self._transport()
+        return transport.open_channel('direct-tcpip', (host, self.port),
+                                      ('127.0.0.1', 0), timeout=self.timeout)
+
+    def _read_banner(self, host):
+        channel = self._open_channel(host)
+        try:
+            channel.settimeout(self.timeout)
+            return channel.recv(256).startswith('SSH-')
+        finally:
+            channel.close()
+
+    def _login(self, host):
+        channel = self._open_channel(host)
+        client = _ssh_client()
+        try:
+            client.connect(hostname=host, port=self.port, username=self.user,
+                           key_filename=self.key_file, sock=channel,
+                           timeout=self.timeout, banner_timeout=self.timeout)
+            return True
+        finally:
+            client.close()
+            channel.close()
+
+    def __call__(self, host):
+        try:
+            if not self._read_banner(host):
+                return False
+            if self.authenticate:
+                return self._login(host)
+            return True
+        except _ssh_errors() as e:
+            LOG.debug("Connect to {0} via {1} failed: {2}".format(
+                host, self.bastion, e))
+            return False
+
+    def close(self):
+        with self._lock:
+            if self._client is not None:
+                self._client.close()
+                self._client = None
+
+
+def _backoff(attempt, base=BACKOFF_BASE, cap=BACKOFF_MAX):
+    delay = min(cap, base * (2 ** attempt))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def _report_progress(ready, total, started):
+    msg = "SSH ready: %d/%d, pending: %d (%ds elapsed)" % (
+        ready, total, total - ready, time.time() - started)
+    # redraw a single status line on a terminal, log a line otherwise
+    if sys.stdout.isatty():
+        sys.stdout.write("\r%s" % msg)
+    else:
+        sys.stdout.write("%s\n" % msg)
+    sys.stdout.flush()
+
+
+def _end_progress():
+    if sys.stdout.isatty():
+        sys.stdout.write("\n")
+        sys.stdout.flush()
+
+
+def _probe_worker(probe, jobs, results):
+    while True:
+        host = jobs.get()
+        if host is None:
+            return
+        try:
+            ok = probe(host)
+        except Exception as e:
+            LOG.debug("Probe of %s raised: %s", host, e)
+            ok = False
+        results.put((host, ok))
+
+
+def wait_for_ssh(hosts, probe, concurrency=DEFAULT_CONCURRENCY,
+                 timeout=DEFAULT_TIMEOUT):
+    hosts = sorted(set(hosts))
+    if not hosts:
+        return []
+
+    concurrency = max(1, min(concurrency, len(hosts)))
+    started = time.time()
+    deadline = started + timeout
+
+    jobs = Queue.Queue()
+    results = Queue.Queue()
+    workers = []
+    for _ in range(concurrency):
+        worker = threading.Thread(target=_probe_worker,
+                                  args=(probe, jobs, results))
+        worker.daemon = True
+        worker.start()
+        workers.append(worker)
+
+    # (time the next attempt is due, host)
+    schedule = [(started, host) for host in hosts]
+    heapq.heapify(schedule)
+    attempts = dict.fromkeys(hosts, 0)
+    ready = set()
+    in_flight = 0
+    last_report = 0
+
+    try:
+        while len(ready) < len(hosts):
+            now = time.time()
+            if now >= deadline:
+                pending = sorted(set(hosts) - ready)
+                raise Exception(
+                    "Timed out after %ds waiting for SSH connectivity to: %s"
+                    % (timeout, ", ".join(pending)))
+
+            while (schedule and schedule[0][0] <= now and
+                   in_flight < concurrency):
+                _, host = heapq.heappop(schedule)
+                jobs.put(host)
+                in_flight += 1
+
+            if now - last_report >= PROGRESS_INTERVAL:
+                _report_progress(len(ready), len(hosts), started)
+                last_report = now
+
+            wake = deadline
+            if schedule and in_flight < concurrency:
+                wake = min(wake, schedule[0][0])
+            wait = max(0.05, min(wake - now, 1))
+            try:
+                host, ok = results.get(timeout=wait)
+            except Queue.Empty:
+                continue
+
+            in_flight -= 1
+            if ok:
+                ready.add(host)
+                _report_progress(len(ready), len(hosts), started)
+                last_report = time.time()
+            else:
+                delay = _backoff(attempts[host])
+                attempts[host] += 1
+                LOG.debug("waiting %.1fs before retrying %s", delay, host)
+                heapq.heappush(schedule, (time.time() + delay, host))
+    finally:
+        _end_progress()
+        for _ in workers:
+            jobs.put(None)
+
+    return sorted(ready)
+
+
+def open_control_master(connection, ssh_args, user, host_key_checking=True,
+                        env=None):
+    # Runs a no-op command with the same ssh options ansible's ssh connection
+    # uses, so the master it leaves behind (ControlMaster=auto) sits at the
+    # ControlPath ansible will look up for this host. Running it against an
+    # already open master is cheap and restarts its ControlPersist timer.
+    if env is None:
+        env = os.environ
+    command = ['ssh'] + shlex.split(ssh_args) + [
+        '-o', 'BatchMode=yes',
+        '-o', 'ConnectTimeout=%d' % CONNECT_TIMEOUT,
+        '-o', 'User=%s' % (connection['user'] or user),
+    ]
+    if not host_key_checking:
+        command += ['-o', 'StrictHostKeyChecking=no']
+    if connection['port']:
+        command += ['-o', 'Port=%s' % connection['port']]
+    command += [connection['address'], 'true']
+
+    # the backgrounded master inherits ssh's stdio, so reading a pipe would
+    # block until ControlPersist expires
+    with open(os.devnull, 'r+') as devnull:
+        errors = tempfile.TemporaryFile()
+        try:
+            rc = subprocess.call(command, env=env.copy(), stdin=devnull,
+                                 stdout=devnull, stderr=errors)
+            errors.seek(0)
+            message = errors.read().strip()
+        finally:
+            errors.close()
+    if rc:
+        LOG.debug("Opening control master to %s failed: %s",
+                  connection['name'], message)
+    return rc == 0
+
+
+def warm_control_masters(connections, ssh_args, user,
+                         concurrency=WARM_CONCURRENCY, host_key_checking=True,
+                         env=None):
+    def warm(connection):
+        return open_control_master(connection, ssh_args, user,
+                                   host_key_checking, env)
+
+    started = time.time()
+    results = utils.parallel_map(warm, connections, concurrency)
+    unreachable = sorted(c['name'] for c, ok in zip(connections, results)
+                         if not ok)
+    LOG.info("Control masters open to %d/%d hosts (%.1fs)",
+             len(connections) - len(unreachable), len(connections),
+             time.time() - started)
+    if unreachable:
+        LOG.warn("Unreachable hosts: %s", ", ".join(unreachable))
+    return unreachable
@@ -0,0 +1,283 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2015, Craig Tracey <craigtracey@gmail.com>
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+
+import os
+import json
+import hashlib
+import logging
+import subprocess
+
+from ursula_cli import fingerprint
+from ursula_cli import utils
+
+LOG = logging.getLogger(__name__)
+
+INDEX_FILE = '.ursula_role_index.json'
+# bump when the layout of the cached index changes
+INDEX_VERSION = 2
+SYNTAX_CHECK_FILE = '.ursula_syntax_check.json'
+# directories next to the playbook that every play depends on
+SHARED_DIRS = ('library', 'group_vars', 'host_vars', 'action_plugins',
+               'callback_plugins', 'filter_plugins', 'lookup_plugins',
+               'vars_plugins')
+
+
+def _tags(value):
+    if not value:
+        return []
+    if isinstance(value, basestring):
+        value = value.split(',')
+    return [str(tag).strip() for tag in value if str(tag).strip()]
+
+
+def _content_hash(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        digest.update(f.read())
+    return digest.hexdigest()
+
+
+def build_index(playbook, roles_path=()):
+    # The playbook files, each play's tags, task files and vars_files, and
+    # each role it applies with the tags given to it and the directories of
+    # the role and everything it depends on. Also returns every file the
+    # index was read from.
+    plays, files = fingerprint.load_plays(playbook)
+    sources = set(files)
+    closures = {}
+
+    def closure(name, base, stack=()):
+        key = (name, base)
+        if key not in closures:
+            path = fingerprint.find_role(name, base, roles_path)
+            found = []
+            if path is None:
+                LOG.debug("Role %s not found, changes to it can't be "
+                          "targeted", name)
+            else:
+                path = os.path.abspath(path)
+                found.append(path)
+                meta = fingerprint.role_meta(path)
+                if meta:
+                    sources.add(meta)
+                for dependency in fingerprint.role_dependencies(path):
+                    if dependency in stack:
+                        continue
+                    found.extend(p for p in closure(dependency, base,
+                                                    stack + (name,))
+                                 if p not in found)
+            closures[key] = found
+        return closures[key]
+
+    index = {'playbooks': files, 'plays': []}
+    for play, base in plays:
+        roles = []
+        for role in play.get('roles') or []:
+            name = fingerprint.role_name(role)
+            if not name or '{{' in name:
+                continue
+            roles.append({
+                'name': name,
+                'tags': _tags(role.get('tags')) if isinstance(role, dict)
+                else [],
+                'paths': closure(name, base),
+            })
+        seen = set()
+        task_files = [path for key in fingerprint.TASK_LISTS
+                      for path in fingerprint.task_includes(play.get(key),
+                                                            base, seen)]
+        sources.update(task_files)
+        index['plays'].append({
+            'name': play.get('name') or play.get('hosts'),
+            'tags': _tags(play.get('tags')),
+            'roles': roles,
+            'files': task_files + list(fingerprint.vars_files(play, base)),
+        })
+    return index, sorted(sources)
+
+
+def _index_path(environment):
+    return os.path.join(environment, INDEX_FILE)
+
+
+def _load_all(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def _unchanged(sources):
+    try:
+        return all(_content_hash(path) == digest
+                   for path, digest in sources.iteritems())
+    except (IOError, OSError):
+        return False
+
+
+def load_index(environment, playbook, roles_path=()):
+    # the index is cached in the environment and rebuilt when any file it
+    # was read from changes
+    data = _load_all(_index_path(environment))
+    key = os.path.abspath(playbook)
+    cached = data.get(key)
+    if (cached and cached.get('version') == INDEX_VERSION and
+            cached.get('roles_path') == list(roles_path) and
+            _unchanged(cached.get('sources', {}))):
+        return cached['index']
+
+    LOG.debug("Indexing the roles of %s", playbook)
+    index, sources = build_index(playbook, roles_path)
+    data[key] = {
+        'version': INDEX_VERSION,
+        'roles_path': list(roles_path),
+        'sources': dict((path, _content_hash(path)) for path in sources),
+        'index': index,
+    }
+    try:
+        utils.atomic_write(_index_path(environment), json.dumps(data))
+    except (IOError, OSError) as e:
+        LOG.debug("Unable to cache the role index: %s", e)
+    return index
+
+
+def _under(path, directory):
+    return path == directory or path.startswith(directory + os.sep)
+
+
+def _unused_role_file(path, role_dirs, used):
+    # a file of a role the playbook doesn't apply
+    for directory in role_dirs:
+        if _under(path, directory) and path != directory:
+            role = os.path.join(directory, os.path.relpath(
+                path, directory).split(os.sep)[0])
+            return role != path and not any(_under(role, p) or _under(p, role)
+                                            for p in used)
+    return False
+
+
+def select_tags(index, changed, playbook, shared=(), roles_path=()):
+    # The tags that run everything the changed files affect: [] if none of
+    # them matter to the playbook, None if they can't be singled out by
+    # tags and the whole playbook has to run. Files next to the playbook
+    # that it doesn't name (templates, vars read by path, ...) may be used
+    # by any play, as may the shared files (extra-vars, the environment).
+    changed = set(os.path.abspath(path) for path in changed)
+    base = os.path.dirname(os.path.abspath(playbook))
+    shared = [os.path.abspath(path) for path in shared] + [
+        os.path.join(base, name) for name in SHARED_DIRS]
+    role_dirs = [os.path.join(base, 'roles')] + [
+        os.path.abspath(os.path.expanduser(path)) for path in roles_path]
+    used = set(path for play in index['plays'] for role in play['roles']
+               for path in role['paths'])
+    files = set(path for play in index['plays'] for path in play['files'])
+
+    for path in changed:
+        if (path in index['playbooks'] or
+                any(_under(path, directory) for directory in shared)):
+            LOG.info("%s changed, running the whole playbook",
+                     os.path.relpath(path))
+            return None
+        if (_under(path, base) and path not in files and
+                not any(_under(path, directory) for directory in used) and
+                not _unused_role_file(path, role_dirs, used)):
+            LOG.info("%s changed and may be used by any play, running the "
+                     "whole playbook", os.path.relpath(path))
+            return None
+
+    tags = set()
+    for play in index['plays']:
+        for role in play['roles']:
+            if not any(_under(path, directory) for path in changed
+                       for directory in role['paths']):
+                continue
+            selected = role['tags'] or play['tags']
+            if not selected:
+                LOG.info("Role %s changed but has no tags in play '%s', "
+                         "running the whole playbook", role['name'],
+                         play['name'])
+                return None
+            tags.update(selected)
+        if changed.intersection(play['files']):
+            if not play['tags']:
+                LOG.info("Tasks of play '%s' changed but it has no tags, "
+                         "running the whole playbook", play['name'])
+                return None
+            tags.update(play['tags'])
+    return sorted(tags)
+
+
+def changed_files(revision='HEAD'):
+    # files that differ from the given git revision, including uncommitted
+    # and untracked ones
+    def git(*args):
+        proc = subprocess.Popen(('git',) + args, stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+        out, err = proc.communicate()
+        if proc.returncode:
+            raise Exception("git %s failed: %s" % (" ".join(args),
+                                                   err.strip()))
+        return out.splitlines()
+
+    top = git('rev-parse', '--show-toplevel')[0]
+    names = git('diff', '--name-only', revision, '--')
+    names += git('ls-files', '--others', '--exclude-standard', '--full-name',
+                 top)
+    return sorted(set(os.path.join(top, name) for name in names if name))
+
+
+def syntax_check_key(environment, playbook, inventory_file, run_args,
+                     roles_path=(), version=None):
+    # covers everything a syntax check reads: the playbook, the files it
+    # includes, its roles, the inventory and the command line with the
+    # extra-vars files it names
+    index = load_index(environment, playbook, roles_path)
+    plays = index['plays']
+    digest = hashlib.sha256()
+    digest.update(json.dumps([run_args, version]))
+    for path in index['playbooks']:
+        fingerprint.hash_file(digest, path)
+    for path in sorted(set(path for play in plays for path in play['files'])):
+        fingerprint.hash_file(digest, path)
+    for path in sorted(set(path for play in plays for role in play['roles']
+                           for path in role['paths'])):
+        fingerprint.hash_tree(digest, path)
+    base = os.path.dirname(os.path.abspath(playbook))
+    for name in SHARED_DIRS:
+        if os.path.exists(os.path.join(base, name)):
+            fingerprint.hash_tree(digest, os.path.join(base, name))
+    if os.path.isfile(inventory_file):
+        fingerprint.hash_file(digest, os.path.abspath(inventory_file))
+    for path in fingerprint.extra_vars_files(run_args):
+        fingerprint.hash_file(digest, path)
+    return digest.hexdigest()
+
+
+def cached_syntax_check(environment, playbook, key):
+    # the output of the last syntax check, if it passed with this key
+    cached = _load_all(os.path.join(environment, SYNTAX_CHECK_FILE)).get(
+        os.path.abspath(playbook))
+    if cached and cached.get('key') == key:
+        return cached.get('output')
+    return None
+
+
+def save_syntax_check(environment, playbook, key, output):
+    path = os.path.join(environment, SYNTAX_CHECK_FILE)
+    data = _load_all(path)
+    data[os.path.abspath(playbook)] = {'key': key, 'output': output}
+    utils.atomic_write(path, json.dumps(data))
@@ -0,0 +1,57 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2015, Craig Tracey <craigtracey@gmail.com>
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+
+import json
+import logging
+import unittest
+
+from ursula_cli import eventlog
+
+
+class RedactTestCase(unittest.TestCase):
+
+    def test_redacts_values(self):
+        self.assertEqual(eventlog.redact('OS_PASSWORD=s3cret other=1'),
+                         'OS_PASSWORD=<redacted> other=1')
+        self.assertEqual(eventlog.redact('--os-password s3cret --limit x'),
+                         '--os-password <redacted> --limit x')
+
+    def test_leaves_other_words(self):
+        text = 'passed: 3 hosts; tokens_used=5; bypass=yes'
+        self.assertEqual(eventlog.redact(text), text)
+
+
+class JSONFormatterTestCase(unittest.TestCase):
+
+    def format(self, msg, *args, **extra):
+        record = logging.LogRecord('ursula_cli.shell', logging.DEBUG, __file__,
+                                   1, msg, args, None)
+        record.__dict__.update(extra)
+        return json.loads(eventlog.JSONFormatter().format(record))
+
+    def test_redacts_event_fields(self):
+        command = ['ansible-playbook', '-e', 'admin_password=s3cret',
+                   '--vault-password', 's3cret', '--ask-pass', '-v']
+        data = self.format(
+            "Running command: %s", " ".join(command),
+            **eventlog.event('command', command=command,
+                             env={'OS_TOKEN': 's3cret', 'A': 'token=s3cret'}))
+        self.assertNotIn('s3cret', json.dumps(data))
+        self.assertEqual(data['command'], [
+            'ansible-playbook', '-e', 'admin_password=<redacted>',
+            '--vault-password', '<redacted>', '--ask-pass', '-v'])
+        self.assertEqual(data['env'], {'OS_TOKEN': '<redacted>',
+                                       'A': 'token=<redacted>'})
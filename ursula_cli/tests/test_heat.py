@@ -0,0 +1,78 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2015, Craig Tracey <craigtracey@gmail.com>
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+
+import unittest
+
+from ursula_cli import heat
+
+
+class _Object(object):
+
+    def __init__(self, **attrs):
+        self.__dict__.update(attrs)
+
+
+class _FakeHeat(object):
+    # hands out one batch of stack events per poll; the stack is in the
+    # state of the last event handed out
+
+    def __init__(self, batches, disable_rollback=False):
+        self.batches = list(batches)
+        self.disable_rollback = disable_rollback
+        self.status = None
+        self.events = self
+        self.stacks = self
+
+    def list(self, stack_id, **kwargs):
+        batch = self.batches.pop(0) if self.batches else []
+        events = [_Object(id=status, resource_name='stack',
+                          resource_status=status) for status in batch]
+        if batch:
+            self.status = batch[-1]
+        return events
+
+    def get(self, stack_id):
+        action, status = self.status.split('_', 1)
+        return _Object(action=action, status=status, stack_status=self.status,
+                       disable_rollback=self.disable_rollback)
+
+
+class WaitForStackTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.poll_min = heat.POLL_MIN
+        heat.POLL_MIN = 0
+
+    def tearDown(self):
+        heat.POLL_MIN = self.poll_min
+
+    def test_complete(self):
+        client = _FakeHeat([['UPDATE_IN_PROGRESS'], ['UPDATE_COMPLETE']])
+        stack = heat.wait_for_stack(client, 'stack', 'update')
+        self.assertEqual(stack.stack_status, 'UPDATE_COMPLETE')
+
+    def test_waits_for_rollback(self):
+        client = _FakeHeat([['UPDATE_IN_PROGRESS'], ['UPDATE_FAILED'], [],
+                            ['ROLLBACK_IN_PROGRESS'], [],
+                            ['ROLLBACK_COMPLETE']])
+        stack = heat.wait_for_stack(client, 'stack', 'update')
+        self.assertEqual(stack.stack_status, 'ROLLBACK_COMPLETE')
+
+    def test_failed_without_rollback(self):
+        client = _FakeHeat([['CREATE_IN_PROGRESS'], ['CREATE_FAILED']],
+                           disable_rollback=True)
+        stack = heat.wait_for_stack(client, 'stack', 'create')
+        self.assertEqual(stack.stack_status, 'CREATE_FAILED')
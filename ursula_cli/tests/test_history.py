@@ -0,0 +1,44 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2015, Craig Tracey <craigtracey@gmail.com>
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+
+import unittest
+
+from ursula_cli import history
+
+
+def _runs(*durations):
+    return [{'environment': 'envs/test', 'kind': 'playbook',
+             'target': 'site.yml', 'rc': 0, 'duration': duration}
+            for duration in durations]
+
+
+class BaselineTestCase(unittest.TestCase):
+
+    def test_slow_run(self):
+        rows = history._with_baselines(_runs(100, 100, 100, 200))
+        self.assertEqual(rows[-1]['baseline'], 100)
+        self.assertTrue(rows[-1]['slow'])
+
+    def test_short_runs_are_not_slow(self):
+        rows = history._with_baselines(_runs(0.2, 0.2, 0.2, 0.45))
+        self.assertFalse(rows[-1]['slow'])
+        rows = history._with_baselines(_runs(20, 20, 20, 45))
+        self.assertFalse(rows[-1]['slow'])
+
+    def test_no_baseline(self):
+        rows = history._with_baselines(_runs(100, 100, 200))
+        self.assertIsNone(rows[-1]['baseline'])
+        self.assertFalse(rows[-1]['slow'])
@@ -0,0 +1,53 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2015, Craig Tracey <craigtracey@gmail.com>
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from ursula_cli import inventory
+
+HOSTS = """
+[compute]
+compute01
+compute02
+compute03
+"""
+
+
+class ResolveTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        path = os.path.join(self.directory, 'hosts')
+        with open(path, 'w') as f:
+            f.write(HOSTS)
+        self.index = inventory.load_index(path)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_subscript(self):
+        self.assertEqual(self.index.resolve('compute[0]'), ['compute01'])
+        self.assertEqual(self.index.resolve('compute[1:]'),
+                         ['compute02', 'compute03'])
+        self.assertEqual(self.index.resolve('compute[5]'), [])
+
+    def test_negative_subscript(self):
+        self.assertEqual(self.index.resolve('compute[-1]'), ['compute03'])
+        self.assertEqual(self.index.resolve('compute[-3]'), ['compute01'])
+        self.assertEqual(self.index.resolve('compute[-4]'), [])
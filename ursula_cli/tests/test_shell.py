@@ -0,0 +1,99 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2015, Craig Tracey <craigtracey@gmail.com>
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+from ursula_cli import shell
+
+
+class _RunsInProcess(Exception):
+    pass
+
+
+class NeedsTerminalTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.playbook = self.write('site.yml', "- hosts: all\n"
+                                               "  roles:\n"
+                                               "    - common\n")
+        self.write('roles/common/tasks/main.yml', "- ping:\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, name, text):
+        path = os.path.join(self.directory, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write(text)
+        return path
+
+    def test_plain_run(self):
+        self.assertFalse(shell._needs_terminal(
+            ['envs/test', self.playbook, '-e', 'a=1', '--limit', 'web']))
+
+    def test_prompt_flags(self):
+        for flag in ('--ask-vault-pass', '--ask-become-pass', '-k', '-vK'):
+            self.assertTrue(shell._needs_terminal(
+                ['envs/test', self.playbook, flag]), flag)
+
+    def test_prompting_playbook(self):
+        self.write('roles/common/tasks/main.yml',
+                   "- pause:\n    prompt: continue?\n")
+        self.assertTrue(shell._needs_terminal(['envs/test', self.playbook]))
+
+    def test_vars_prompt(self):
+        self.write('site.yml', "- hosts: all\n"
+                               "  vars_prompt:\n"
+                               "    - name: release\n")
+        self.assertTrue(shell._needs_terminal(['envs/test', self.playbook]))
+
+    def run_main(self, argv):
+        forwarded = []
+
+        def forward(args):
+            forwarded.append(args)
+            return 0
+
+        def parse_args():
+            raise _RunsInProcess()
+
+        saved = (sys.argv, shell.daemon.forward, shell.parse_args)
+        sys.argv = ['ursula'] + argv
+        shell.daemon.forward, shell.parse_args = forward, parse_args
+        try:
+            shell.main()
+        except (SystemExit, _RunsInProcess) as e:
+            return forwarded, e
+        finally:
+            sys.argv, shell.daemon.forward, shell.parse_args = saved
+
+    def test_prompting_run_is_not_forwarded(self):
+        forwarded, e = self.run_main(['envs/test', self.playbook,
+                                      '--ask-vault-pass'])
+        self.assertEqual(forwarded, [])
+        self.assertIsInstance(e, _RunsInProcess)
+
+    def test_run_is_forwarded(self):
+        forwarded, e = self.run_main(['envs/test', self.playbook])
+        self.assertEqual(forwarded, [['envs/test', self.playbook]])
+        self.assertIsInstance(e, SystemExit)
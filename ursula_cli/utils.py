@@ -0,0 +1,86 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2015, Craig Tracey <craigtracey@gmail.com>
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+
+import os
+import threading
+
+# AsyncResult.get() without a timeout can't be interrupted with ^C on
+# python 2, so wait with a (very long) timeout instead
+_MAP_TIMEOUT = 60 * 60 * 24 * 7
+
+
+def parallel_map(func, items, concurrency):
+    from multiprocessing.pool import ThreadPool
+
+    items = list(items)
+    if not items:
+        return []
+    pool = ThreadPool(max(1, min(concurrency, len(items))))
+    try:
+        results = pool.map_async(func, items, chunksize=1).get(_MAP_TIMEOUT)
+    except BaseException:
+        pool.terminate()
+        raise
+    pool.close()
+    pool.join()
+    return results
+
+
+def atomic_write(path, data, mode=0644):
+    # write to a temporary file next to the target and rename it over the
+    # target, so readers never see a partially written file; the temporary
+    # file is per thread as environments deploy from threads of one process
+    tmp_path = "%s.%d.%d.tmp" % (path, os.getpid(),
+                                 threading.current_thread().ident)
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(data)
+        os.rename(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+
+def write_if_changed(path, data, mode=0644):
+    # atomic_write, unless the file already holds data; returns whether it
+    # was written
+    try:
+        with open(path) as f:
+            if f.read() == data:
+                return False
+    except IOError:
+        pass
+    atomic_write(path, data, mode)
+    return True
+
+
+def cpu_count():
+    import multiprocessing
+
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return "%dh%02dm%02ds" % (hours, minutes, seconds)
+    return "%dm%02ds" % (minutes, seconds)